@@ -0,0 +1,320 @@
+"""
+asyncio counterparts of the job queue clients and SyncJob, on top of redis.asyncio.
+
+They run the same operations as the synchronous ones (see `run_operation`),
+so jobs submitted by async services are consumed by sync workers
+and vice versa. Async backend is picked by SyncJob.QUEUE_BACKEND:
+
+    job = AsyncSyncJob(device_id=1, sync_from="db", sync_to="device")
+    await job.put_to_queue(coalesce=True)
+    job = await AsyncSyncJob.get_next_from_queue()
+"""
+
+import asyncio
+import inspect
+import weakref
+from contextlib import asynccontextmanager
+
+import redis
+import redis.asyncio
+
+from mnoc_jobtools.tools import (
+    DEFAULT_REDIS_HOST,
+    DEFAULT_REDIS_MAX_CONNECTIONS,
+    DEFAULT_REDIS_PORT,
+    DEFAULT_SHARD_LEASE_TTL,
+    BaseRedisJobQueue,
+    BaseRedisStreamJobQueue,
+    BaseShardCoordinator,
+    BaseSyncJob,
+    Commands,
+    JobStatus,
+    RedisJobQueue,
+    RedisStreamJobQueue,
+    Sleep,
+)
+
+##################################################################
+
+
+async def execute_commands(
+    commands: Commands, client: redis.asyncio.Redis, scripts: dict
+) -> list:
+    """Same as `mnoc_jobtools.tools.execute_commands`, by the asyncio client"""
+    if not commands:
+        return []
+    commands.register_scripts(client, scripts)
+    if len(commands) == 1 and not commands.transaction:
+        try:
+            return [await commands.call(client, scripts)]
+        except redis.ResponseError as e:
+            if commands.raise_on_error:
+                raise
+            return [e]
+    async with client.pipeline(transaction=commands.transaction) as pipe:
+        commands.buffer(pipe, scripts)
+        return await pipe.execute(raise_on_error=commands.raise_on_error)
+
+
+async def run_operation(
+    operation, client: redis.asyncio.Redis = None, scripts: dict = None
+):
+    """Same as `mnoc_jobtools.tools.run_operation`, but the effects
+    only suspend the coroutine, not the event loop"""
+    result, error = None, None
+    while True:
+        try:
+            effect = operation.send(result) if error is None else operation.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        result, error = None, None
+        try:
+            if isinstance(effect, Commands):
+                result = await execute_commands(effect, client, scripts)
+            elif isinstance(effect, Sleep):
+                await asyncio.sleep(effect.seconds)
+            else:
+                result = effect.function(*effect.args, **effect.kwargs)
+                if inspect.isawaitable(result):
+                    result = await result
+        except Exception as e:
+            error = e
+
+
+##################################################################
+
+# Connections are bound to the event loop they were opened in,
+# so pools are shared within the loop only
+_connection_pools = weakref.WeakKeyDictionary()
+
+
+def get_async_connection_pool(
+    host: str = DEFAULT_REDIS_HOST,
+    port: int = DEFAULT_REDIS_PORT,
+    max_connections: int = DEFAULT_REDIS_MAX_CONNECTIONS,
+) -> redis.asyncio.ConnectionPool:
+    """
+    Same as `get_connection_pool`, but for the clients of the running event loop.
+    Must be called from a coroutine.
+    """
+    loop_pools = _connection_pools.setdefault(asyncio.get_running_loop(), {})
+    pool = loop_pools.get((host, port))
+    if pool is None:
+        pool = redis.asyncio.BlockingConnectionPool(
+            host=host, port=port, max_connections=max_connections
+        )
+        loop_pools[(host, port)] = pool
+    return pool
+
+
+class AsyncRedisJobQueue(BaseRedisJobQueue):
+    """Same as RedisJobQueue, but all the methods are coroutines.
+    Must be created from a coroutine, see `get_async_connection_pool`"""
+
+    def __init__(
+        self,
+        host: str = DEFAULT_REDIS_HOST,
+        port: int = DEFAULT_REDIS_PORT,
+        max_connections: int = DEFAULT_REDIS_MAX_CONNECTIONS,
+    ):
+        self._queue = redis.asyncio.Redis(
+            connection_pool=get_async_connection_pool(host, port, max_connections)
+        )
+        self._scripts = {}
+
+    async def _run(self, operation):
+        return await run_operation(operation, self._queue, self._scripts)
+
+    @asynccontextmanager
+    async def pipeline(self, transaction: bool = True):
+        """Same as `RedisJobQueue.pipeline`:
+
+        async with queue.pipeline() as pipe:
+            pipe.rpush(queue_name, value)
+            pipe.llen(queue_name)
+        """
+        async with self._queue.pipeline(transaction=transaction) as pipe:
+            yield pipe
+            if len(pipe):
+                await pipe.execute()
+
+    async def list(self, queue_name, start: int = 0, end: int = 10):
+        return await self._run(self._list_op(queue_name, start, end))
+
+    async def get(self, queue_names, block: float = 0, index_name: str = None):
+        """Same as `RedisJobQueue.get`"""
+        return await self._run(self._get_op(queue_names, block, index_name))
+
+    async def put(self, queue_name, *values):
+        await self._run(self._put_many_op(queue_name, values))
+
+    async def put_many(self, queue_name: str, values: list):
+        """Same as `RedisJobQueue.put_many`"""
+        await self._run(self._put_many_op(queue_name, values))
+
+    async def put_coalesced(
+        self, queue_name: str, index_name: str, key: str, uid: str, value
+    ) -> str:
+        """Same as `RedisJobQueue.put_coalesced`"""
+        items = [(queue_name, key, uid, value)]
+        return (await self.put_coalesced_many(index_name, items))[0]
+
+    async def put_coalesced_many(self, index_name: str, items: list):
+        """Same as `RedisJobQueue.put_coalesced_many`"""
+        return await self._run(self._put_coalesced_many_op(index_name, items))
+
+    async def put_delayed(self, delayed_name: str, due: float, value):
+        """Same as `RedisJobQueue.put_delayed`"""
+        await self._run(self._put_delayed_op(delayed_name, due, value))
+
+    async def promote_delayed(self, lanes: list):
+        """Same as `RedisJobQueue.promote_delayed`"""
+        return await self._run(self._promote_delayed_op(lanes))
+
+    async def record_events(self, stats_name: str, events: dict):
+        """Same as `RedisJobQueue.record_events`"""
+        await self._run(self._record_events_op(stats_name, events))
+
+    async def depth(self, queue_names: list) -> list:
+        """Same as `RedisJobQueue.depth`"""
+        return await self._run(self._depth_op(queue_names))
+
+    async def clear_pending(self, index_name: str, key: str, uid: str) -> bool:
+        """Same as `RedisJobQueue.clear_pending`"""
+        return await self._run(self._clear_pending_op(index_name, key, uid))
+
+    async def ack(self, queue_name: str, receipt):
+        """Same as `RedisJobQueue.ack`"""
+        await self._run(self._ack_op(queue_name, receipt))
+
+
+class AsyncRedisStreamJobQueue(BaseRedisStreamJobQueue, AsyncRedisJobQueue):
+    """Same as RedisStreamJobQueue, but all the methods are coroutines"""
+
+    async def create_group(self, queue_name: str):
+        """Same as `RedisStreamJobQueue.create_group`"""
+        await self._run(self._create_group_op(queue_name))
+
+    async def reclaim(self, queue_names):
+        """Same as `RedisStreamJobQueue.reclaim`"""
+        return await self._run(self._reclaim_op(queue_names))
+
+
+# Async backend of the same semantics as the sync one
+ASYNC_QUEUE_BACKENDS = {
+    RedisJobQueue: AsyncRedisJobQueue,
+    RedisStreamJobQueue: AsyncRedisStreamJobQueue,
+}
+
+
+class AsyncShardCoordinator(BaseShardCoordinator):
+    """Same as ShardCoordinator, but the methods talking to redis are coroutines"""
+
+    def __init__(
+        self,
+        registry_name: str,
+        shard_count: int,
+        worker_id: str = None,
+        lease_ttl: int = DEFAULT_SHARD_LEASE_TTL,
+        pinned_shards: list = None,
+        host: str = DEFAULT_REDIS_HOST,
+        port: int = DEFAULT_REDIS_PORT,
+    ):
+        """Takes the same arguments as ShardCoordinator"""
+        super().__init__(
+            registry_name, shard_count, worker_id, lease_ttl, pinned_shards
+        )
+        self._host = host
+        self._port = port
+        # Client and its scripts per event loop, the client is bound to the loop
+        self._clients = weakref.WeakKeyDictionary()
+
+    async def _run(self, operation):
+        loop = asyncio.get_running_loop()
+        if loop not in self._clients:
+            self._clients[loop] = (
+                redis.asyncio.Redis(
+                    connection_pool=get_async_connection_pool(self._host, self._port)
+                ),
+                {},
+            )
+        return await run_operation(operation, *self._clients[loop])
+
+    async def assigned_shards(self) -> list:
+        """Same as `ShardCoordinator.assigned_shards`"""
+        return await self._run(self._assigned_shards_op())
+
+    async def acquire_shards(self, busy_shards=()) -> list:
+        """Same as `ShardCoordinator.acquire_shards`"""
+        return await self._run(self._acquire_shards_op(busy_shards))
+
+    async def leave(self):
+        """Same as `ShardCoordinator.leave`"""
+        await self._run(self._leave_op())
+
+
+##################################################################
+
+
+class AsyncSyncJob(BaseSyncJob):
+    """
+    SyncJob with coroutines instead of the methods which talk to the queue.
+    Jobs are interchangeable with SyncJob: payloads and queues are the same.
+    """
+
+    SHARD_COORDINATOR = AsyncShardCoordinator
+
+    @classmethod
+    def job_queue(cls) -> AsyncRedisJobQueue:
+        return ASYNC_QUEUE_BACKENDS[cls.QUEUE_BACKEND]()
+
+    @classmethod
+    async def owned_shards(cls, busy_shards=()) -> list:
+        """Same as `SyncJob.owned_shards`"""
+        return await run_operation(cls._owned_shards_op(busy_shards))
+
+    @classmethod
+    async def leave_shards(cls):
+        """Must be called by worker on shutdown, see `SyncJob.leave_shards`"""
+        await run_operation(cls._leave_shards_op())
+
+    @classmethod
+    async def record_events(cls, job_queue: AsyncRedisJobQueue, events: dict):
+        """Same as `SyncJob.record_events`"""
+        await run_operation(cls._record_events_op(job_queue, events))
+
+    async def put_to_queue(self, coalesce: bool = False, delay: float = 0) -> str:
+        """Same as `SyncJob.put_to_queue`"""
+        return await run_operation(self._put_to_queue_op(coalesce, delay))
+
+    @classmethod
+    async def put_many(cls, jobs: list, coalesce: bool = False) -> list:
+        """Same as `SyncJob.put_many`"""
+        return await run_operation(cls._put_many_op(jobs, coalesce))
+
+    @classmethod
+    async def get_next_from_queue(cls, timeout: float = None, busy_shards=()):
+        """Same as `SyncJob.get_next_from_queue`.
+        Blocking read only suspends the coroutine, not the event loop"""
+        return await run_operation(cls._get_next_from_queue_op(timeout, busy_shards))
+
+    @classmethod
+    async def get_many_from_queue(
+        cls, max_jobs: int, window: float = 0, timeout: float = None, busy_shards=()
+    ) -> list:
+        """Same as `SyncJob.get_many_from_queue`"""
+        return await run_operation(
+            cls._get_many_from_queue_op(max_jobs, window, timeout, busy_shards)
+        )
+
+    async def ack(self):
+        """Same as `SyncJob.ack`"""
+        await run_operation(self._ack_op())
+
+    async def finish(self, status: JobStatus = JobStatus.SUCCESS):
+        """Same as `SyncJob.finish`"""
+        await run_operation(self._finish_op(status))
+
+    async def reschedule(self, force: bool = False):
+        """Same as `SyncJob.reschedule`"""
+        await run_operation(self._reschedule_op(force))
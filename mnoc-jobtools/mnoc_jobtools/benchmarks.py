@@ -0,0 +1,151 @@
+"""
+Micro-benchmarks for the job queue. Requires running redis server,
+which is configured with MNOC_REDIS_HOST/MNOC_REDIS_PORT environment variables.
+
+Usage:
+    python -m mnoc_jobtools.benchmarks --jobs 10000
+"""
+
+import argparse
+import logging
+import time
+from datetime import datetime
+
+import redis
+
+from mnoc_jobtools.tools import (
+    DEFAULT_REDIS_HOST,
+    DEFAULT_REDIS_PORT,
+    JOB_CODECS,
+    RedisJobQueue,
+    SyncJob,
+    decode_job_payload,
+)
+
+BENCHMARK_QUEUE_NAME = "queue:benchmark"
+
+##################################################################
+
+
+def measure(name: str, operations: int, func):
+    """Runs func and prints operations per second"""
+    started = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - started
+    print(f"{name:<40} {operations / elapsed:>12.0f} ops/s  ({elapsed:.3f}s)")
+
+
+def bench_client_per_operation(host: str, port: int, jobs: int):
+    """Baseline: new redis client (and connection) for every operation"""
+    payload = "x" * 200
+
+    def enqueue():
+        for _ in range(jobs):
+            redis.Redis(host=host, port=port).rpush(BENCHMARK_QUEUE_NAME, payload)
+
+    def dequeue():
+        for _ in range(jobs):
+            redis.Redis(host=host, port=port).blpop([BENCHMARK_QUEUE_NAME], 1)
+
+    measure("enqueue, client per operation", jobs, enqueue)
+    measure("dequeue, client per operation", jobs, dequeue)
+
+
+def bench_pooled(host: str, port: int, jobs: int):
+    """RedisJobQueue instances share the process-wide connection pool"""
+    payload = "x" * 200
+
+    def enqueue():
+        for _ in range(jobs):
+            RedisJobQueue(host, port).put(BENCHMARK_QUEUE_NAME, payload)
+
+    def dequeue():
+        for _ in range(jobs):
+            RedisJobQueue(host, port).get(BENCHMARK_QUEUE_NAME, 1)
+
+    measure("enqueue, pooled", jobs, enqueue)
+    measure("dequeue, pooled", jobs, dequeue)
+
+
+def bench_pipelined(host: str, port: int, jobs: int):
+    """All the values are pushed in one round trip"""
+    payload = "x" * 200
+
+    def enqueue():
+        with RedisJobQueue(host, port).pipeline(transaction=False) as pipe:
+            for _ in range(jobs):
+                pipe.rpush(BENCHMARK_QUEUE_NAME, payload)
+
+    measure("enqueue, pipelined", jobs, enqueue)
+    RedisJobQueue(host, port)._queue.delete(BENCHMARK_QUEUE_NAME)
+
+
+def bench_sync_job(jobs: int):
+    """End-to-end SyncJob submit/retrieve including serialization"""
+    SyncJob.QUEUE_NAME = BENCHMARK_QUEUE_NAME
+
+    def enqueue():
+        for device_id in range(jobs):
+            SyncJob(device_id, sync_from="db", sync_to="device").put_to_queue()
+
+    def dequeue():
+        for _ in range(jobs):
+            SyncJob.get_next_from_queue()
+
+    def enqueue_many():
+        SyncJob.put_many(
+            [
+                SyncJob(device_id, sync_from="db", sync_to="device")
+                for device_id in range(jobs)
+            ]
+        )
+
+    measure("SyncJob.put_to_queue", jobs, enqueue)
+    measure("SyncJob.get_next_from_queue", jobs, dequeue)
+    measure("SyncJob.put_many", jobs, enqueue_many)
+    RedisJobQueue()._queue.delete(BENCHMARK_QUEUE_NAME)
+
+
+def bench_codecs(jobs: int):
+    """Serialization cost and size of a job for every codec. Doesn't need redis"""
+    job = SyncJob(123, sync_from="db", sync_to="device", timestamp=datetime.now())
+    for name, codec in JOB_CODECS.items():
+        payload = codec.encode(job)
+
+        def encode():
+            for _ in range(jobs):
+                codec.encode(job)
+
+        def decode():
+            for _ in range(jobs):
+                decode_job_payload(payload)
+
+        measure(f"encode, {name} codec", jobs, encode)
+        measure(f"decode, {name} codec", jobs, decode)
+        print(f"{'bytes per job, ' + name + ' codec':<40} {len(payload):>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--jobs", type=int, default=10000)
+    parser.add_argument(
+        "--codecs-only", action="store_true", help="Skip benchmarks using redis"
+    )
+    args = parser.parse_args()
+    # Per-job logging would dominate the measurements
+    logging.getLogger().setLevel(logging.WARNING)
+
+    bench_codecs(args.jobs)
+    if args.codecs_only:
+        return
+    host, port = DEFAULT_REDIS_HOST, DEFAULT_REDIS_PORT
+
+    RedisJobQueue(host, port)._queue.delete(BENCHMARK_QUEUE_NAME)
+    bench_client_per_operation(host, port, args.jobs)
+    bench_pooled(host, port, args.jobs)
+    bench_pipelined(host, port, args.jobs)
+    bench_sync_job(args.jobs)
+
+
+if __name__ == "__main__":
+    main()
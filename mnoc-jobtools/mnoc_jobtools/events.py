@@ -0,0 +1,69 @@
+"""
+Change events shared between mnoc-mgmt and mnoc-sync over Redis pub/sub.
+
+mnoc-mgmt publishes the id of a Device every time it's changed or deleted,
+so mnoc-sync can drop the cached data of the device right away
+instead of waiting for the cache to expire.
+Pub/sub doesn't keep the events for subscribers which are not connected,
+so caches must expire anyway.
+"""
+
+import logging
+import threading
+import time
+
+import redis
+
+from mnoc_jobtools.tools import (
+    DEFAULT_REDIS_HOST,
+    DEFAULT_REDIS_PORT,
+    get_connection_pool,
+)
+
+DEVICE_EVENTS_CHANNEL = "events:device_changed"
+
+##################################################################
+
+
+def publish_device_changed(
+    device_id: int, host: str = DEFAULT_REDIS_HOST, port: int = DEFAULT_REDIS_PORT
+):
+    """Notifies subscribers that the device was changed or deleted.
+    Failures are logged, not raised, as the event is only an optimization"""
+    try:
+        redis.Redis(connection_pool=get_connection_pool(host, port)).publish(
+            DEVICE_EVENTS_CHANNEL, device_id
+        )
+    except redis.RedisError:
+        logging.exception(f"Failed to publish change of the device {device_id}")
+
+
+def subscribe_device_changed(
+    callback,
+    host: str = DEFAULT_REDIS_HOST,
+    port: int = DEFAULT_REDIS_PORT,
+    poll_interval: float = 1,
+) -> threading.Thread:
+    """
+    Calls `callback(device_id)` for every published device change
+    in a daemon thread. Call `stop()` of the returned thread to unsubscribe
+    """
+    pubsub = redis.Redis(connection_pool=get_connection_pool(host, port)).pubsub(
+        ignore_subscribe_messages=True
+    )
+
+    def handle(message):
+        try:
+            callback(int(message["data"]))
+        except Exception:
+            logging.exception(f"Failed to handle device change event {message}")
+
+    def reconnect_later(exception, pubsub, thread):
+        # Pubsub reconnects and resubscribes on the next read
+        logging.warning(f"Device change events are unavailable: {exception}")
+        time.sleep(poll_interval)
+
+    pubsub.subscribe(**{DEVICE_EVENTS_CHANNEL: handle})
+    return pubsub.run_in_thread(
+        sleep_time=poll_interval, daemon=True, exception_handler=reconnect_later
+    )
@@ -0,0 +1,164 @@
+"""
+Queue depth, lag and throughput metrics of the sync jobs.
+
+Depth and age of the oldest job are read from the queues themselves,
+rates and per-status counters come from the event counters,
+which SyncJob records with `SyncJob.record_events`.
+Collecting the metrics takes a few round trips regardless of the queue length,
+so it's cheap enough to be scraped frequently.
+"""
+
+import time
+from datetime import datetime, timezone
+
+from mnoc_jobtools.tools import (
+    STATS_BUCKET_INTERVAL,
+    JobPriority,
+    JobStatus,
+    SyncJob,
+    SyncJobCodecException,
+)
+
+RATE_EVENTS = ("enqueued", "dequeued", "merged")
+PROMETHEUS_PREFIX = "mnoc_sync_queue"
+
+##################################################################
+
+
+def _decode_counters(counters: dict) -> dict:
+    return {key.decode(): int(value) for key, value in counters.items()}
+
+
+def collect_queue_metrics(job_class=SyncJob) -> dict:
+    """
+    Returns:
+        {
+            "lanes": {lane_name: {"depth", "delayed", "oldest_job_age"}},
+            "depth": jobs waiting in all the lanes,
+            "delayed": jobs waiting for retry in all the lanes,
+            "oldest_job_age": seconds since submission of the oldest waiting job,
+            "totals": {event: count since the counters were created},
+            "rates": {event: events per second over the last bucket interval},
+            "statuses": {JobStatus name: count},
+        }
+        Age is None if there are no waiting jobs
+    """
+    job_queue = job_class.QUEUE_BACKEND()
+    lanes = [
+        (
+            job_class.lane_name(priority, shard),
+            job_class.delayed_set_name(priority, shard),
+        )
+        for priority in JobPriority
+        for shard in range(job_class.SHARD_COUNT)
+    ]
+    depths = job_queue.depth([lane_name for lane_name, _ in lanes])
+
+    now = time.time()
+    bucket = int(now // STATS_BUCKET_INTERVAL)
+    stats_name = job_class.stats_name()
+    with job_queue.pipeline(transaction=False) as pipe:
+        for _, delayed_name in lanes:
+            pipe.zcard(delayed_name)
+        pipe.hgetall(stats_name)
+        pipe.hgetall(f"{stats_name}:{bucket - 1}")
+        pipe.hgetall(f"{stats_name}:{bucket}")
+        *delayed, totals, previous_bucket, current_bucket = pipe.execute()
+
+    lane_metrics = {}
+    for (lane_name, _), depth, delayed_count in zip(lanes, depths, delayed):
+        oldest_job_age = None
+        # Jobs are appended to the tail, so the head is the oldest one.
+        # Retried jobs keep their original timestamp, so age includes retries
+        head = job_queue.list(lane_name, 0, 0) if depth else None
+        if head:
+            try:
+                timestamp = job_class.from_payload(head[0]).timestamp
+                # Naive timestamps are local time, as `datetime.now()` makes them
+                age = datetime.now(timezone.utc) - timestamp.astimezone(timezone.utc)
+                oldest_job_age = max(age.total_seconds(), 0)
+            except SyncJobCodecException:
+                pass
+        lane_metrics[lane_name] = {
+            "depth": depth,
+            "delayed": delayed_count,
+            "oldest_job_age": oldest_job_age,
+        }
+
+    # Current bucket is incomplete, so the rate is averaged
+    # over it and the whole previous bucket
+    totals = _decode_counters(totals)
+    previous_bucket = _decode_counters(previous_bucket)
+    current_bucket = _decode_counters(current_bucket)
+    rate_interval = STATS_BUCKET_INTERVAL + now % STATS_BUCKET_INTERVAL
+    ages = [
+        lane["oldest_job_age"]
+        for lane in lane_metrics.values()
+        if lane["oldest_job_age"] is not None
+    ]
+    return {
+        "lanes": lane_metrics,
+        "depth": sum(depths),
+        "delayed": sum(delayed),
+        "oldest_job_age": max(ages) if ages else None,
+        "totals": {event: totals.get(event, 0) for event in RATE_EVENTS},
+        "rates": {
+            event: (previous_bucket.get(event, 0) + current_bucket.get(event, 0))
+            / rate_interval
+            for event in RATE_EVENTS
+        },
+        "statuses": {
+            status.name: totals.get(f"status:{status.name}", 0)
+            for status in JobStatus
+            if status != JobStatus.TODO
+        },
+    }
+
+
+def render_prometheus(metrics: dict) -> str:
+    """Renders result of `collect_queue_metrics` in Prometheus text format.
+    Rates are left out: Prometheus derives them from the counters"""
+    lines = []
+
+    def metric(name: str, metric_type: str, help_text: str, samples: list):
+        name = f"{PROMETHEUS_PREFIX}_{name}"
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in samples:
+            if value is None:
+                continue
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}")
+
+    lanes = metrics["lanes"].items()
+    metric(
+        "depth",
+        "gauge",
+        "Jobs waiting in the queue lane",
+        [({"lane": lane}, values["depth"]) for lane, values in lanes],
+    )
+    metric(
+        "delayed",
+        "gauge",
+        "Jobs waiting for retry in the queue lane",
+        [({"lane": lane}, values["delayed"]) for lane, values in lanes],
+    )
+    metric(
+        "oldest_job_age_seconds",
+        "gauge",
+        "Seconds since submission of the oldest job waiting in the queue lane",
+        [({"lane": lane}, values["oldest_job_age"]) for lane, values in lanes],
+    )
+    metric(
+        "jobs_total",
+        "counter",
+        "Jobs by queue event",
+        [({"event": event}, count) for event, count in metrics["totals"].items()],
+    )
+    metric(
+        "job_outcomes_total",
+        "counter",
+        "Job deliveries by outcome",
+        [({"status": status}, count) for status, count in metrics["statuses"].items()],
+    )
+    return "\n".join(lines) + "\n"
@@ -1,10 +1,29 @@
+import asyncio
+import itertools
+import json
+import queue
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
 import pytest
+from mnoc_jobtools import tools
+from mnoc_jobtools.aio import AsyncRedisJobQueue, AsyncSyncJob
+from mnoc_jobtools.events import publish_device_changed, subscribe_device_changed
+from mnoc_jobtools.metrics import collect_queue_metrics, render_prometheus
 from mnoc_jobtools.tools import (
+    get_connection_pool,
+    BaseSyncJob,
     RedisJobQueue,
+    RedisStreamJobQueue,
+    ShardCoordinator,
     SyncJob,
+    SyncJobCodecException,
     SyncJobSameTargetsException,
     SyncJobUnknownTargetException,
     JobStatus,
+    JobPriority,
+    JOB_CODECS,
 )
 from pytest import fixture
 
@@ -29,14 +48,124 @@ class TestRedisJobQueue:
         assert queue.list(TEST_QUEUE_NAME) == [b"test-value"]
         queue._queue.delete(TEST_QUEUE_NAME)
 
+    def test_shared_connection_pool(self):
+        assert (
+            RedisJobQueue()._queue.connection_pool
+            is RedisJobQueue()._queue.connection_pool
+            is get_connection_pool()
+        )
+
+    def test_pipeline(self):
+        queue = RedisJobQueue()
+        queue._queue.delete(TEST_QUEUE_NAME)
+        with queue.pipeline() as pipe:
+            pipe.rpush(TEST_QUEUE_NAME, "test-value-1")
+            pipe.rpush(TEST_QUEUE_NAME, "test-value-2")
+        assert queue.list(TEST_QUEUE_NAME) == [b"test-value-1", b"test-value-2"]
+        queue._queue.delete(TEST_QUEUE_NAME)
+
+    def test_depth(self):
+        queue = RedisJobQueue()
+        queue._queue.delete(TEST_QUEUE_NAME)
+        queue.put_many(TEST_QUEUE_NAME, ["test-value-1", "test-value-2"])
+        assert queue.depth([TEST_QUEUE_NAME, TEST_QUEUE_NAME + ":empty"]) == [2, 0]
+        queue._queue.delete(TEST_QUEUE_NAME)
+
+
+class TestRedisStreamJobQueue:
+    def test_put_get_ack(self):
+        queue = RedisStreamJobQueue(consumer="test-consumer")
+        queue._queue.delete(TEST_QUEUE_NAME)
+        queue.put(TEST_QUEUE_NAME, "test-value")
+        _, value, entry_id = queue.get(TEST_QUEUE_NAME)
+        assert value.decode() == "test-value"
+        queue.ack(TEST_QUEUE_NAME, entry_id)
+        assert queue._queue.xpending(TEST_QUEUE_NAME, queue.group)["pending"] == 0
+        queue._queue.delete(TEST_QUEUE_NAME)
+
+    def test_put_list(self):
+        queue = RedisStreamJobQueue(consumer="test-consumer")
+        queue._queue.delete(TEST_QUEUE_NAME)
+        queue.put(TEST_QUEUE_NAME, "test-value-1", "test-value-2")
+        assert queue.list(TEST_QUEUE_NAME) == [b"test-value-1", b"test-value-2"]
+        queue.get(TEST_QUEUE_NAME)
+        assert queue.list(TEST_QUEUE_NAME) == [b"test-value-2"]
+        queue._queue.delete(TEST_QUEUE_NAME)
+
+    def test_depth(self):
+        queue = RedisStreamJobQueue(consumer="test-consumer")
+        queue._queue.delete(TEST_QUEUE_NAME)
+        queue.put(TEST_QUEUE_NAME, "test-value-1", "test-value-2")
+        queue.get(TEST_QUEUE_NAME)
+        assert queue.depth([TEST_QUEUE_NAME, TEST_QUEUE_NAME + ":empty"]) == [1, 0]
+        queue._queue.delete(TEST_QUEUE_NAME)
+
+    def test_reclaim_from_dead_consumer(self):
+        dead_queue = RedisStreamJobQueue(consumer="dead-consumer")
+        dead_queue._queue.delete(TEST_QUEUE_NAME)
+        dead_queue.put(TEST_QUEUE_NAME, "test-value")
+        _, _, entry_id = dead_queue.get(TEST_QUEUE_NAME)
+
+        queue = RedisStreamJobQueue(consumer="test-consumer", reclaim_idle=0)
+        assert queue.get(TEST_QUEUE_NAME) == (TEST_QUEUE_NAME, b"test-value", entry_id)
+        queue._queue.delete(TEST_QUEUE_NAME)
+
+
+class TestDeviceEvents:
+    def test_publish_subscribe(self):
+        changed = queue.Queue()
+        thread = subscribe_device_changed(changed.put, poll_interval=0.01)
+        try:
+            publish_device_changed(42)
+            assert changed.get(timeout=2) == 42
+        finally:
+            thread.stop()
+
+
+@fixture
+def shard_coordinators():
+    coordinators = [
+        ShardCoordinator(TEST_QUEUE_NAME + ":workers", 4, worker_id=worker_id)
+        for worker_id in ("worker-1", "worker-2")
+    ]
+    yield coordinators
+    for coordinator in coordinators:
+        coordinator.leave()
+
+
+class TestShardCoordinator:
+    def test_single_worker_owns_all(self, shard_coordinators):
+        assert shard_coordinators[0].acquire_shards() == [0, 1, 2, 3]
+
+    def test_rebalance_on_join(self, shard_coordinators):
+        first, second = shard_coordinators
+        assert first.acquire_shards() == [0, 1, 2, 3]
+        # First worker still holds the leases, until it asks for shards again
+        assert second.acquire_shards() == []
+        assert first.acquire_shards() == [0, 2]
+        assert second.acquire_shards() == [1, 3]
+
+    def test_rebalance_on_leave(self, shard_coordinators):
+        first, second = shard_coordinators
+        first.acquire_shards()
+        second.acquire_shards()
+        first.acquire_shards()
+        first.leave()
+        assert second.acquire_shards() == [0, 1, 2, 3]
+
 
 @fixture(params=[["db", "device"], ["device", "db"]])
 def sync_job(request):
     queue = RedisJobQueue()
-    queue._queue.delete(TEST_QUEUE_NAME)
-    SyncJob.QUEUE_NAME = TEST_QUEUE_NAME
+    BaseSyncJob.QUEUE_NAME = TEST_QUEUE_NAME
+    BaseSyncJob.RETRY_BACKOFF_BASE = 0.1
+    test_keys = [SyncJob.pending_index_name(), SyncJob.stats_name()]
+    for priority in JobPriority:
+        test_keys += [SyncJob.lane_name(priority), SyncJob.delayed_set_name(priority)]
+        test_keys.append(queue._signal_name(SyncJob.lane_name(priority)))
+    queue._queue.delete(*test_keys)
     yield SyncJob(device_id=1, sync_from=request.param[0], sync_to=request.param[1])
-    queue._queue.delete(TEST_QUEUE_NAME)
+    queue._queue.delete(*test_keys)
 
 
 class TestSyncJob:
@@ -64,6 +193,49 @@ class TestSyncJob:
         job_from_queue = sync_job.get_next_from_queue()
         assert sync_job.__dict__ == job_from_queue.__dict__
 
+    @pytest.mark.parametrize("codec", JOB_CODECS.keys())
+    def test_codec_ser_des(self, sync_job, codec):
+        sync_job.CODEC = JOB_CODECS[codec]
+        sync_job.put_to_queue()
+        job_from_queue = SyncJob.get_next_from_queue()
+        assert job_from_queue.to_dict() == sync_job.to_dict()
+
+    @pytest.mark.parametrize("codec", JOB_CODECS.keys())
+    @pytest.mark.parametrize(
+        "tzinfo", [timezone.utc, timezone(timedelta(hours=-5, minutes=-30))]
+    )
+    def test_codec_aware_timestamp(self, sync_job, codec, tzinfo):
+        sync_job.timestamp = datetime.now(tzinfo)
+        job = SyncJob(**JOB_CODECS[codec].decode(JOB_CODECS[codec].encode(sync_job)))
+        assert job.timestamp == sync_job.timestamp
+        assert job.timestamp.utcoffset() == sync_job.timestamp.utcoffset()
+
+    def test_binary_codec_version_1(self, sync_job):
+        sync_job.timestamp = datetime.now()
+        payload = JOB_CODECS["binary"].encode(sync_job)
+        # Version 1 had no UTC offset after the timestamp
+        legacy_payload = bytes([1]) + payload[1:15] + payload[17:]
+        assert SyncJob.from_payload(legacy_payload).to_dict() == sync_job.to_dict()
+
+    def test_binary_codec_is_compact(self, sync_job):
+        sync_job.put_to_queue()
+        assert len(JOB_CODECS["binary"].encode(sync_job)) < 40
+        assert len(JOB_CODECS["json"].encode(sync_job)) > 200
+
+    def test_legacy_json_payload(self, sync_job):
+        sync_job.timestamp = datetime.now()
+        legacy_payload = sync_job.to_dict()
+        del legacy_payload["priority"]
+        RedisJobQueue().put(TEST_QUEUE_NAME, json.dumps(legacy_payload))
+        job_from_queue = SyncJob.get_next_from_queue()
+        assert job_from_queue.uid == sync_job.uid
+        assert job_from_queue.timestamp == sync_job.timestamp
+        assert job_from_queue.priority == JobPriority.NORMAL
+
+    @pytest.mark.xfail(raises=SyncJobCodecException)
+    def test_unknown_payload(self):
+        SyncJob.from_payload(b"\xffunknown")
+
     def test_reschedule(self, sync_job):
         sync_job.reschedule()
         SyncJob.QUEUE_NAME = TEST_QUEUE_NAME
@@ -73,9 +245,381 @@ class TestSyncJob:
         assert sync_job.status == JobStatus.REDO
         assert job_from_queue.status == JobStatus.REDO
 
+    def test_reschedule_delayed(self, sync_job):
+        sync_job.reschedule()
+        assert RedisJobQueue().list(TEST_QUEUE_NAME) == []
+        assert RedisJobQueue()._queue.zcard(SyncJob.delayed_set_name()) == 1
+        assert SyncJob.get_next_from_queue().uid == sync_job.uid
+        assert RedisJobQueue()._queue.zcard(SyncJob.delayed_set_name()) == 0
+
+    def test_promotion_rate_limited(self, sync_job, monkeypatch):
+        promotions = []
+        promote_delayed = RedisJobQueue.promote_delayed
+
+        def counting_promote_delayed(queue, lanes):
+            promotions.append(lanes)
+            return promote_delayed(queue, lanes)
+
+        monkeypatch.setattr(RedisJobQueue, "promote_delayed", counting_promote_delayed)
+        monkeypatch.setattr(SyncJob, "_next_promotion", 0.0)
+        assert SyncJob.get_next_from_queue(timeout=0.05) is None
+        assert SyncJob.get_next_from_queue(timeout=0.05) is None
+        assert len(promotions) == 1
+        # Retry of a job brings the next promotion forward
+        sync_job.put_to_queue(delay=0.1)
+        assert SyncJob.get_next_from_queue(timeout=1).uid == sync_job.uid
+        assert len(promotions) == 2
+
+    def test_retry_delay_backoff(self, sync_job):
+        delays = []
+        for attempts_done in range(3):
+            sync_job.attempts_done = attempts_done
+            delays.append(sync_job.retry_delay())
+            max_delay = SyncJob.RETRY_BACKOFF_BASE * 2 ** attempts_done
+            assert max_delay / 2 <= delays[-1] <= max_delay
+        sync_job.attempts_done = 100
+        assert sync_job.retry_delay() <= SyncJob.RETRY_BACKOFF_MAX
+
+    def test_priority_lanes(self, sync_job):
+        jobs = {
+            priority: SyncJob(
+                1, sync_job.sync_from, sync_job.sync_to, priority=priority
+            )
+            for priority in JobPriority
+        }
+        for priority in reversed(JobPriority):
+            jobs[priority].put_to_queue(coalesce=True)
+        assert len(RedisJobQueue().list(SyncJob.lane_name(JobPriority.HIGH))) == 1
+        SyncJob._retrievals_counter = itertools.count(1)
+        for priority in JobPriority:
+            job_from_queue = SyncJob.get_next_from_queue()
+            assert job_from_queue.uid == jobs[priority].uid
+            assert job_from_queue.priority == priority
+
+    def test_starvation_guard(self, sync_job):
+        high_jobs = [
+            SyncJob(1, sync_job.sync_from, sync_job.sync_to, priority=JobPriority.HIGH)
+            for _ in range(SyncJob.STARVATION_GUARD)
+        ]
+        low_job = SyncJob(
+            1, sync_job.sync_from, sync_job.sync_to, priority=JobPriority.LOW
+        )
+        SyncJob.put_many(high_jobs + [low_job])
+        SyncJob._retrievals_counter = itertools.count(SyncJob.STARVATION_GUARD)
+        assert SyncJob.get_next_from_queue().uid == low_job.uid
+
     def test_reschedule_failure(self, sync_job):
         sync_job.attempts_done = 2
         sync_job.reschedule()
         assert sync_job.status == JobStatus.FAILURE
         # Check that the queue is empty:
         assert RedisJobQueue().list(TEST_QUEUE_NAME) == []
+
+    def test_put_coalesced(self, sync_job):
+        uid = sync_job.put_to_queue(coalesce=True)
+        duplicate_job = SyncJob(
+            1, sync_from=sync_job.sync_from, sync_to=sync_job.sync_to
+        )
+        assert duplicate_job.put_to_queue(coalesce=True) == uid
+        assert duplicate_job.uid == uid
+        assert len(RedisJobQueue().list(TEST_QUEUE_NAME)) == 1
+
+    def test_put_coalesced_other_device(self, sync_job):
+        sync_job.put_to_queue(coalesce=True)
+        other_job = SyncJob(2, sync_from=sync_job.sync_from, sync_to=sync_job.sync_to)
+        assert other_job.put_to_queue(coalesce=True) == other_job.uid
+        assert len(RedisJobQueue().list(TEST_QUEUE_NAME)) == 2
+
+    def test_get_clears_pending(self, sync_job):
+        uid = sync_job.put_to_queue(coalesce=True)
+        assert SyncJob.get_next_from_queue().uid == uid
+        new_job = SyncJob(1, sync_from=sync_job.sync_from, sync_to=sync_job.sync_to)
+        assert new_job.put_to_queue(coalesce=True) == new_job.uid != uid
+
+    def test_get_pops_and_clears_pending_at_once(self, sync_job):
+        sync_job.put_to_queue(coalesce=True)
+        queue = RedisJobQueue()
+        # Worker dies right after the pop, before doing anything else
+        queue.get(SyncJob.lanes_in_serving_order(), 1, SyncJob.pending_index_name())
+        assert queue._queue.hgetall(SyncJob.pending_index_name()) == {}
+        new_job = SyncJob(1, sync_from=sync_job.sync_from, sync_to=sync_job.sync_to)
+        assert new_job.put_to_queue(coalesce=True) == new_job.uid
+
+    def test_get_wakes_up_on_put(self, sync_job):
+        results = queue.Queue()
+        consumer = threading.Thread(
+            target=lambda: results.put(SyncJob.get_next_from_queue(timeout=5))
+        )
+        consumer.start()
+        time.sleep(0.2)
+        started = time.monotonic()
+        sync_job.put_to_queue(coalesce=True)
+        consumer.join()
+        assert results.get().uid == sync_job.uid
+        assert time.monotonic() - started < tools.SIGNAL_POLL_INTERVAL
+
+    def test_put_coalesced_lost_job(self, sync_job):
+        sync_job.put_to_queue(coalesce=True)
+        RedisJobQueue()._queue.delete(TEST_QUEUE_NAME)
+        new_job = SyncJob(1, sync_from=sync_job.sync_from, sync_to=sync_job.sync_to)
+        assert new_job.put_to_queue(coalesce=True) == new_job.uid
+        assert len(RedisJobQueue().list(TEST_QUEUE_NAME)) == 1
+
+    def test_put_coalesced_stale_marker(self, sync_job, monkeypatch):
+        monkeypatch.setattr(tools, "PENDING_MARKER_TTL", 0)
+        sync_job.put_to_queue(coalesce=True)
+        new_job = SyncJob(1, sync_from=sync_job.sync_from, sync_to=sync_job.sync_to)
+        assert new_job.put_to_queue(coalesce=True) == new_job.uid
+        assert len(RedisJobQueue().list(TEST_QUEUE_NAME)) == 2
+
+    def test_put_many(self, sync_job):
+        jobs = [
+            SyncJob(device_id, sync_from=sync_job.sync_from, sync_to=sync_job.sync_to)
+            for device_id in range(3)
+        ]
+        assert SyncJob.put_many(jobs) == [job.uid for job in jobs]
+        assert [SyncJob.get_next_from_queue().uid for _ in jobs] == [
+            job.uid for job in jobs
+        ]
+
+    def test_put_many_coalesced(self, sync_job):
+        uid = sync_job.put_to_queue(coalesce=True)
+        jobs = [
+            SyncJob(device_id, sync_from=sync_job.sync_from, sync_to=sync_job.sync_to)
+            for device_id in (1, 2, 2)
+        ]
+        uids = SyncJob.put_many(jobs, coalesce=True)
+        assert uids == [uid, jobs[1].uid, jobs[1].uid]
+        assert len(RedisJobQueue().list(TEST_QUEUE_NAME)) == 2
+
+    def test_stream_put_coalesced_delivered_job(self, sync_job):
+        BaseSyncJob.QUEUE_BACKEND = RedisStreamJobQueue
+        try:
+            sync_job.put_to_queue(coalesce=True)
+            # Worker dies after the read, before clearing the pending marker:
+            # the stream still has the entry, but it was delivered
+            SyncJob.job_queue().get(TEST_QUEUE_NAME)
+            new_job = SyncJob(1, sync_from=sync_job.sync_from, sync_to=sync_job.sync_to)
+            assert new_job.put_to_queue(coalesce=True) == new_job.uid
+            another_job = SyncJob(
+                1, sync_from=sync_job.sync_from, sync_to=sync_job.sync_to
+            )
+            assert another_job.put_to_queue(coalesce=True) == new_job.uid
+        finally:
+            BaseSyncJob.QUEUE_BACKEND = RedisJobQueue
+            RedisJobQueue()._queue.delete(TEST_QUEUE_NAME)
+
+    def test_stream_backend_ack(self, sync_job):
+        BaseSyncJob.QUEUE_BACKEND = RedisStreamJobQueue
+        try:
+            sync_job.put_to_queue(coalesce=True)
+            job_from_queue = SyncJob.get_next_from_queue()
+            assert job_from_queue.uid == sync_job.uid
+            assert job_from_queue.receipt[0] == TEST_QUEUE_NAME
+            job_from_queue.ack()
+            assert job_from_queue.receipt is None
+        finally:
+            BaseSyncJob.QUEUE_BACKEND = RedisJobQueue
+
+    def test_sharded_lanes(self, sync_job):
+        BaseSyncJob.SHARD_COUNT = 4
+        try:
+            jobs = [
+                SyncJob(device_id, sync_job.sync_from, sync_job.sync_to)
+                for device_id in range(8)
+            ]
+            SyncJob.put_many(jobs)
+            for job in jobs:
+                assert job.to_payload() in RedisJobQueue().list(
+                    SyncJob.lane_name(job.priority, job.shard)
+                )
+            retrieved = {SyncJob.get_next_from_queue().uid for _ in jobs}
+            assert retrieved == {job.uid for job in jobs}
+        finally:
+            SyncJob.leave_shards()
+            RedisJobQueue()._queue.delete(*SyncJob.all_lane_names())
+            BaseSyncJob.SHARD_COUNT = 1
+
+    def test_get_next_timeout(self, sync_job):
+        assert SyncJob.get_next_from_queue(timeout=0.1) is None
+        sync_job.put_to_queue()
+        assert SyncJob.get_next_from_queue(timeout=0.1).uid == sync_job.uid
+
+    def test_get_many_merged(self, sync_job):
+        jobs = [
+            SyncJob(device_id, sync_job.sync_from, sync_job.sync_to)
+            for device_id in (1, 2, 1, 1, 3)
+        ]
+        SyncJob.put_many(jobs)
+        retrieved = SyncJob.get_many_from_queue(max_jobs=4, timeout=0.1)
+        assert [job.uid for job in retrieved] == [job.uid for job in jobs[:4]]
+        merged = SyncJob.merge_jobs(retrieved)
+        assert [job.uid for job in merged] == [jobs[0].uid, jobs[1].uid]
+        assert [job.uid for job in merged[0].merged_jobs] == [
+            jobs[2].uid,
+            jobs[3].uid,
+        ]
+        merged[0].finish(JobStatus.FAILURE)
+        assert merged[0].merged_jobs[1].status == JobStatus.FAILURE
+        assert SyncJob.get_many_from_queue(max_jobs=4, timeout=0.1)[0].device_id == 3
+        assert SyncJob.get_many_from_queue(max_jobs=4, timeout=0.1) == []
+
+    def test_get_many_keeps_shards_of_retrieved_jobs(self, sync_job, monkeypatch):
+        busy_shards_seen = []
+        owned_shards_op = BaseSyncJob._owned_shards_op.__func__
+
+        def recording_owned_shards_op(cls, busy_shards):
+            busy_shards_seen.append(set(busy_shards))
+            return (yield from owned_shards_op(cls, busy_shards))
+
+        monkeypatch.setattr(
+            BaseSyncJob, "_owned_shards_op", classmethod(recording_owned_shards_op)
+        )
+        jobs = [
+            SyncJob(device_id, sync_job.sync_from, sync_job.sync_to)
+            for device_id in (1, 2)
+        ]
+        SyncJob.put_many(jobs)
+        retrieved = SyncJob.get_many_from_queue(max_jobs=2, busy_shards={5})
+        assert [job.uid for job in retrieved] == [job.uid for job in jobs]
+        assert busy_shards_seen == [{5}, {5, jobs[0].shard}]
+
+    def test_merge_jobs_keeps_direction_order(self):
+        jobs = [
+            SyncJob(1, "db", "device"),
+            SyncJob(1, "device", "db"),
+            SyncJob(2, "db", "device"),
+            SyncJob(1, "device", "db"),
+            SyncJob(1, "db", "device"),
+        ]
+        merged = SyncJob.merge_jobs(jobs)
+        assert merged == [jobs[0], jobs[1], jobs[2], jobs[4]]
+        assert merged[1].merged_jobs == [jobs[3]]
+
+    def test_queue_metrics(self, sync_job):
+        sync_job.put_to_queue()
+        SyncJob(2, sync_job.sync_from, sync_job.sync_to).put_to_queue(coalesce=True)
+        SyncJob(2, sync_job.sync_from, sync_job.sync_to).put_to_queue(coalesce=True)
+        job_from_queue = SyncJob.get_next_from_queue()
+        job_from_queue.reschedule()
+        job_from_queue.finish(JobStatus.SUCCESS)  # Already rescheduled
+
+        metrics = collect_queue_metrics()
+        assert metrics["depth"] == 1
+        assert metrics["delayed"] == 1
+        assert metrics["lanes"][TEST_QUEUE_NAME]["oldest_job_age"] >= 0
+        assert metrics["totals"] == {"enqueued": 3, "dequeued": 1, "merged": 1}
+        assert metrics["rates"]["enqueued"] > 0
+        assert metrics["statuses"] == {"REDO": 1, "SUCCESS": 0, "FAILURE": 0}
+
+    @pytest.mark.parametrize(
+        "tzinfo", [None, timezone.utc, timezone(timedelta(hours=-5, minutes=-30))]
+    )
+    def test_queue_metrics_aware_timestamp(self, sync_job, tzinfo):
+        sync_job.timestamp = datetime.now(tzinfo) - timedelta(minutes=10)
+        sync_job.put_to_queue()
+        age = collect_queue_metrics()["lanes"][TEST_QUEUE_NAME]["oldest_job_age"]
+        assert 600 <= age < 660
+
+    def test_queue_metrics_empty(self, sync_job):
+        metrics = collect_queue_metrics()
+        assert metrics["depth"] == 0
+        assert metrics["oldest_job_age"] is None
+
+    def test_render_prometheus(self, sync_job):
+        sync_job.put_to_queue()
+        text = render_prometheus(collect_queue_metrics())
+        assert f'mnoc_sync_queue_depth{{lane="{TEST_QUEUE_NAME}"}} 1' in text
+        assert 'mnoc_sync_queue_jobs_total{event="enqueued"} 1' in text
+        assert "# TYPE mnoc_sync_queue_job_outcomes_total counter" in text
+
+
+class TestAsyncSyncJob:
+    def test_async_queue_put_get(self):
+        async def put_get():
+            queue = AsyncRedisJobQueue()
+            await queue._queue.delete(TEST_QUEUE_NAME)
+            await queue.put(TEST_QUEUE_NAME, "test-value")
+            return await queue.get(TEST_QUEUE_NAME)
+
+        assert asyncio.run(put_get())[1].decode() == "test-value"
+
+    def test_put_async_get_sync(self, sync_job):
+        job = AsyncSyncJob(2, sync_job.sync_from, sync_job.sync_to)
+        asyncio.run(job.put_to_queue())
+        job_from_queue = SyncJob.get_next_from_queue()
+        assert job_from_queue.to_dict() == job.to_dict()
+
+    def test_put_sync_get_async(self, sync_job):
+        sync_job.put_to_queue()
+        job_from_queue = asyncio.run(AsyncSyncJob.get_next_from_queue())
+        assert isinstance(job_from_queue, AsyncSyncJob)
+        assert job_from_queue.to_dict() == sync_job.to_dict()
+
+    def test_put_coalesced(self, sync_job):
+        async def put_twice():
+            first = AsyncSyncJob(2, sync_job.sync_from, sync_job.sync_to)
+            second = AsyncSyncJob(2, sync_job.sync_from, sync_job.sync_to)
+            return await first.put_to_queue(True), await second.put_to_queue(True)
+
+        first_uid, second_uid = asyncio.run(put_twice())
+        assert first_uid == second_uid
+        assert len(RedisJobQueue().list(TEST_QUEUE_NAME)) == 1
+
+    def test_put_many_coalesced(self, sync_job):
+        jobs = [AsyncSyncJob(2, sync_job.sync_from, sync_job.sync_to) for _ in range(3)]
+        uids = asyncio.run(AsyncSyncJob.put_many(jobs, coalesce=True))
+        assert len(set(uids)) == 1
+        assert len(RedisJobQueue().list(TEST_QUEUE_NAME)) == 1
+
+    def test_reschedule_delayed(self, sync_job):
+        async def reschedule_and_get():
+            job = AsyncSyncJob(2, sync_job.sync_from, sync_job.sync_to)
+            await job.reschedule()
+            return job, await AsyncSyncJob.get_next_from_queue()
+
+        job, job_from_queue = asyncio.run(reschedule_and_get())
+        assert job_from_queue.uid == job.uid
+        assert job_from_queue.status == JobStatus.REDO
+
+    def test_stream_backend_ack(self, sync_job):
+        BaseSyncJob.QUEUE_BACKEND = RedisStreamJobQueue
+
+        async def put_get_ack():
+            job = AsyncSyncJob(2, sync_job.sync_from, sync_job.sync_to)
+            await job.put_to_queue(coalesce=True)
+            job_from_queue = await AsyncSyncJob.get_next_from_queue()
+            assert job_from_queue.uid == job.uid
+            assert job_from_queue.receipt[0] == TEST_QUEUE_NAME
+            await job_from_queue.ack()
+            assert job_from_queue.receipt is None
+
+        try:
+            asyncio.run(put_get_ack())
+            assert (
+                RedisJobQueue()._queue.xpending(TEST_QUEUE_NAME, "mnoc-sync")["pending"]
+                == 0
+            )
+        finally:
+            RedisJobQueue()._queue.delete(TEST_QUEUE_NAME)
+            BaseSyncJob.QUEUE_BACKEND = RedisJobQueue
+
+    def test_sharded_lanes(self, sync_job):
+        BaseSyncJob.SHARD_COUNT = 4
+
+        async def put_get_all():
+            jobs = [
+                AsyncSyncJob(device_id, sync_job.sync_from, sync_job.sync_to)
+                for device_id in range(8)
+            ]
+            await AsyncSyncJob.put_many(jobs)
+            retrieved = [await AsyncSyncJob.get_next_from_queue() for _ in jobs]
+            await AsyncSyncJob.leave_shards()
+            return jobs, retrieved
+
+        try:
+            jobs, retrieved = asyncio.run(put_get_all())
+            assert {job.uid for job in retrieved} == {job.uid for job in jobs}
+        finally:
+            RedisJobQueue()._queue.delete(*SyncJob.all_lane_names())
+            BaseSyncJob.SHARD_COUNT = 1
@@ -1,8 +1,16 @@
+import itertools
 import json
 import logging
+import os
 import random
+import socket
 import string
-from datetime import datetime
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from enum import Enum
 
 import redis
@@ -11,10 +19,32 @@ logging.basicConfig(
     level=logging.DEBUG, format="%(asctime)s %(levelname)-8s %(message)s"
 )
 
+BULK_PUT_CHUNK_SIZE = 1000  # Max number of values pushed by a single RPUSH
 QUEUE_NAME_PREFIX = "queue:"  # Used as prefix for Redis list name
+PENDING_INDEX_SUFFIX = ":pending"  # Used as suffix for Redis hash of pending jobs
+PENDING_MARKER_TTL = 3600  # Seconds before pending job marker is considered stale
+DELAYED_SET_SUFFIX = ":delayed"  # Used as suffix for Redis sorted set of delayed jobs
+DELAYED_PROMOTE_BATCH = 100  # Max number of due jobs moved to queue at once
+DELAYED_POLL_INTERVAL = 5  # Max seconds to block while there are delayed jobs
+SIGNAL_SUFFIX = ":signal"  # Used as suffix for Redis list which wakes up consumers
+SIGNAL_POLL_INTERVAL = 5  # Max seconds to wait for a signal before popping again
+WORKERS_REGISTRY_SUFFIX = ":workers"  # Used as suffix for Redis set of workers
+STATS_SUFFIX = ":stats"  # Used as suffix for Redis hashes of job event counters
+STATS_BUCKET_INTERVAL = 60  # Seconds covered by a single bucket of event counters
 AVAILABLE_SYNCJOB_TARGETS = ["device", "db"]
-DEFAULT_REDIS_PORT = 6379
-DEFAULT_REDIS_HOST = "redis"  # TODO: change to redis
+DEFAULT_REDIS_PORT = int(os.getenv("MNOC_REDIS_PORT", 6379))
+DEFAULT_REDIS_HOST = os.getenv("MNOC_REDIS_HOST", "redis")
+DEFAULT_REDIS_MAX_CONNECTIONS = int(os.getenv("MNOC_REDIS_MAX_CONNECTIONS", 16))
+DEFAULT_QUEUE_BACKEND = os.getenv("MNOC_QUEUE_BACKEND", "list")
+DEFAULT_JOB_CODEC = os.getenv("MNOC_JOB_CODEC", "json")
+DEFAULT_STREAM_GROUP = os.getenv("MNOC_STREAM_GROUP", "mnoc-sync")
+DEFAULT_STREAM_MAXLEN = 100000  # Approximate number of entries kept in the stream
+DEFAULT_STREAM_RECLAIM_IDLE = 300000  # ms before job of a dead consumer is reclaimed
+DEFAULT_STREAM_MAX_DELIVERIES = 5  # Deliveries before reclaimed job is dropped
+DEFAULT_SHARD_COUNT = int(os.getenv("MNOC_QUEUE_SHARDS", 1))
+DEFAULT_SHARD_LEASE_TTL = int(os.getenv("MNOC_QUEUE_SHARD_LEASE_TTL", 60))  # seconds
+# Comma separated shards for the worker to own, disables automatic rebalancing
+DEFAULT_PINNED_SHARDS = os.getenv("MNOC_QUEUE_SHARDS_OWNED")
 
 ##################################################################
 
@@ -37,21 +67,912 @@ class SyncJobSameTargetsException(SyncJobException):
     pass
 
 
+class SyncJobCodecException(SyncJobException):
+    """Payload can't be decoded into a job"""
+
+    pass
+
+
 ##################################################################
 
 
-class RedisJobQueue:
-    def __init__(self, host: str = DEFAULT_REDIS_HOST, port: int = DEFAULT_REDIS_PORT):
-        self._queue = redis.Redis(host=host, port=port)
+class Commands:
+    """
+    Redis commands, which an operation sends to the server in one round trip.
+    Commands are recorded by calling the methods of the redis client
+    with the same arguments, and Lua scripts by `script`:
+
+        [length] = yield Commands().rpush(queue_name, value)
+
+    A single command is sent as is, several ones - in a pipeline,
+    which is wrapped into MULTI/EXEC with transaction=True.
+    With raise_on_error=False the error of a command is returned
+    as its result instead of being raised.
+    """
+
+    def __init__(self, transaction: bool = False, raise_on_error: bool = True):
+        self.transaction = transaction
+        self.raise_on_error = raise_on_error
+        self.calls = []
+
+    def __getattr__(self, command: str):
+        if command.startswith("_"):
+            raise AttributeError(command)
+
+        def record(*args, **kwargs):
+            self.calls.append((command, args, kwargs))
+            return self
+
+        return record
+
+    def __len__(self):
+        return len(self.calls)
+
+    def script(self, source: str, keys: list, args: list):
+        """Records a call of the Lua script, which is sent by its sha"""
+        self.calls.append(("script", (source, keys, args), {}))
+        return self
+
+    def register_scripts(self, client, scripts: dict):
+        """Registers the scripts on the client, `scripts` caches them by source"""
+        for command, args, _ in self.calls:
+            if command == "script" and args[0] not in scripts:
+                scripts[args[0]] = client.register_script(args[0])
+
+    def call(self, client, scripts: dict):
+        """Sends the only command by the client. Returns its result,
+        or a coroutine of the result for the asyncio client"""
+        [(command, args, kwargs)] = self.calls
+        if command == "script":
+            source, keys, script_args = args
+            return scripts[source](keys=keys, args=script_args)
+        return getattr(client, command)(*args, **kwargs)
+
+    def buffer(self, pipe, scripts: dict):
+        """Buffers all the commands in the pipeline"""
+        for command, args, kwargs in self.calls:
+            if command == "script":
+                source, keys, script_args = args
+                pipe.scripts.add(scripts[source])
+                pipe.evalsha(scripts[source].sha, len(keys), *keys, *script_args)
+            else:
+                getattr(pipe, command)(*args, **kwargs)
+
+
+class Sleep:
+    """Effect of an operation: wait for `seconds`"""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+
+
+class Call:
+    """Effect of an operation: call of a function, which may do I/O.
+    The result is awaited by the asyncio runner if it's awaitable"""
+
+    def __init__(self, function, *args, **kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+
+def execute_commands(commands: Commands, client: redis.Redis, scripts: dict) -> list:
+    """Sends the commands by the blocking client, returns the list of results"""
+    if not commands:
+        return []
+    commands.register_scripts(client, scripts)
+    if len(commands) == 1 and not commands.transaction:
+        try:
+            return [commands.call(client, scripts)]
+        except redis.ResponseError as e:
+            if commands.raise_on_error:
+                raise
+            return [e]
+    with client.pipeline(transaction=commands.transaction) as pipe:
+        commands.buffer(pipe, scripts)
+        return pipe.execute(raise_on_error=commands.raise_on_error)
+
+
+def run_operation(operation, client: redis.Redis = None, scripts: dict = None):
+    """
+    Runs the operation - a generator, which yields effects (`Commands`,
+    `Sleep` or `Call`) and gets their results back, without doing any I/O itself.
+    Effects are executed by the blocking client, and their exceptions
+    are thrown into the operation. Returns what the operation returns.
+
+    The same operations are run by `mnoc_jobtools.aio.run_operation`,
+    so the sync and asyncio clients share all the logic but the I/O.
+    """
+    result, error = None, None
+    while True:
+        try:
+            effect = operation.send(result) if error is None else operation.throw(error)
+        except StopIteration as stop:
+            return stop.value
+        result, error = None, None
+        try:
+            if isinstance(effect, Commands):
+                result = execute_commands(effect, client, scripts)
+            elif isinstance(effect, Sleep):
+                time.sleep(effect.seconds)
+            else:
+                result = effect.function(*effect.args, **effect.kwargs)
+        except Exception as e:
+            error = e
+
+
+##################################################################
+
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+
+def get_connection_pool(
+    host: str = DEFAULT_REDIS_HOST,
+    port: int = DEFAULT_REDIS_PORT,
+    max_connections: int = DEFAULT_REDIS_MAX_CONNECTIONS,
+) -> redis.ConnectionPool:
+    """
+    Returns process-wide connection pool for the redis server.
+    The pool is created on the first call for the host/port pair
+    and then shared by all the clients, so connections are reused between jobs.
+    If pool is exhausted, clients wait for a free connection instead of failing.
+    """
+    with _connection_pools_lock:
+        pool = _connection_pools.get((host, port))
+        if pool is None:
+            pool = redis.BlockingConnectionPool(
+                host=host, port=port, max_connections=max_connections
+            )
+            _connection_pools[(host, port)] = pool
+        return pool
+
+
+class BaseRedisJobQueue:
+    """
+    Operations of the job queue on top of Redis lists, see `run_operation`.
+    They are run by RedisJobQueue with the blocking client,
+    and by `mnoc_jobtools.aio.AsyncRedisJobQueue` with the asyncio one.
+    """
+
+    # Push the value only if there is no pending job with the same key yet.
+    # Pending marker is "<uid>|<expiry unix time>|<value>", and the index
+    # maps "job|<value>" back to the key (values are unique by uid), so POP_SCRIPT
+    # removes the marker together with the value. The job may still be lost
+    # without clearing it (queue deleted or trimmed), so the marker is ignored
+    # once it expires, or when the queue is empty. KEYS[3] is the queue signal.
+    # Returns uid of the job which is pending for the key after the call.
+    PUT_COALESCED_SCRIPT = """
+        local pending = redis.call('HGET', KEYS[2], ARGV[1])
+        if pending then
+            local uid, expiry, job = string.match(pending, '^([^|]*)|([^|]*)|?(.*)$')
+            if uid and redis.call('LLEN', KEYS[1]) > 0 and tonumber(expiry) > tonumber(ARGV[4]) then
+                return uid
+            end
+            if job and job ~= '' then
+                redis.call('HDEL', KEYS[2], 'job|' .. job)
+            end
+        end
+        redis.call('HSET', KEYS[2], ARGV[1], ARGV[2] .. '|' .. ARGV[5] .. '|' .. ARGV[3], 'job|' .. ARGV[3], ARGV[1])
+        redis.call('RPUSH', KEYS[1], ARGV[3])
+        redis.call('LPUSH', KEYS[3], 1)
+        redis.call('LTRIM', KEYS[3], 0, 0)
+        return ARGV[2]
+    """
+    # Remove pending marker only if it still points to the given job uid
+    CLEAR_PENDING_SCRIPT = """
+        local pending = redis.call('HGET', KEYS[1], ARGV[1])
+        if not pending then
+            return 0
+        end
+        local uid, _, job = string.match(pending, '^([^|]*)|([^|]*)|?(.*)$')
+        if uid ~= ARGV[2] then
+            return 0
+        end
+        if job ~= '' then
+            redis.call('HDEL', KEYS[1], 'job|' .. job)
+        end
+        return redis.call('HDEL', KEYS[1], ARGV[1])
+    """
+    # KEYS are the queues in priority order, then their signals in the same order,
+    # then optionally the pending index; ARGV[1] is the number of queues.
+    # Pops the first value of the first non-empty queue and removes the pending
+    # marker of its job in the same step, so the marker can't outlive the job
+    # when the worker dies right after the pop. Signals are left only
+    # for the queues which still have values, to wake up other consumers.
+    POP_SCRIPT = """
+        local count = tonumber(ARGV[1])
+        local index = KEYS[2 * count + 1]
+        local popped = false
+        for i = 1, count do
+            if not popped then
+                local value = redis.call('LPOP', KEYS[i])
+                if value then
+                    popped = {KEYS[i], value}
+                    local key = index and redis.call('HGET', index, 'job|' .. value)
+                    if key then
+                        redis.call('HDEL', index, 'job|' .. value)
+                        local pending = redis.call('HGET', index, key)
+                        if pending and string.match(pending, '^[^|]*|[^|]*|(.*)$') == value then
+                            redis.call('HDEL', index, key)
+                        end
+                    end
+                end
+            end
+            if redis.call('LLEN', KEYS[i]) > 0 then
+                redis.call('LPUSH', KEYS[count + i], 1)
+                redis.call('LTRIM', KEYS[count + i], 0, 0)
+            else
+                redis.call('DEL', KEYS[count + i])
+            end
+        end
+        return popped
+    """
+    # Whether the pending marker of the job is removed by `get`,
+    # otherwise the consumer must call `clear_pending` itself
+    CLEARS_PENDING_ON_GET = True
+
+    # Move values which are due from the delayed set to the queue.
+    # Returns number of moved values and due time of the next delayed value
+    PROMOTE_DELAYED_SCRIPT = """
+        local due = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+        for _, value in ipairs(due) do
+            redis.call('ZREM', KEYS[2], value)
+            redis.call('RPUSH', KEYS[1], value)
+        end
+        if #due > 0 then
+            redis.call('LPUSH', KEYS[3], 1)
+            redis.call('LTRIM', KEYS[3], 0, 0)
+        end
+        local next = redis.call('ZRANGE', KEYS[2], 0, 0, 'WITHSCORES')
+        return {#due, next[2] or false}
+    """
+
+    @staticmethod
+    def _signal_name(queue_name) -> str:
+        """List which holds a token while the queue may have values"""
+        if isinstance(queue_name, bytes):
+            queue_name = queue_name.decode()
+        return f"{queue_name}{SIGNAL_SUFFIX}"
+
+    def _list_op(self, queue_name, start: int, end: int):
+        [values] = yield Commands().lrange(queue_name, start, end)
+        return values
+
+    def _get_op(self, queue_names, block: float, index_name: str = None):
+        # Lua script can't block, so the consumer waits for a signal of the queues
+        # by BLPOP, and then pops by POP_SCRIPT. Values pushed without the signal
+        # (e.g. by `pipeline`) are picked up after SIGNAL_POLL_INTERVAL at most
+        if isinstance(queue_names, str):
+            queue_names = [queue_names]
+        signals = [self._signal_name(queue_name) for queue_name in queue_names]
+        keys = [*queue_names, *signals] + ([index_name] if index_name else [])
+        deadline = time.monotonic() + block if block else None
+        while True:
+            [response] = yield Commands().script(
+                self.POP_SCRIPT, keys, [len(queue_names)]
+            )
+            if response:
+                return tuple(response)
+            wait = SIGNAL_POLL_INTERVAL
+            if deadline:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                wait = min(wait, remaining)
+            yield Commands().blpop(signals, wait)
+
+    def _put_many_op(self, queue_name: str, values: list):
+        commands = Commands()
+        for i in range(0, len(values), BULK_PUT_CHUNK_SIZE):
+            commands.rpush(queue_name, *values[i : i + BULK_PUT_CHUNK_SIZE])
+        signal_name = self._signal_name(queue_name)
+        yield commands.lpush(signal_name, 1).ltrim(signal_name, 0, 0)
+
+    def _put_coalesced_many_op(self, index_name: str, items: list):
+        now = time.time()
+        commands = Commands()
+        for queue_name, key, uid, value in items:
+            commands.script(
+                self.PUT_COALESCED_SCRIPT,
+                [queue_name, index_name, self._signal_name(queue_name)],
+                self._put_coalesced_args(key, uid, value, now),
+            )
+        pending_uids = yield commands
+        return [uid.decode() if isinstance(uid, bytes) else uid for uid in pending_uids]
+
+    def _put_coalesced_args(self, key: str, uid: str, value, now: float) -> list:
+        return [key, uid, value, now, now + PENDING_MARKER_TTL]
+
+    def _put_delayed_op(self, delayed_name: str, due: float, value):
+        yield Commands().zadd(delayed_name, {value: due})
+
+    def _promote_delayed_op(self, lanes: list):
+        now = time.time()
+        commands = Commands()
+        for queue_name, delayed_name in lanes:
+            commands.script(
+                self.PROMOTE_DELAYED_SCRIPT,
+                [queue_name, delayed_name, self._signal_name(queue_name)],
+                self._promote_delayed_args(now, DELAYED_PROMOTE_BATCH),
+            )
+        results = yield commands
+
+        next_dues = []
+        for (queue_name, _), (promoted, next_due) in zip(lanes, results):
+            if promoted:
+                logging.info(f"Promoted {promoted} delayed values to {queue_name}")
+            if next_due is not None:
+                next_dues.append(float(next_due))
+        return max(min(next_dues) - now, 0) if next_dues else None
+
+    def _promote_delayed_args(self, now: float, count: int) -> list:
+        return [now, count]
+
+    def _record_events_op(self, stats_name: str, events: dict):
+        bucket_name = f"{stats_name}:{int(time.time() // STATS_BUCKET_INTERVAL)}"
+        commands = Commands()
+        for event, count in events.items():
+            commands.hincrby(stats_name, event, count)
+            commands.hincrby(bucket_name, event, count)
+        yield commands.expire(bucket_name, STATS_BUCKET_INTERVAL * 3)
+
+    def _depth_op(self, queue_names: list):
+        commands = Commands()
+        for queue_name in queue_names:
+            commands.llen(queue_name)
+        return (yield commands)
+
+    def _clear_pending_op(self, index_name: str, key: str, uid: str):
+        [cleared] = yield Commands().script(
+            self.CLEAR_PENDING_SCRIPT, [index_name], [key, uid]
+        )
+        return bool(cleared)
+
+    def _ack_op(self, queue_name: str, receipt):
+        # Lists don't track deliveries: value is gone as soon as it is popped
+        yield from ()
+
+
+class RedisJobQueue(BaseRedisJobQueue):
+    def __init__(
+        self,
+        host: str = DEFAULT_REDIS_HOST,
+        port: int = DEFAULT_REDIS_PORT,
+        max_connections: int = DEFAULT_REDIS_MAX_CONNECTIONS,
+    ):
+        self._queue = redis.Redis(
+            connection_pool=get_connection_pool(host, port, max_connections)
+        )
+        # Lua scripts registered on the client, by source
+        self._scripts = {}
+
+    def _run(self, operation):
+        return run_operation(operation, self._queue, self._scripts)
+
+    @contextmanager
+    def pipeline(self, transaction: bool = True):
+        """
+        Buffers multiple commands and sends them in one round trip.
+        With transaction=True commands are wrapped into MULTI/EXEC.
+        Commands which were not executed explicitly are executed on exit:
+
+            with queue.pipeline() as pipe:
+                pipe.rpush(queue_name, value)
+                pipe.llen(queue_name)
+        """
+        with self._queue.pipeline(transaction=transaction) as pipe:
+            yield pipe
+            if len(pipe):
+                pipe.execute()
 
     def list(self, queue_name, start: int = 0, end: int = 10):
-        return self._queue.lrange(queue_name, start, end)
+        return self._run(self._list_op(queue_name, start, end))
 
-    def get(self, queue_name: str, block: int = 0):
-        return self._queue.blpop([queue_name], block)
+    def get(self, queue_names, block: float = 0, index_name: str = None):
+        """Pops value from the first non-empty queue.
+        queue_names is either a single name or a list of names in priority order.
+        If index_name is given, the pending marker of the popped value,
+        see `put_coalesced`, is removed in the same step"""
+        return self._run(self._get_op(queue_names, block, index_name))
 
     def put(self, queue_name, *values):
-        self._queue.rpush(queue_name, *values)
+        self._run(self._put_many_op(queue_name, values))
+
+    def put_many(self, queue_name: str, values: list):
+        """Pushes all the values in one round trip.
+        Values are split into chunks, so a single command doesn't get too big"""
+        self._run(self._put_many_op(queue_name, values))
+
+    def put_coalesced(
+        self, queue_name: str, index_name: str, key: str, uid: str, value
+    ) -> str:
+        """Atomically puts value to the queue unless the pending index
+        already has a job for the key. Markers older than PENDING_MARKER_TTL,
+        or of a queue which is empty, are stale: the job could be lost.
+        Returns uid of the pending job"""
+        return self.put_coalesced_many(index_name, [(queue_name, key, uid, value)])[0]
+
+    def put_coalesced_many(self, index_name: str, items: list):
+        """Same as put_coalesced, but for list of (queue_name, key, uid, value)
+        tuples. All the items are submitted in one round trip.
+        Returns list of uids of the pending jobs in the same order"""
+        return self._run(self._put_coalesced_many_op(index_name, items))
+
+    def put_delayed(self, delayed_name: str, due: float, value):
+        """Puts value to the delayed set. It's not in the queue
+        until `promote_delayed` is called after `due` unix time"""
+        self._run(self._put_delayed_op(delayed_name, due, value))
+
+    def promote_delayed(self, lanes: list):
+        """
+        Moves values which are due from the delayed sets to their queues.
+        All the lanes are processed in one round trip.
+
+        Args:
+            lanes: list of (queue_name, delayed_name) tuples
+        Returns:
+            seconds until the next delayed value is due,
+            or None if all the delayed sets are empty
+        """
+        return self._run(self._promote_delayed_op(lanes))
+
+    def record_events(self, stats_name: str, events: dict):
+        """
+        Increments job event counters, e.g. {"enqueued": 10}, in one round trip.
+        Totals are kept in `stats_name` hash, and the counts of the current
+        STATS_BUCKET_INTERVAL in a separate hash, which expires soon after,
+        so the rates can be calculated without keeping any history.
+        """
+        self._run(self._record_events_op(stats_name, events))
+
+    def depth(self, queue_names: list) -> list:
+        """Number of values waiting in each of the queues, in one round trip"""
+        return self._run(self._depth_op(queue_names))
+
+    def clear_pending(self, index_name: str, key: str, uid: str) -> bool:
+        """Removes the key from the pending index if it still belongs to uid"""
+        return self._run(self._clear_pending_op(index_name, key, uid))
+
+    def ack(self, queue_name: str, receipt):
+        """Acknowledges that the value has been processed, see RedisStreamJobQueue.
+        Lists don't track deliveries: value is gone as soon as it is popped"""
+        self._run(self._ack_op(queue_name, receipt))
+
+
+class BaseRedisStreamJobQueue(BaseRedisJobQueue):
+    """Operations of the job queue on top of Redis Streams, see RedisStreamJobQueue"""
+
+    STREAM_FIELD = b"job"
+    # Pending marker is "<uid>|<expiry unix time>|<entry id>". Delivered values
+    # stay in the stream after XACK, so the marker is ignored once its entry
+    # is trimmed, or is in the pending entries list of the group (ARGV[7]):
+    # the consumer read it, and then died before clearing the marker.
+    PUT_COALESCED_SCRIPT = """
+        local function delivered(entry_id)
+            -- No group yet means nothing was delivered
+            local entries = redis.pcall('XPENDING', KEYS[1], ARGV[7], entry_id, entry_id, 1)
+            return entries.err == nil and #entries > 0
+        end
+        local pending = redis.call('HGET', KEYS[2], ARGV[1])
+        if pending then
+            local uid, expiry, entry_id = string.match(pending, '^([^|]*)|([^|]*)|?(.*)$')
+            if uid and tonumber(expiry) > tonumber(ARGV[4]) and entry_id ~= ''
+                and #redis.call('XRANGE', KEYS[1], entry_id, entry_id) > 0
+                and not delivered(entry_id) then
+                return uid
+            end
+        end
+        local entry_id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[6], '*', 'job', ARGV[3])
+        redis.call('HSET', KEYS[2], ARGV[1], ARGV[2] .. '|' .. ARGV[5] .. '|' .. entry_id)
+        return ARGV[2]
+    """
+    CLEAR_PENDING_SCRIPT = """
+        local pending = redis.call('HGET', KEYS[1], ARGV[1])
+        if pending and string.match(pending, '^([^|]*)|') == ARGV[2] then
+            return redis.call('HDEL', KEYS[1], ARGV[1])
+        end
+        return 0
+    """
+    PROMOTE_DELAYED_SCRIPT = """
+        local due = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+        for _, value in ipairs(due) do
+            redis.call('ZREM', KEYS[2], value)
+            redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[3], '*', 'job', value)
+        end
+        local next = redis.call('ZRANGE', KEYS[2], 0, 0, 'WITHSCORES')
+        return {#due, next[2] or false}
+    """
+    # Pending marker is cleared by the consumer after the read
+    CLEARS_PENDING_ON_GET = False
+
+    def __init__(
+        self,
+        host: str = DEFAULT_REDIS_HOST,
+        port: int = DEFAULT_REDIS_PORT,
+        max_connections: int = DEFAULT_REDIS_MAX_CONNECTIONS,
+        group: str = DEFAULT_STREAM_GROUP,
+        consumer: str = None,
+        maxlen: int = DEFAULT_STREAM_MAXLEN,
+        reclaim_idle: int = DEFAULT_STREAM_RECLAIM_IDLE,
+        max_deliveries: int = DEFAULT_STREAM_MAX_DELIVERIES,
+    ):
+        """
+        Args:
+            group (optional): name of consumer group. Consumers of the same group
+                share the stream, so every value is delivered to only one of them
+            consumer (optional): name of this consumer within the group.
+                Must be unique among running consumers. Defaults to hostname-pid
+            maxlen (optional): stream is trimmed to approximately this length
+            reclaim_idle (optional): ms after which unacknowledged value
+                of another consumer is considered abandoned and can be reclaimed
+            max_deliveries (optional): abandoned value which was delivered
+                this many times is dropped instead of being reclaimed again
+        """
+        # The client is built by the sync or asyncio queue next in MRO
+        super().__init__(host, port, max_connections)
+        self.group = group
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.maxlen = maxlen
+        self.reclaim_idle = reclaim_idle
+        self.max_deliveries = max_deliveries
+
+    def _create_group_op(self, queue_name: str):
+        try:
+            yield Commands().xgroup_create(
+                queue_name, self.group, id="0", mkstream=True
+            )
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def _group_info(self, groups) -> dict:
+        """Info of the consumer group from XINFO GROUPS response, if any"""
+        if isinstance(groups, Exception):  # No such stream
+            return None
+        for group in groups:
+            if group["name"].decode() == self.group:
+                return group
+        return None
+
+    def _list_op(self, queue_name, start: int, end: int):
+        try:
+            [groups] = yield Commands().xinfo_groups(queue_name)
+        except redis.ResponseError:  # No such stream
+            return []
+        group = self._group_info(groups)
+        last_delivered_id = group["last-delivered-id"] if group else "-"
+        [entries] = yield Commands().xrange(
+            queue_name, min=last_delivered_id, count=end + 2
+        )
+        if entries and entries[0][0] == last_delivered_id:
+            entries = entries[1:]
+        return [fields[self.STREAM_FIELD] for _, fields in entries[start : end + 1]]
+
+    def _get_op(self, queue_names, block: float, index_name: str = None):
+        # XREADGROUP over several streams would deliver a value from each of them,
+        # so streams are read one by one, and blocking is done by XREAD,
+        # which only waits for new values without delivering them.
+        if isinstance(queue_names, str):
+            queue_names = [queue_names]
+        reclaimed = yield from self._reclaim_op(queue_names)
+        if reclaimed:
+            return reclaimed
+
+        deadline = time.monotonic() + block if block else None
+        while True:
+            for queue_name in queue_names:
+                response = yield from self._read_group_op(queue_name)
+                if response:
+                    return response
+            remaining = deadline - time.monotonic() if deadline else 0
+            if deadline and remaining <= 0:
+                return None
+            if not (yield from self._wait_for_new_values_op(queue_names, remaining)):
+                return None
+
+    def _read_group_op(self, queue_name: str):
+        """Non-blocking read of a new value from the stream"""
+        xreadgroup = Commands().xreadgroup(
+            self.group, self.consumer, {queue_name: ">"}, count=1
+        )
+        try:
+            [response] = yield xreadgroup
+        except redis.ResponseError as e:
+            if "NOGROUP" not in str(e):
+                raise
+            yield from self._create_group_op(queue_name)
+            [response] = yield xreadgroup
+        if not response:
+            return None
+        _, [(entry_id, fields)] = response[0]
+        return queue_name, fields[self.STREAM_FIELD], entry_id
+
+    def _wait_for_new_values_op(self, queue_names: list, block: float):
+        """Blocks until any of the streams has a value, which was not yet
+        delivered to the group. Returns False on timeout"""
+        commands = Commands(raise_on_error=False)
+        for queue_name in queue_names:
+            commands.xinfo_groups(queue_name)
+        groups_per_stream = yield commands
+        last_delivered_ids = {}
+        for queue_name, groups in zip(queue_names, groups_per_stream):
+            # Stream may have no group yet, or be deleted meanwhile
+            group = self._group_info(groups)
+            last_delivered_ids[queue_name] = (
+                group["last-delivered-id"] if group else "0"
+            )
+        [response] = yield Commands().xread(
+            last_delivered_ids, count=1, block=self._block_ms(block)
+        )
+        return bool(response)
+
+    @staticmethod
+    def _block_ms(block: float) -> int:
+        # XREAD treats BLOCK 0 as "forever" same as BLPOP, but takes ms
+        return max(int(block * 1000), 1) if block else 0
+
+    def _reclaim_op(self, queue_names):
+        if isinstance(queue_names, str):
+            queue_names = [queue_names]
+        # No such stream or group yet is not an error here
+        commands = Commands(raise_on_error=False)
+        for queue_name in queue_names:
+            commands.xpending_range(queue_name, self.group, "-", "+", 1)
+        pending_per_stream = yield commands
+
+        for queue_name, pending in zip(queue_names, pending_per_stream):
+            if isinstance(pending, Exception) or not pending:
+                continue
+            if pending[0]["time_since_delivered"] >= self.reclaim_idle:
+                return (yield from self._claim_op(queue_name, pending[0]))
+        return None
+
+    def _claim_op(self, queue_name: str, entry: dict):
+        [claimed] = yield Commands().xclaim(
+            queue_name,
+            self.group,
+            self.consumer,
+            self.reclaim_idle,
+            [entry["message_id"]],
+        )
+        if not claimed or claimed[0][1] is None:  # Trimmed or claimed by others
+            return None
+        entry_id, fields = claimed[0]
+        if entry["times_delivered"] >= self.max_deliveries:
+            logging.error(
+                f"Dropping {entry_id} from {queue_name}:"
+                f" delivered {entry['times_delivered']} times without ack"
+            )
+            yield from self._ack_op(queue_name, entry_id)
+            return None
+        logging.warning(f"Reclaimed {entry_id} from consumer {entry['consumer']}")
+        return queue_name, fields[self.STREAM_FIELD], entry_id
+
+    def _put_many_op(self, queue_name: str, values: list):
+        commands = Commands()
+        for value in values:
+            commands.xadd(
+                queue_name,
+                {self.STREAM_FIELD: value},
+                maxlen=self.maxlen,
+                approximate=True,
+            )
+        yield commands
+
+    def _depth_op(self, queue_names: list):
+        # Stream length is used when the server doesn't report the group lag
+        # (before Redis 7.0, or when the lag can't be determined after trimming),
+        # so it may include the values which were already delivered.
+        commands = Commands(raise_on_error=False)
+        for queue_name in queue_names:
+            commands.xinfo_groups(queue_name)
+            commands.xlen(queue_name)
+        results = yield commands
+        depths = []
+        for groups, length in zip(results[::2], results[1::2]):
+            depth = 0 if isinstance(length, Exception) else length
+            group = self._group_info(groups)
+            if group and group.get("lag") is not None:
+                depth = group["lag"]
+            depths.append(depth)
+        return depths
+
+    def _put_coalesced_args(self, key: str, uid: str, value, now: float) -> list:
+        args = super()._put_coalesced_args(key, uid, value, now)
+        return args + [self.maxlen, self.group]
+
+    def _promote_delayed_args(self, now: float, count: int) -> list:
+        return [now, count, self.maxlen]
+
+    def _ack_op(self, queue_name: str, receipt):
+        yield Commands().xack(queue_name, self.group, receipt)
+
+
+class RedisStreamJobQueue(BaseRedisStreamJobQueue, RedisJobQueue):
+    """
+    Operations of the job queue on top of Redis Streams with consumer groups.
+    Unlike lists, a value is not gone when consumer gets it:
+    it stays in the group's pending entries list until it is acknowledged.
+    If consumer dies without ack, the value is reclaimed by another consumer
+    after `reclaim_idle` ms, so jobs are not lost when worker crashes.
+
+    `get` returns (queue_name, value, entry_id) tuple,
+    entry_id must be passed to `ack` when the value is processed.
+    """
+
+    def create_group(self, queue_name: str):
+        """Creates consumer group (and the stream) unless it already exists"""
+        self._run(self._create_group_op(queue_name))
+
+    def reclaim(self, queue_names):
+        """
+        Takes over the oldest value which was delivered to some consumer
+        but not acknowledged within `reclaim_idle` ms.
+        queue_names is either a single name or a list of names in priority order.
+        Returns (queue_name, value, entry_id) tuple or None.
+        """
+        return self._run(self._reclaim_op(queue_names))
+
+
+QUEUE_BACKENDS = {"list": RedisJobQueue, "stream": RedisStreamJobQueue}
+
+
+class BaseShardCoordinator:
+    """Operations of the shard coordinator, see ShardCoordinator"""
+
+    # KEYS are leases of all the shards, ARGV: worker id, lease ttl in ms,
+    # then '1' or '0' per shard - whether the shard is assigned to the worker.
+    # Returns list of shards which leases the worker holds
+    LEASES_SCRIPT = """
+        local held = {}
+        for i, key in ipairs(KEYS) do
+            local owner = redis.call('GET', key)
+            if ARGV[i + 2] == '1' then
+                if owner == ARGV[1] then
+                    redis.call('PEXPIRE', key, ARGV[2])
+                    table.insert(held, i - 1)
+                elseif not owner then
+                    redis.call('SET', key, ARGV[1], 'PX', ARGV[2])
+                    table.insert(held, i - 1)
+                end
+            elseif owner == ARGV[1] then
+                redis.call('DEL', key)
+            end
+        end
+        return held
+    """
+
+    def __init__(
+        self,
+        registry_name: str,
+        shard_count: int,
+        worker_id: str = None,
+        lease_ttl: int = DEFAULT_SHARD_LEASE_TTL,
+        pinned_shards: list = None,
+    ):
+        """
+        Args:
+            registry_name: name of the Redis sorted set of live workers
+            shard_count: number of shards to split between workers
+            worker_id (optional): unique id of this worker. Defaults to hostname-pid
+            lease_ttl (optional): seconds before shards of the silent worker
+                can be taken over. Must be longer than the longest job
+            pinned_shards (optional): shards this worker always asks for,
+                instead of the automatically assigned ones
+        """
+        self.registry_name = registry_name
+        self.shard_count = shard_count
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_ttl = lease_ttl
+        self.pinned_shards = pinned_shards
+        self.heartbeat_interval = lease_ttl / 3
+
+    def lease_name(self, shard: int) -> str:
+        return f"{self.registry_name}:lease:{shard}"
+
+    def _assigned_shards_op(self):
+        if self.pinned_shards is not None:
+            return self.pinned_shards
+        now = time.time()
+        *_, workers = yield (
+            Commands(transaction=True)
+            .zadd(self.registry_name, {self.worker_id: now})
+            .zremrangebyscore(self.registry_name, "-inf", now - self.lease_ttl)
+            .zrange(self.registry_name, 0, -1)
+        )
+        # Order by id and not by score, which changes with every heartbeat
+        workers = sorted(worker.decode() for worker in workers)
+        index = workers.index(self.worker_id)
+        return [
+            shard for shard in range(self.shard_count) if shard % len(workers) == index
+        ]
+
+    def _leases(self, commands: Commands, shards: set) -> Commands:
+        """Adds LEASES_SCRIPT call to hold only the given shards"""
+        return commands.script(
+            self.LEASES_SCRIPT,
+            [self.lease_name(shard) for shard in range(self.shard_count)],
+            [self.worker_id, int(self.lease_ttl * 1000)]
+            + ["1" if shard in shards else "0" for shard in range(self.shard_count)],
+        )
+
+    def _acquire_shards_op(self, busy_shards):
+        assigned = set((yield from self._assigned_shards_op()))
+        [held] = yield self._leases(Commands(), assigned | set(busy_shards))
+        return [shard for shard in held if shard in assigned]
+
+    def _leave_op(self):
+        yield self._leases(Commands(), set()).zrem(self.registry_name, self.worker_id)
+
+
+class ShardCoordinator(BaseShardCoordinator):
+    """
+    Splits queue shards between live workers.
+
+    Workers register in a sorted set with the time of the last heartbeat
+    as a score, workers without heartbeat for `lease_ttl` are considered dead.
+    Shards are assigned round-robin over the sorted list of live workers,
+    so every join or leave of a worker rebalances the shards.
+
+    Worker consumes a shard only while it holds the lease of the shard.
+    Worker which lost the shard in rebalancing releases the lease
+    only when it asks for shards again, i.e. after its in-flight job is done,
+    and the new owner can't take the shard before that.
+    Worker running several jobs at once keeps the leases of the shards
+    with jobs in flight, see `busy_shards` of `acquire_shards`.
+    So jobs of the same device never run concurrently.
+    """
+
+    def __init__(
+        self,
+        registry_name: str,
+        shard_count: int,
+        worker_id: str = None,
+        lease_ttl: int = DEFAULT_SHARD_LEASE_TTL,
+        pinned_shards: list = None,
+        host: str = DEFAULT_REDIS_HOST,
+        port: int = DEFAULT_REDIS_PORT,
+    ):
+        """
+        Args:
+            registry_name: name of the Redis sorted set of live workers
+            shard_count: number of shards to split between workers
+            worker_id (optional): unique id of this worker. Defaults to hostname-pid
+            lease_ttl (optional): seconds before shards of the silent worker
+                can be taken over. Must be longer than the longest job
+            pinned_shards (optional): shards this worker always asks for,
+                instead of the automatically assigned ones
+        """
+        super().__init__(
+            registry_name, shard_count, worker_id, lease_ttl, pinned_shards
+        )
+        self._redis = redis.Redis(connection_pool=get_connection_pool(host, port))
+        self._scripts = {}
+
+    def _run(self, operation):
+        return run_operation(operation, self._redis, self._scripts)
+
+    def assigned_shards(self) -> list:
+        """Registers heartbeat of this worker and returns shards assigned to it"""
+        return self._run(self._assigned_shards_op())
+
+    def acquire_shards(self, busy_shards=()) -> list:
+        """
+        Takes leases of the assigned shards, renews already held ones,
+        and releases the shards which are not assigned anymore.
+        Returns shards which this worker may consume now
+
+        Args:
+            busy_shards (optional): shards with jobs still in progress.
+                Their leases are renewed even if they are not assigned anymore,
+                so the new owner doesn't start before the jobs are done
+        """
+        return self._run(self._acquire_shards_op(busy_shards))
+
+    def leave(self):
+        """Releases all the shards, so other workers can take them immediately"""
+        self._run(self._leave_op())
 
 
 ##################################################################
@@ -64,14 +985,282 @@ class JobStatus(Enum):
     FAILURE = "FAILURE"
 
 
-class SyncJob:
+class JobPriority(Enum):
+    """Members are ordered from the highest priority to the lowest"""
+
+    HIGH = 0  # Interactive changes made by operators
+    NORMAL = 1  # Changes discovered on the network, i.e. snmp-traps
+    LOW = 2  # Background reconcile
+
+
+##################################################################
+
+
+class JsonJobCodec:
     """
-    An instance of this class represents a Job for synchronization
-    of device config to DB and vice versa
+    Human-readable codec, which was the only job format originally.
+    It has no version byte: payload starting with '{' is always json
+    """
+
+    def encode(self, job: "SyncJob") -> bytes:
+        return json.dumps(job.to_dict()).encode()
+
+    def decode(self, payload: bytes) -> dict:
+        """Returns keyword arguments for the job constructor"""
+        job_data = json.loads(payload)
+        return dict(
+            device_id=job_data["device_id"],
+            sync_from=job_data["sync_from"],
+            sync_to=job_data["sync_to"],
+            uid=job_data["uid"],
+            timestamp=datetime.fromisoformat(job_data["timestamp"]),
+            status=JobStatus[job_data["status"]],
+            attempts_target=job_data["attempts_target"],
+            attempts_done=job_data["attempts_done"],
+            # Jobs submitted before priorities were introduced have no priority
+            priority=JobPriority[job_data.get("priority", JobPriority.NORMAL.name)],
+        )
+
+
+class BinaryJobCodec:
+    """
+    Compact codec: fixed-size struct of the job fields followed by uid.
+    The first byte is schema VERSION, so the layout can evolve
+    while jobs of the previous versions are still in the queue.
+    Enums and targets are encoded as their index,
+    timestamp - as microseconds since epoch of its wall time,
+    followed by its UTC offset in minutes, or NAIVE if it has no timezone.
+    """
+
+    VERSION = 2
+    # Layouts of all the versions, which may still be in the queue
+    HEADERS = {1: struct.Struct(">BIBBqBBBB"), 2: struct.Struct(">BIBBqhBBBB")}
+    HEADER = HEADERS[VERSION]
+    NAIVE = -(2**15)
+    EPOCH = datetime(1970, 1, 1)
+    TARGETS = AVAILABLE_SYNCJOB_TARGETS
+    STATUSES = list(JobStatus)
+    PRIORITIES = list(JobPriority)
+
+    def encode(self, job: "SyncJob") -> bytes:
+        wall_time = job.timestamp.replace(tzinfo=None)
+        timestamp = (wall_time - self.EPOCH) // timedelta(microseconds=1)
+        utc_offset = self.NAIVE
+        if job.timestamp.utcoffset() is not None:
+            utc_offset = job.timestamp.utcoffset() // timedelta(minutes=1)
+        return (
+            self.HEADER.pack(
+                self.VERSION,
+                job.device_id,
+                self.TARGETS.index(job.sync_from),
+                self.TARGETS.index(job.sync_to),
+                timestamp,
+                utc_offset,
+                self.STATUSES.index(job.status),
+                job.attempts_target,
+                job.attempts_done,
+                self.PRIORITIES.index(job.priority),
+            )
+            + job.uid.encode()
+        )
+
+    def decode(self, payload: bytes) -> dict:
+        """Returns keyword arguments for the job constructor"""
+        header = self.HEADERS[payload[0]]
+        fields = list(header.unpack_from(payload))
+        if payload[0] == 1:  # Timestamps were always naive
+            fields.insert(5, self.NAIVE)
+        (
+            _,
+            device_id,
+            sync_from,
+            sync_to,
+            timestamp,
+            utc_offset,
+            status,
+            attempts_target,
+            attempts_done,
+            priority,
+        ) = fields
+        timestamp = self.EPOCH + timedelta(microseconds=timestamp)
+        if utc_offset != self.NAIVE:
+            timestamp = timestamp.replace(
+                tzinfo=timezone(timedelta(minutes=utc_offset))
+            )
+        return dict(
+            device_id=device_id,
+            sync_from=self.TARGETS[sync_from],
+            sync_to=self.TARGETS[sync_to],
+            uid=payload[header.size :].decode(),
+            timestamp=timestamp,
+            status=self.STATUSES[status],
+            attempts_target=attempts_target,
+            attempts_done=attempts_done,
+            priority=self.PRIORITIES[priority],
+        )
+
+
+JOB_CODECS = {"json": JsonJobCodec(), "binary": BinaryJobCodec()}
+
+
+def decode_job_payload(payload) -> dict:
+    """
+    Decodes payload of any known format into keyword arguments
+    for the job constructor. Format is detected by the first byte:
+    json object or version byte of the binary codec
+    """
+    if isinstance(payload, str):
+        payload = payload.encode()
+    if payload[:1] == b"{":
+        return JOB_CODECS["json"].decode(payload)
+    if payload[:1] and payload[0] in BinaryJobCodec.HEADERS:
+        return JOB_CODECS["binary"].decode(payload)
+    raise SyncJobCodecException(f"Unknown job payload format: {payload[:1]}")
+
+
+##################################################################
+
+
+class BaseSyncJob:
+    """
+    Job for synchronization of device config to DB and vice versa,
+    without the I/O: queue operations are generators, see `run_operation`.
+    They are run by SyncJob with the blocking clients, and by
+    `mnoc_jobtools.aio.AsyncSyncJob` with the asyncio ones,
+    so jobs of both are interchangeable: payloads and queues are the same.
     """
 
     JOB_TYPE = "sync"
     QUEUE_NAME = QUEUE_NAME_PREFIX + JOB_TYPE
+    QUEUE_BACKEND = QUEUE_BACKENDS[DEFAULT_QUEUE_BACKEND]
+    CODEC = JOB_CODECS[DEFAULT_JOB_CODEC]
+    RETRY_BACKOFF_BASE = 5  # Seconds before the first retry
+    RETRY_BACKOFF_MAX = 300  # Max seconds between retries
+    STARVATION_GUARD = 10  # Every Nth retrieval starts from a lower priority lane
+    SHARD_COUNT = DEFAULT_SHARD_COUNT
+    SHARD_COORDINATOR = None  # Class of the coordinator, set by the subclasses
+    _retrievals_counter = itertools.count(1)
+    _shard_coordinator = None
+    # Monotonic time when the delayed jobs are promoted next by this worker
+    _next_promotion = 0.0
+
+    @classmethod
+    def job_queue(cls):
+        """Client of QUEUE_BACKEND, which the operations are run with"""
+        raise NotImplementedError
+
+    @classmethod
+    def lane_name(cls, priority: JobPriority = None, shard: int = 0) -> str:
+        """Name of the queue for jobs of the priority and the shard.
+        NORMAL priority lane of the only shard is QUEUE_NAME itself"""
+        lane_name = cls.QUEUE_NAME
+        if priority is not None and priority != JobPriority.NORMAL:
+            lane_name += f":{priority.name.lower()}"
+        if cls.SHARD_COUNT > 1:
+            lane_name += f":shard-{shard}"
+        return lane_name
+
+    @classmethod
+    def all_lane_names(cls) -> list:
+        """Names of all the queues for the jobs, in priority order"""
+        return [
+            cls.lane_name(priority, shard)
+            for priority in JobPriority
+            for shard in range(cls.SHARD_COUNT)
+        ]
+
+    @classmethod
+    def shard_for(cls, device_id: int) -> int:
+        """All the jobs of the device go to the same shard"""
+        return zlib.crc32(str(device_id).encode()) % cls.SHARD_COUNT
+
+    @property
+    def shard(self) -> int:
+        return self.shard_for(self.device_id)
+
+    @classmethod
+    def shard_coordinator(cls) -> BaseShardCoordinator:
+        """Process-wide coordinator of the shards owned by this worker"""
+        registry_name = cls.QUEUE_NAME + WORKERS_REGISTRY_SUFFIX
+        if (
+            cls._shard_coordinator is None
+            or cls._shard_coordinator.registry_name != registry_name
+            or cls._shard_coordinator.shard_count != cls.SHARD_COUNT
+        ):
+            pinned_shards = None
+            if DEFAULT_PINNED_SHARDS:
+                pinned_shards = [int(s) for s in DEFAULT_PINNED_SHARDS.split(",")]
+            cls._shard_coordinator = cls.SHARD_COORDINATOR(
+                registry_name, cls.SHARD_COUNT, pinned_shards=pinned_shards
+            )
+        return cls._shard_coordinator
+
+    @classmethod
+    def _owned_shards_op(cls, busy_shards):
+        if cls.SHARD_COUNT == 1:
+            return [0]
+        return (yield Call(cls.shard_coordinator().acquire_shards, busy_shards))
+
+    @classmethod
+    def _leave_shards_op(cls):
+        if cls.SHARD_COUNT > 1:
+            yield Call(cls.shard_coordinator().leave)
+
+    @classmethod
+    def pending_index_name(cls) -> str:
+        """Name of the Redis hash, which maps coalescing keys to pending job uids"""
+        return cls.QUEUE_NAME + PENDING_INDEX_SUFFIX
+
+    @classmethod
+    def stats_name(cls) -> str:
+        """Name of the Redis hash of job event counters, see `record_events`"""
+        return cls.QUEUE_NAME + STATS_SUFFIX
+
+    @classmethod
+    def _record_events_op(cls, job_queue, events: dict):
+        # Metrics are not worth failing the job for, so errors are only logged
+        try:
+            yield Call(job_queue.record_events, cls.stats_name(), events)
+        except redis.RedisError:
+            logging.exception(f"Failed to record job events {events}")
+
+    @classmethod
+    def delayed_set_name(cls, priority: JobPriority = None, shard: int = 0) -> str:
+        """Name of the Redis sorted set of delayed jobs, scored by due time"""
+        return cls.lane_name(priority, shard) + DELAYED_SET_SUFFIX
+
+    @classmethod
+    def lanes_in_serving_order(cls, shards: list = (0,)) -> list:
+        """
+        Lane names of the shards in order they are checked by `get_next_from_queue`.
+        Usually it's priority order, but every STARVATION_GUARD-th time
+        one of lower priority lanes (in turns) goes first,
+        so background jobs make progress even under constant interactive load.
+        Shards of the same priority are rotated, so none of them is starved.
+        """
+        priorities = list(JobPriority)
+        retrieval = next(cls._retrievals_counter)
+        if retrieval % cls.STARVATION_GUARD == 0:
+            lower_priorities = priorities[1:]
+            boosted = lower_priorities[
+                (retrieval // cls.STARVATION_GUARD) % len(lower_priorities)
+            ]
+            priorities.remove(boosted)
+            priorities.insert(0, boosted)
+        offset = retrieval % len(shards)
+        shards = list(shards[offset:]) + list(shards[:offset])
+        return [
+            cls.lane_name(priority, shard)
+            for priority in priorities
+            for shard in shards
+        ]
+
+    @property
+    def coalescing_key(self) -> str:
+        """Jobs with the same coalescing key do the same work,
+        so only one of them needs to be pending at a time.
+        Priority is a part of the key: urgent job mustn't wait in a lower lane"""
+        return f"{self.device_id}:{self.sync_from}:{self.sync_to}:{self.priority.name}"
 
     def __init__(
         self,
@@ -83,6 +1272,7 @@ class SyncJob:
         status: JobStatus = JobStatus.TODO,
         attempts_target: int = 2,
         attempts_done: int = 0,
+        priority: JobPriority = JobPriority.NORMAL,
     ):
         """
         Args:
@@ -99,6 +1289,7 @@ class SyncJob:
             attempts_target (optional): number of attempts before considering this job failed
             attempts_done (optional): current number of attempts to execute this job
                 if it doesn't reach attempts_target, Job can be rescheduled.
+            priority (optional): jobs of higher priority are retrieved first
         """
         # Sanity checks
         if (
@@ -118,6 +1309,15 @@ class SyncJob:
         self.status = status
         self.attempts_target = attempts_target
         self.attempts_done = attempts_done
+        self.priority = priority
+        # (queue_name, entry_id) of the delivery, which is to be acknowledged.
+        # Set only by the queue backends which track deliveries
+        self.receipt = None
+        # Outcome of the delivery is counted once, see `finish`
+        self._finished = False
+        # Jobs of the same device and direction, which were retrieved
+        # together with this one and share its outcome, see `merge_jobs`
+        self.merged_jobs = []
 
     def __generate_uid(self):
         """Generates unique ID"""
@@ -127,74 +1327,396 @@ class SyncJob:
             + "".join(random.choices(string.ascii_lowercase + string.digits, k=8))
         )
 
-    def __serialize_to_json(self):
-        """Serializes this instance of class to json-string
-        The result can be deserialized into object"""
-        return json.dumps(
-            {
-                "device_id": self.device_id,
-                "sync_from": self.sync_from,
-                "sync_to": self.sync_to,
-                "timestamp": self.timestamp.isoformat(),
-                "uid": self.uid,
-                "status": self.status.name,
-                "attempts_target": self.attempts_target,
-                "attempts_done": self.attempts_done,
-            }
-        )
-
-    def put_to_queue(self):
-        """Submits this instance to the RedisJobQueue"""
-        job_queue = RedisJobQueue()
+    def to_dict(self) -> dict:
+        """Json-friendly representation of this job"""
+        return {
+            "device_id": self.device_id,
+            "sync_from": self.sync_from,
+            "sync_to": self.sync_to,
+            "timestamp": self.timestamp.isoformat(),
+            "uid": self.uid,
+            "status": self.status.name,
+            "attempts_target": self.attempts_target,
+            "attempts_done": self.attempts_done,
+            "priority": self.priority.name,
+        }
+
+    def to_payload(self) -> bytes:
+        """Serializes this instance of class with CODEC
+        The result can be deserialized into object with `from_payload`"""
+        return self.CODEC.encode(self)
+
+    @classmethod
+    def from_payload(cls, payload):
+        """Deserializes job from payload of any known codec"""
+        return cls(**decode_job_payload(payload))
+
+    def _put_to_queue_op(self, coalesce: bool, delay: float):
+        job_queue = self.job_queue()
         # If no timestamp provided - use the current time
         self.timestamp = self.timestamp if self.timestamp else datetime.now()
+        if delay > 0:
+            logging.info(f"Submitting sync job to queue in {delay:.1f}s: {self}")
+            yield Call(
+                job_queue.put_delayed,
+                self.delayed_set_name(self.priority, self.shard),
+                time.time() + delay,
+                self.to_payload(),
+            )
+            # Retry of the job must not wait for the next scheduled promotion
+            cls = type(self)
+            cls._next_promotion = min(cls._next_promotion, time.monotonic() + delay)
+            yield from self._record_events_op(job_queue, {"enqueued": 1})
+            return self.uid
+
         logging.info(f"Submitting sync job to queue: {self}")
-        job_queue.put(self.QUEUE_NAME, self.__serialize_to_json())
+        if not coalesce:
+            yield Call(
+                job_queue.put,
+                self.lane_name(self.priority, self.shard),
+                self.to_payload(),
+            )
+            yield from self._record_events_op(job_queue, {"enqueued": 1})
+            return self.uid
+
+        pending_uid = yield Call(
+            job_queue.put_coalesced,
+            self.lane_name(self.priority, self.shard),
+            self.pending_index_name(),
+            self.coalescing_key,
+            self.uid,
+            self.to_payload(),
+        )
+        if pending_uid != self.uid:
+            logging.info(
+                f"Sync job {self.uid} was merged into pending job {pending_uid}"
+            )
+            self.uid = pending_uid
+            yield from self._record_events_op(job_queue, {"merged": 1})
+        else:
+            yield from self._record_events_op(job_queue, {"enqueued": 1})
+        return self.uid
 
     @classmethod
-    def get_next_from_queue(cls):
-        """Retrieve next Job from RedisJobQueue
-        This method returns instance of the SyncJob,
-        and not payload"""
-        job_queue = RedisJobQueue()
-        logging.info(f"Retrieving sync job from queue")
-        job_data = job_queue.get(cls.QUEUE_NAME)
-        job_data = json.loads(job_data[1])
-        instance = cls(
-            device_id=job_data["device_id"],
-            sync_from=job_data["sync_from"],
-            sync_to=job_data["sync_to"],
-            uid=job_data["uid"],
-            timestamp=datetime.fromisoformat(job_data["timestamp"]),
-            status=JobStatus[job_data["status"]],
-            attempts_target=job_data["attempts_target"],
-            attempts_done=job_data["attempts_done"],
+    def _put_many_op(cls, jobs: list, coalesce: bool):
+        job_queue = cls.job_queue()
+        now = datetime.now()
+        for job in jobs:
+            job.timestamp = job.timestamp if job.timestamp else now
+        logging.info(f"Submitting {len(jobs)} sync jobs to queue")
+        if not coalesce:
+            lanes = {}
+            for job in jobs:
+                lane_name = cls.lane_name(job.priority, job.shard)
+                lanes.setdefault(lane_name, []).append(job.to_payload())
+            for lane_name, values in lanes.items():
+                yield Call(job_queue.put_many, lane_name, values)
+            yield from cls._record_events_op(job_queue, {"enqueued": len(jobs)})
+            return [job.uid for job in jobs]
+
+        pending_uids = yield Call(
+            job_queue.put_coalesced_many,
+            cls.pending_index_name(),
+            [
+                (
+                    cls.lane_name(job.priority, job.shard),
+                    job.coalescing_key,
+                    job.uid,
+                    job.to_payload(),
+                )
+                for job in jobs
+            ],
+        )
+        enqueued = 0
+        for job, pending_uid in zip(jobs, pending_uids):
+            enqueued += job.uid == pending_uid
+            job.uid = pending_uid
+        yield from cls._record_events_op(
+            job_queue, {"enqueued": enqueued, "merged": len(jobs) - enqueued}
         )
+        return pending_uids
+
+    @classmethod
+    def _get_next_from_queue_op(cls, timeout: float, busy_shards):
+        job_queue = cls.job_queue()
+        logging.debug("Retrieving sync job from queue")
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        response = None
+        while not response:
+            # Wait for the new job forever, unless there is something to do:
+            # shards must be re-acquired before the lease expires
+            block = 0
+            if cls.SHARD_COUNT > 1:
+                block = cls.shard_coordinator().heartbeat_interval
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0.01)
+                block = min(block, remaining) if block else remaining
+            shards = yield from cls._owned_shards_op(busy_shards)
+            if not shards:  # More workers than shards
+                yield Sleep(block)
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None
+                continue
+            # Delayed jobs get into the queue only when somebody promotes them,
+            # so don't block for longer than until the next one is due.
+            # Promotion is a round trip, so it's done at most once per
+            # DELAYED_POLL_INTERVAL, unless a delayed job is due sooner
+            if time.monotonic() >= cls._next_promotion:
+                next_due = yield Call(
+                    job_queue.promote_delayed,
+                    [
+                        (
+                            cls.lane_name(priority, shard),
+                            cls.delayed_set_name(priority, shard),
+                        )
+                        for priority in JobPriority
+                        for shard in shards
+                    ],
+                )
+                promotion_interval = DELAYED_POLL_INTERVAL
+                if next_due is not None:
+                    promotion_interval = min(max(next_due, 0.01), promotion_interval)
+                cls._next_promotion = time.monotonic() + promotion_interval
+            due_block = max(cls._next_promotion - time.monotonic(), 0.01)
+            block = min(block, due_block) if block else due_block
+            response = yield Call(
+                job_queue.get,
+                cls.lanes_in_serving_order(shards),
+                block,
+                cls.pending_index_name(),
+            )
+            if not response and deadline is not None:
+                if time.monotonic() >= deadline:
+                    return None
+        instance = cls.from_payload(response[1])
+        if len(response) > 2:
+            instance.receipt = (response[0], response[2])
+        # From now on, the job is not pending anymore.
+        # New submissions must create a new job instead of merging into this one
+        if not job_queue.CLEARS_PENDING_ON_GET:
+            yield Call(
+                job_queue.clear_pending,
+                cls.pending_index_name(),
+                instance.coalescing_key,
+                instance.uid,
+            )
+        yield from cls._record_events_op(job_queue, {"dequeued": 1})
         logging.info(f"Job retrieved: {instance}")
         return instance
 
-    def reschedule(self, force: bool = False):
+    @classmethod
+    def _get_many_from_queue_op(
+        cls, max_jobs: int, window: float, timeout: float, busy_shards
+    ):
+        first = yield from cls._get_next_from_queue_op(timeout, busy_shards)
+        if first is None:
+            return []
+        jobs = [first]
+        deadline = time.monotonic() + window
+        while len(jobs) < max_jobs:
+            # Shards of the jobs retrieved so far must stay owned as well
+            sync_job = yield from cls._get_next_from_queue_op(
+                max(deadline - time.monotonic(), 0),
+                {*busy_shards, *(job.shard for job in jobs)},
+            )
+            if sync_job is None:
+                break
+            jobs.append(sync_job)
+        return jobs
+
+    @staticmethod
+    def merge_jobs(jobs: list) -> list:
         """
-        If you consider this Job unsuccessful,
-        you can use this method to reschedule it.
-        Job won't be rescheduled if its attempts_done counter hits attempt_target,
-        unless you specify force as True
+        Merges consecutive jobs of the same device and direction,
+        so a run of them is executed once. Jobs of other devices in between
+        don't break the run, but a job of the device in the other direction
+        does, so jobs of every device keep their order.
+        Returns the first job of every run, in retrieval order,
+        with the rest of the run in its `merged_jobs`
+        """
+        runs = {}  # Device id -> first job of the current run of the device
+        merged = []
+        for sync_job in jobs:
+            run = runs.get(sync_job.device_id)
+            if run is not None and (run.sync_from, run.sync_to) == (
+                sync_job.sync_from,
+                sync_job.sync_to,
+            ):
+                run.merged_jobs.append(sync_job)
+            else:
+                runs[sync_job.device_id] = sync_job
+                merged.append(sync_job)
+        return merged
+
+    def _ack_op(self):
+        if self.receipt is not None:
+            yield Call(self.job_queue().ack, *self.receipt)
+            self.receipt = None
+        for sync_job in self.merged_jobs:
+            yield from sync_job._ack_op()
+
+    def _finish_op(self, status: JobStatus):
+        if self._finished:
+            return
+        self._finished = True
+        self.status = status
+        yield from self._record_events_op(
+            self.job_queue(), {f"status:{status.name}": 1}
+        )
+        for sync_job in self.merged_jobs:
+            yield from sync_job._finish_op(status)
+
+    def retry_delay(self) -> float:
         """
+        Exponential backoff with jitter: the delay doubles with every attempt
+        up to RETRY_BACKOFF_MAX, and the random half of it spreads retries
+        of the jobs which failed at the same time
+        """
+        delay = min(
+            self.RETRY_BACKOFF_BASE * 2**self.attempts_done, self.RETRY_BACKOFF_MAX
+        )
+        return delay / 2 + random.uniform(0, delay / 2)
 
+    def _reschedule_op(self, force: bool):
         logging.info(f"Rescheduling sync job {self}")
         if (self.attempts_done < self.attempts_target) or force:
+            delay = self.retry_delay()
             self.attempts_done += 1
             self.status = JobStatus.REDO
-            self.put_to_queue()
+            yield from self._finish_op(JobStatus.REDO)
+            yield from self._put_to_queue_op(coalesce=False, delay=delay)
             logging.info(f"Sync Job was rescheduled {self}")
         else:
             logging.info(
                 f"Sync job attempts have exceeded the limit. Dropping this job: {self}"
             )
             self.status = JobStatus.FAILURE
+            yield from self._finish_op(JobStatus.FAILURE)
 
     def __str__(self):
         return (
             f"<SyncJob> <{self.uid}> {self.sync_from}->{self.sync_to}"
             f" Device: {self.device_id} Status: {self.status}"
+            f" Priority: {self.priority.name}"
+        )
+
+
+class SyncJob(BaseSyncJob):
+    """
+    An instance of this class represents a Job for synchronization
+    of device config to DB and vice versa
+    """
+
+    SHARD_COORDINATOR = ShardCoordinator
+
+    @classmethod
+    def job_queue(cls) -> RedisJobQueue:
+        return cls.QUEUE_BACKEND()
+
+    @classmethod
+    def owned_shards(cls, busy_shards=()) -> list:
+        """Shards this worker may consume jobs from,
+        see `ShardCoordinator.acquire_shards` for `busy_shards`"""
+        return run_operation(cls._owned_shards_op(busy_shards))
+
+    @classmethod
+    def leave_shards(cls):
+        """Must be called by worker on shutdown, so its shards are rebalanced
+        immediately and not after the lease expires"""
+        run_operation(cls._leave_shards_op())
+
+    @classmethod
+    def record_events(cls, job_queue: RedisJobQueue, events: dict):
+        """
+        Counts job events for the metrics: "enqueued", "merged" into pending job,
+        "dequeued" and "status:<JobStatus name>" for the outcomes of deliveries.
+        Metrics are not worth failing the job for, so errors are only logged.
+        """
+        run_operation(cls._record_events_op(job_queue, events))
+
+    def put_to_queue(self, coalesce: bool = False, delay: float = 0) -> str:
+        """Submits this instance to the RedisJobQueue
+
+        Args:
+            coalesce (optional): if there is already a pending job
+                for the same device and direction, don't submit a new one.
+                This instance is merged into the pending job and takes its uid.
+            delay (optional): seconds before the job gets into the queue.
+                Delayed jobs are never coalesced: new submissions for
+                the same device and direction mustn't wait for the delay.
+        Returns:
+            uid of the job in the queue
+        """
+        return run_operation(self._put_to_queue_op(coalesce, delay))
+
+    @classmethod
+    def put_many(cls, jobs: list, coalesce: bool = False) -> list:
+        """
+        Submits many jobs to the RedisJobQueue in one pipelined call
+
+        Args:
+            jobs: list of SyncJob instances
+            coalesce (optional): same as for `put_to_queue`.
+                Jobs within the same batch are coalesced as well.
+        Returns:
+            list of uids of the jobs in the queue, in the same order as jobs
+        """
+        return run_operation(cls._put_many_op(jobs, coalesce))
+
+    @classmethod
+    def get_next_from_queue(cls, timeout: float = None, busy_shards=()):
+        """Retrieve next Job from RedisJobQueue
+        Jobs are retrieved from the highest priority non-empty lane
+        of the shards owned by this worker, see `lanes_in_serving_order`.
+        This method returns instance of the SyncJob,
+        and not payload
+
+        Args:
+            timeout (optional): seconds to wait for a job, waits forever if None.
+                Returns None if there was no job in time
+            busy_shards (optional): shards of the jobs which this worker
+                is still running, see `ShardCoordinator.acquire_shards`
+        """
+        return run_operation(cls._get_next_from_queue_op(timeout, busy_shards))
+
+    @classmethod
+    def get_many_from_queue(
+        cls, max_jobs: int, window: float = 0, timeout: float = None, busy_shards=()
+    ) -> list:
+        """
+        Retrieves up to `max_jobs` jobs: waits for the first one
+        same as `get_next_from_queue`, then takes the jobs which are already
+        in the queue or arrive within `window` seconds after the first one.
+        Returns empty list if there was no job in `timeout`
+        """
+        return run_operation(
+            cls._get_many_from_queue_op(max_jobs, window, timeout, busy_shards)
         )
+
+    def ack(self):
+        """
+        Confirms that the job has been processed and mustn't be redelivered.
+        Must be called when the job handler is done with the job,
+        regardless of job outcome (rescheduled job is a new delivery).
+        Merged jobs are acknowledged as well
+        """
+        run_operation(self._ack_op())
+
+    def finish(self, status: JobStatus = JobStatus.SUCCESS):
+        """
+        Records the outcome of the delivery of this job for the metrics.
+        Only the first outcome counts: job handler must call it when done,
+        but if the job was already rescheduled or dropped, it stays that way.
+        Merged jobs get the same outcome.
+        """
+        run_operation(self._finish_op(status))
+
+    def reschedule(self, force: bool = False):
+        """
+        If you consider this Job unsuccessful,
+        you can use this method to reschedule it.
+        Job gets back to the queue after `retry_delay` seconds.
+        Job won't be rescheduled if its attempts_done counter hits attempt_target,
+        unless you specify force as True
+        """
+        run_operation(self._reschedule_op(force))
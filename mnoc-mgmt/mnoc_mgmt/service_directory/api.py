@@ -1,29 +1,390 @@
-import json
+import logging
+import zlib
 
-from mnoc_jobtools.tools import RedisJobQueue
+from django.db import IntegrityError, transaction
+from django.db.models import QuerySet
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+from mnoc_jobtools.metrics import collect_queue_metrics, render_prometheus
+from mnoc_jobtools.tools import SyncJob
+from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination, LimitOffsetPagination
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from .models import Device, Vlan
-from .serializers import DeviceSerializer, VlanSerializer
+from .models import Device, Vlan, VlanChange
+from .serializers import (
+    BulkVlanRequestSerializer,
+    DeviceSerializer,
+    VlanChangeSerializer,
+    VlanSerializer,
+)
+from .signals import bulk_vlan_changes, vlans_bulk_changed
 from rest_framework.viewsets import ModelViewSet
 
+BULK_DELETE_CHUNK_SIZE = 1000
 
-class DeviceViewSet(ModelViewSet):
+
+class ListCursorPagination(CursorPagination):
+    """Pages of a list, for the clients asking for them with `cursor` or `page_size`"""
+
+    ordering = "id"
+    page_size = 100
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+
+
+def iterate_in_chunks(queryset: QuerySet, chunk_size: int):
+    """
+    Yields lists of objects of the queryset ordered by id, a query per list.
+    Unlike `queryset.iterator()`, every query fetches only its chunk:
+    MySQL client buffers the whole result of a query before the first row
+    """
+    queryset = queryset.order_by("pk")
+    chunk = list(queryset[:chunk_size])
+    while chunk:
+        yield chunk
+        chunk = list(queryset.filter(pk__gt=chunk[-1].pk)[:chunk_size])
+
+
+class StreamingListMixin:
+    """
+    List is rendered as a JSON array written a chunk of objects at a time,
+    so memory of the worker doesn't grow with the number of objects.
+    Pages are served by `ListCursorPagination` when `cursor` or `page_size`
+    is given, and the browsable API is rendered as usual
+    """
+
+    pagination_class = ListCursorPagination
+    stream_chunk_size = 1000
+
+    @property
+    def paginator(self):
+        pagination = self.pagination_class
+        page_params = {pagination.cursor_query_param, pagination.page_size_query_param}
+        if page_params.isdisjoint(self.request.query_params):
+            return None
+        return super().paginator
+
+    def list(self, request, *args, **kwargs):
+        if self.paginator is not None or not isinstance(
+            request.accepted_renderer, JSONRenderer
+        ):
+            return super().list(request, *args, **kwargs)
+        # Filters are validated before the response starts
+        queryset = self.filter_queryset(self.get_queryset())
+        return StreamingHttpResponse(
+            self._render_chunks(queryset), content_type="application/json"
+        )
+
+    def _render_chunks(self, queryset: QuerySet):
+        renderer = self.request.accepted_renderer
+        renderer_context = self.get_renderer_context()
+        yield b"["
+        separator = b""
+        for chunk in iterate_in_chunks(queryset, self.stream_chunk_size):
+            data = self.get_serializer(chunk, many=True).data
+            rendered = renderer.render(data, renderer_context=renderer_context)
+            # Objects of the chunk, without the brackets of the array
+            yield separator + rendered[1:-1]
+            separator = b","
+        yield b"]"
+
+
+class DeviceViewSet(StreamingListMixin, ModelViewSet):
     queryset = Device.objects.all()
     serializer_class = DeviceSerializer
     filterset_fields = ("id", "name", "management_ip")
 
+    @action(detail=True, methods=["get"])
+    def vlan_changes(self, request, pk=None):
+        """
+        Vlan changes of the device after the vlans revision given with `since`:
 
-class VlanViewSet(ModelViewSet):
-    queryset = Vlan.objects.select_related("device").all()
+            {"revision": current revision, "changes": [change, ...]}
+
+        Changes are in the order they were made. Pass the returned revision
+        as `since` of the next request to get only the changes made after it.
+        Changes made while the request was served are left to the next request
+        """
+        try:
+            since = int(request.query_params.get("since", 0))
+        except ValueError:
+            raise ValidationError({"since": "Must be a vlans revision number"})
+        device = self.get_object()
+        changes = VlanChange.objects.filter(
+            device_id=device.id,
+            revision__gt=since,
+            revision__lte=device.vlans_revision,
+        )
+        return Response(
+            {
+                "revision": device.vlans_revision,
+                "changes": VlanChangeSerializer(changes, many=True).data,
+            }
+        )
+
+
+def _device_vlans_revision(request):
+    """
+    Returns (device id, vlans revision, vlans modified) of the device
+    the vlan list is filtered by with `device__id`, or None if it isn't.
+    Fetched once per request, as both ETag and Last-Modified need it
+    """
+    if not hasattr(request, "device_vlans_revision"):
+        try:
+            device_id = int(request.GET["device__id"])
+        except (KeyError, ValueError):
+            request.device_vlans_revision = None
+        else:
+            request.device_vlans_revision = (
+                Device.objects.filter(id=device_id)
+                .values_list("id", "vlans_revision", "vlans_modified")
+                .first()
+            )
+    return request.device_vlans_revision
+
+
+def _device_vlans_etag(request, *args, **kwargs):
+    revision = _device_vlans_revision(request)
+    if revision is None:
+        return None
+    # Other filters and the rendering change the body, not the revision
+    variant = zlib.crc32(
+        f"{request.get_full_path()} {request.META.get('HTTP_ACCEPT', '')}".encode()
+    )
+    return f"{revision[0]}.{revision[1]}.{variant:x}"
+
+
+def _device_vlans_last_modified(request, *args, **kwargs):
+    revision = _device_vlans_revision(request)
+    return revision[2] if revision else None
+
+
+class VlanViewSet(StreamingListMixin, ModelViewSet):
+    # Vlan is serialized with id of the device, so the device isn't joined
+    queryset = Vlan.objects.all()
     serializer_class = VlanSerializer
     filterset_fields = ("id", "tag", "name", "device__name", "device__id")
 
+    @method_decorator(
+        condition(
+            etag_func=_device_vlans_etag, last_modified_func=_device_vlans_last_modified
+        )
+    )
+    def list(self, request, *args, **kwargs):
+        """
+        Vlans of a device, requested with `device__id`, support conditional GET:
+        ETag and Last-Modified come from the vlans revision of the device,
+        so 304 Not Modified costs a single query instead of serializing the vlans
+        """
+        return super().list(request, *args, **kwargs)
+
+    @action(detail=False, methods=["post"])
+    def bulk(self, request):
+        """
+        Creates, updates and deletes vlans in one transaction:
+
+            {"create": [vlan, ...], "update": [vlan with id, ...], "delete": [id, ...]}
+
+        Deletes are applied first, then updates, then creates, so tags and names
+        freed by the request can be reused in it. Sync jobs are submitted once
+        for all the changed devices. A request, which violates uniqueness
+        of tags or names, is rolled back with 409 Conflict, see `_conflict`
+        """
+        serializer = BulkVlanRequestSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            with transaction.atomic(), bulk_vlan_changes():
+                changes = self._bulk_delete(serializer.validated_data["delete"])
+                changes += self._bulk_update(serializer.validated_data["update"])
+                changes += self._bulk_create(serializer.validated_data["create"])
+                VlanChange.log(changes)
+        except IntegrityError as e:
+            return Response(
+                self._conflict(serializer.validated_data, e),
+                status=status.HTTP_409_CONFLICT,
+            )
+
+        device_ids = {device_id for _, _, device_id in changes}
+        if device_ids:
+            vlans_bulk_changed.send(sender=Vlan, device_ids=sorted(device_ids))
+        return Response(
+            {
+                "created": len(serializer.validated_data["create"]),
+                "updated": len(serializer.validated_data["update"]),
+                "deleted": len(serializer.validated_data["delete"]),
+            }
+        )
+
+    @staticmethod
+    def _bulk_delete(vlan_ids: list) -> list:
+        """Deletes vlans with a query per chunk. Returns the changes to log"""
+        deleted = list(Vlan.objects.filter(id__in=vlan_ids))
+        missing = set(vlan_ids) - {vlan.id for vlan in deleted}
+        if missing:
+            raise ValidationError({"delete": f"Vlans not found: {sorted(missing)}"})
+        # Chunks keep the IN clause within the limits of the database
+        for start in range(0, len(vlan_ids), BULK_DELETE_CHUNK_SIZE):
+            chunk = vlan_ids[start : start + BULK_DELETE_CHUNK_SIZE]
+            Vlan.objects.filter(id__in=chunk).delete()
+        return [(VlanChange.Action.DELETE, vlan, vlan.device_id) for vlan in deleted]
+
+    @staticmethod
+    def _bulk_update(updates: list) -> list:
+        """Updates vlans with a single query. Returns the changes to log"""
+        vlans = Vlan.objects.select_for_update().in_bulk(
+            [vlan["id"] for vlan in updates]
+        )
+        missing = {vlan["id"] for vlan in updates} - set(vlans)
+        if missing:
+            raise ValidationError({"update": f"Vlans not found: {sorted(missing)}"})
+        changes = []
+        for update in updates:
+            vlan = vlans[update["id"]]
+            for field, value in update.items():
+                setattr(vlan, field, value)
+            changes += VlanChange.changes_of(
+                vlan, VlanChange.Action.UPDATE, vlan.loaded_device_id
+            )
+        Vlan.objects.bulk_update(
+            vlans.values(), ["tag", "name", "description", "device"]
+        )
+        return changes
+
+    @staticmethod
+    def _bulk_create(creates: list) -> list:
+        """Creates vlans with a single query. Returns the changes to log"""
+        created = Vlan.bulk_create_with_ids([Vlan(**vlan) for vlan in creates])
+        return [(VlanChange.Action.CREATE, vlan, vlan.device_id) for vlan in created]
+
+    @staticmethod
+    def _conflict(data: dict, error: IntegrityError) -> dict:
+        """
+        Describes the vlan of the bulk request, which violated a constraint:
+
+            {"detail": message, "device": id, "field": "tag", "value": 10}
+
+        Looked up after the rollback: constraints are checked by the database
+        for the whole request, so the error doesn't tell which vlan it was.
+        Raises ValidationError if the request refers to unknown devices
+        """
+        vlans = data["update"] + data["create"]
+        device_ids = {vlan["device_id"] for vlan in vlans}
+        unknown = device_ids - set(
+            Device.objects.filter(id__in=device_ids).values_list("id", flat=True)
+        )
+        if unknown:
+            raise ValidationError({"device": f"Devices not found: {sorted(unknown)}"})
+
+        def conflict(vlan: dict, field: str, message: str) -> dict:
+            return {
+                "detail": message,
+                "device": vlan["device_id"],
+                "field": field,
+                "value": vlan[field],
+            }
+
+        # Vlans which are deleted or updated by the request free their tags and names
+        changed_ids = set(data["delete"]) | {vlan["id"] for vlan in data["update"]}
+        taken = {}
+        for vlan in Vlan.objects.filter(device_id__in=device_ids).exclude(
+            id__in=changed_ids
+        ):
+            taken[(vlan.device_id, "tag", vlan.tag)] = vlan
+            taken[(vlan.device_id, "name", vlan.name)] = vlan
+        for vlan in vlans:
+            for field in ("tag", "name"):
+                key = (vlan["device_id"], field, vlan[field])
+                if key in taken:
+                    return conflict(
+                        vlan,
+                        field,
+                        f"Vlan (device {vlan['device_id']}, tag {vlan['tag']})"
+                        f" has the {field} of another vlan of the device",
+                    )
+                taken[key] = vlan
+
+        # Updates are a single query, and the database checks uniqueness
+        # row by row, so a tag or name can't move between updated vlans
+        updated = {}
+        for vlan in Vlan.objects.filter(id__in=[vlan["id"] for vlan in data["update"]]):
+            updated[(vlan.device_id, "tag", vlan.tag)] = vlan.id
+            updated[(vlan.device_id, "name", vlan.name)] = vlan.id
+        for vlan in data["update"]:
+            for field in ("tag", "name"):
+                other_id = updated.get((vlan["device_id"], field, vlan[field]))
+                if other_id is not None and other_id != vlan["id"]:
+                    return conflict(
+                        vlan,
+                        field,
+                        f"Vlan {vlan['id']} takes the {field} of vlan {other_id},"
+                        f" which is updated by the same request. Vlans are"
+                        f" updated at once, so free the {field} by another request",
+                    )
+        logging.warning(f"Bulk vlans request violated a constraint: {error}")
+        return {"detail": "Vlans of the request conflict with other vlans"}
+
+
+class TaskQueuePagination(LimitOffsetPagination):
+    default_limit = 100
+    max_limit = 1000
+
+    def paginate_job_queue(self, request, job_class=SyncJob) -> list:
+        """
+        Returns payloads of the page of jobs waiting in the queue lanes,
+        in priority order. Lanes before the page are skipped by their depth,
+        so only the jobs of the page are fetched
+        """
+        self.request = request
+        self.limit = self.get_limit(request)
+        self.offset = self.get_offset(request)
+        job_queue = job_class.QUEUE_BACKEND()
+        lane_names = job_class.all_lane_names()
+        depths = job_queue.depth(lane_names)
+        self.count = sum(depths)
+
+        payloads = []
+        skip = self.offset
+        for lane_name, depth in zip(lane_names, depths):
+            if len(payloads) >= self.limit:
+                break
+            if skip >= depth:
+                skip -= depth
+                continue
+            payloads += job_queue.list(
+                lane_name, skip, skip + self.limit - len(payloads) - 1
+            )
+            skip = 0
+        return payloads[: self.limit]
+
 
 class RpcListTaskQueueView(APIView):
+    """Jobs waiting in the queue. Paginated with `limit` and `offset` parameters"""
+
+    def get(self, request):
+        paginator = TaskQueuePagination()
+        job_list = paginator.paginate_job_queue(request)
+        job_list_json = [SyncJob.from_payload(job).to_dict() for job in job_list]
+        return paginator.get_paginated_response(job_list_json)
+
+
+class RpcQueueMetricsView(APIView):
+    """Depth, lag and throughput of the job queue"""
+
+    def get(self, request):
+        return Response(collect_queue_metrics())
+
+
+class QueueMetricsPrometheusView(APIView):
+    """Same as RpcQueueMetricsView, in Prometheus text format for scraping"""
+
     def get(self, request):
-        job_queue = RedisJobQueue()
-        job_list = job_queue.list("queue:sync", 0, 100)
-        job_list_json = [json.loads(job) for job in job_list]
-        return Response(job_list_json)
+        return HttpResponse(
+            render_prometheus(collect_queue_metrics()),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
@@ -0,0 +1,264 @@
+"""
+Streaming import and export of devices and vlans as CSV or JSON lines,
+see the `import_inventory` and `export_inventory` commands.
+
+Rows are read, written and stored a batch at a time, so memory doesn't grow
+with the size of the file. Devices are referenced by name, so files
+can be moved between installations:
+
+    devices: name, management_ip
+    vlans: device, tag, name, description
+"""
+
+import csv
+import itertools
+import json
+from typing import Iterable, Iterator, List
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_ipv4_address
+from django.db import IntegrityError, transaction
+from django.db.models import Q, QuerySet
+
+from .models import Device, Vlan, VlanChange
+
+FORMATS = ("csv", "jsonl")
+FIELDS = {
+    "devices": ("name", "management_ip"),
+    "vlans": ("device", "tag", "name", "description"),
+}
+REQUIRED_FIELDS = {
+    "devices": {"name", "management_ip"},
+    "vlans": {"device", "tag", "name"},
+}
+DEFAULT_BATCH_SIZE = 1000
+
+
+class InventoryError(Exception):
+    pass
+
+
+def guess_format(path: str) -> str:
+    """Format of the file by its extension, CSV if it's unknown"""
+    if path.endswith((".jsonl", ".json")):
+        return "jsonl"
+    return "csv"
+
+
+def read_rows(stream, fmt: str) -> Iterator[dict]:
+    if fmt == "csv":
+        yield from csv.DictReader(stream)
+        return
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def write_rows(stream, fmt: str, fields: tuple, rows: Iterable[tuple]) -> int:
+    """Writes the rows of `fields` values. Returns the number of written rows"""
+    count = 0
+    if fmt == "csv":
+        writer = csv.writer(stream, lineterminator="\n")
+        writer.writerow(fields)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    else:
+        for row in rows:
+            stream.write(json.dumps(dict(zip(fields, row))) + "\n")
+            count += 1
+    return count
+
+
+def batches(rows: Iterable, size: int) -> Iterator[List]:
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def iterate_rows_in_chunks(
+    queryset: QuerySet, key_fields: tuple, chunk_size: int
+) -> Iterator[List[tuple]]:
+    """
+    Yields lists of `values_list` rows ordered by `key_fields`, a query per list.
+    Key must be unique and its fields must be the first values of the rows.
+    Unlike `queryset.iterator()`, every query fetches only its chunk,
+    see `api.iterate_in_chunks`
+    """
+    queryset = queryset.order_by(*key_fields)
+    chunk = list(queryset[:chunk_size])
+    while chunk:
+        yield chunk
+        last = chunk[-1]
+        # Rows after the last one: greater in the first field, or equal
+        # in the first fields and greater in the next one
+        after = Q()
+        for i, field in enumerate(key_fields):
+            after |= Q(**dict(zip(key_fields[:i], last)), **{f"{field}__gt": last[i]})
+        chunk = list(queryset.filter(after)[:chunk_size])
+
+
+def export_rows(model: str, batch_size: int = DEFAULT_BATCH_SIZE, devices=None):
+    """
+    Rows of the devices or vlans, ordered so the exports can be compared.
+    Rows are fetched from the database in chunks of `batch_size`
+
+    Args:
+        devices (optional): names of the devices to export, all if not given
+    """
+    if model == "devices":
+        queryset = Device.objects.values_list(*FIELDS[model])
+        if devices:
+            queryset = queryset.filter(name__in=devices)
+        key_fields = ("name",)
+    else:
+        queryset = Vlan.objects.values_list(
+            "device__name", "tag", "name", "description"
+        )
+        if devices:
+            queryset = queryset.filter(device__name__in=devices)
+        key_fields = ("device__name", "tag")
+    for chunk in iterate_rows_in_chunks(queryset, key_fields, batch_size):
+        for row in chunk:
+            if model == "vlans" and row[-1] is None:
+                # CSV has no null, empty description is read back as None
+                row = row[:-1] + ("",)
+            yield row
+
+
+class InventoryImporter:
+    """
+    Creates and updates devices and vlans from rows, a batch per transaction.
+
+    Devices are matched by name and vlans by device and tag, so importing
+    the same file again changes nothing. Nothing is deleted. Bulk queries
+    send no model signals, so vlan changes are logged here, and the caller
+    submits sync jobs for `changed_device_ids` once the import is done.
+    """
+
+    def __init__(self, batch_size: int = DEFAULT_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.rows = 0
+        self.created = 0
+        self.updated = 0
+        # Devices with changed management IP, and devices with changed vlans
+        self.updated_device_ids = set()
+        self.changed_device_ids = set()
+        # Device name -> id, so names are resolved once per import
+        self._device_ids = {}
+
+    @property
+    def unchanged(self) -> int:
+        return self.rows - self.created - self.updated
+
+    def import_rows(self, model: str, rows: Iterable[dict]):
+        import_batch = (
+            self._import_devices if model == "devices" else self._import_vlans
+        )
+        for batch in batches(rows, self.batch_size):
+            first_row = self.rows + 1
+            try:
+                with transaction.atomic():
+                    created, updated, device_ids = import_batch(
+                        [
+                            self._parse(model, row, first_row + i)
+                            for i, row in enumerate(batch)
+                        ]
+                    )
+            except IntegrityError as e:
+                raise InventoryError(
+                    f"Rows {first_row}-{first_row + len(batch) - 1}: {e}"
+                )
+            # Counted once the batch is committed, so a failed import
+            # reports and announces the committed batches only
+            self.rows += len(batch)
+            self.created += created
+            self.updated += updated
+            if model == "devices":
+                self.updated_device_ids |= device_ids
+            else:
+                self.changed_device_ids |= device_ids
+
+    @staticmethod
+    def _parse(model: str, row: dict, row_number: int) -> dict:
+        missing = REQUIRED_FIELDS[model] - {
+            field for field, value in row.items() if value not in (None, "")
+        }
+        if missing:
+            raise InventoryError(f"Row {row_number}: missing {sorted(missing)}")
+        try:
+            if model == "devices":
+                validate_ipv4_address(row["management_ip"])
+                return {"name": row["name"], "management_ip": row["management_ip"]}
+            return {
+                "device": row["device"],
+                "tag": int(row["tag"]),
+                "name": row["name"],
+                "description": row.get("description") or None,
+            }
+        except (ValidationError, ValueError) as e:
+            raise InventoryError(f"Row {row_number}: {e}")
+
+    def _import_devices(self, rows: List[dict]) -> tuple:
+        """Returns numbers of created and updated devices, and updated device ids"""
+        devices = Device.objects.in_bulk(
+            {row["name"] for row in rows}, field_name="name"
+        )
+        created, updated = [], {}
+        for row in rows:
+            device = devices.get(row["name"])
+            if device is None:
+                devices[row["name"]] = Device(**row)
+                created.append(devices[row["name"]])
+            elif device.management_ip != row["management_ip"]:
+                device.management_ip = row["management_ip"]
+                if device.id is not None:
+                    updated[device.id] = device
+        Device.objects.bulk_create(created)
+        Device.objects.bulk_update(updated.values(), ["management_ip"])
+        return len(created), len(updated), set(updated)
+
+    def _resolve_devices(self, names: set):
+        missing = names - set(self._device_ids)
+        if missing:
+            self._device_ids.update(
+                Device.objects.filter(name__in=missing).values_list("name", "id")
+            )
+        unknown = names - set(self._device_ids)
+        if unknown:
+            raise InventoryError(f"Devices not found: {sorted(unknown)}")
+
+    def _import_vlans(self, rows: List[dict]) -> tuple:
+        """Returns numbers of created and updated vlans, and their device ids"""
+        self._resolve_devices({row["device"] for row in rows})
+        for row in rows:
+            row["device_id"] = self._device_ids[row.pop("device")]
+        vlans = {
+            (vlan.device_id, vlan.tag): vlan
+            for vlan in Vlan.objects.select_for_update().filter(
+                device_id__in={row["device_id"] for row in rows},
+                tag__in={row["tag"] for row in rows},
+            )
+        }
+        created, updated = [], {}
+        for row in rows:
+            vlan = vlans.get((row["device_id"], row["tag"]))
+            if vlan is None:
+                vlans[(row["device_id"], row["tag"])] = Vlan(**row)
+                created.append(vlans[(row["device_id"], row["tag"])])
+            elif (vlan.name, vlan.description) != (row["name"], row["description"]):
+                vlan.name = row["name"]
+                vlan.description = row["description"]
+                if vlan.id is not None:
+                    updated[vlan.id] = vlan
+        Vlan.objects.bulk_update(updated.values(), ["name", "description"])
+        Vlan.bulk_create_with_ids(created)
+        changes = [
+            (VlanChange.Action.UPDATE, vlan, vlan.device_id)
+            for vlan in updated.values()
+        ] + [(VlanChange.Action.CREATE, vlan, vlan.device_id) for vlan in created]
+        VlanChange.log(changes)
+        return len(created), len(updated), {device_id for _, _, device_id in changes}
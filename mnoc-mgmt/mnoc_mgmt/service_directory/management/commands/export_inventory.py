@@ -0,0 +1,54 @@
+import time
+
+from django.core.management.base import BaseCommand
+from service_directory.inventory import (
+    DEFAULT_BATCH_SIZE,
+    FIELDS,
+    FORMATS,
+    export_rows,
+    guess_format,
+    write_rows,
+)
+
+
+class Command(BaseCommand):
+    help = "Writes devices or vlans to a CSV or JSON lines file"
+
+    def add_arguments(self, parser):
+        parser.add_argument("model", choices=sorted(FIELDS))
+        parser.add_argument(
+            "path", nargs="?", default="-", help="File to write, stdout by default"
+        )
+        parser.add_argument(
+            "--format", choices=FORMATS, help="Format of the file, by its extension"
+        )
+        parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument(
+            "--device",
+            action="append",
+            dest="devices",
+            help="Name of the device to export, or of the device of vlans to export."
+            " Can be repeated. All devices by default",
+        )
+
+    def handle(self, *args, **options):
+        model = options["model"]
+        path = options["path"]
+        fmt = options["format"] or guess_format(path)
+        rows = export_rows(model, options["batch_size"], options["devices"])
+
+        started = time.monotonic()
+        if path == "-":
+            count = write_rows(self.stdout, fmt, FIELDS[model], rows)
+            # Stdout is the export, so the report goes to stderr
+            report = self.stderr
+        else:
+            with open(path, "w", newline="") as stream:
+                count = write_rows(stream, fmt, FIELDS[model], rows)
+            report = self.stdout
+        elapsed = time.monotonic() - started
+
+        report.write(
+            f"Exported {count} {model} in {elapsed:.1f}s"
+            f" ({count / max(elapsed, 1e-6):.0f} rows/s)"
+        )
@@ -0,0 +1,70 @@
+import csv
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from mnoc_jobtools.events import publish_device_changed
+from service_directory.inventory import (
+    DEFAULT_BATCH_SIZE,
+    FIELDS,
+    FORMATS,
+    InventoryError,
+    InventoryImporter,
+    guess_format,
+    read_rows,
+)
+from service_directory.signals import submit_all_vlans_sync_jobs
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates and updates devices or vlans from a CSV or JSON lines file. "
+        "Sync jobs are submitted once for every device with changed vlans"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("model", choices=sorted(FIELDS))
+        parser.add_argument("path", help="File to import, '-' for stdin")
+        parser.add_argument(
+            "--format", choices=FORMATS, help="Format of the file, by its extension"
+        )
+        parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument(
+            "--no-sync",
+            action="store_true",
+            help="Don't submit sync jobs for the devices with changed vlans",
+        )
+
+    def handle(self, *args, **options):
+        model = options["model"]
+        path = options["path"]
+        fmt = options["format"] or guess_format(path)
+        importer = InventoryImporter(batch_size=options["batch_size"])
+
+        started = time.monotonic()
+        stream = sys.stdin if path == "-" else open(path, newline="")
+        try:
+            importer.import_rows(model, read_rows(stream, fmt))
+        except (InventoryError, ValueError, csv.Error) as e:
+            raise CommandError(f"Import stopped after {importer.rows} rows: {e}")
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+            # Batches committed before a failed one stay, so they are announced too
+            self.announce_changes(importer, sync=not options["no_sync"])
+        elapsed = time.monotonic() - started
+
+        self.stdout.write(
+            f"Imported {importer.rows} {model} in {elapsed:.1f}s"
+            f" ({importer.rows / max(elapsed, 1e-6):.0f} rows/s):"
+            f" {importer.created} created, {importer.updated} updated,"
+            f" {importer.unchanged} unchanged"
+        )
+
+    @staticmethod
+    def announce_changes(importer: InventoryImporter, sync: bool):
+        """Bulk queries send no signals, so changes are announced once per device"""
+        for device_id in sorted(importer.updated_device_ids):
+            publish_device_changed(device_id)
+        if importer.changed_device_ids and sync:
+            submit_all_vlans_sync_jobs(sorted(importer.changed_device_ids))
@@ -1,6 +1,6 @@
 from django.core.management.base import BaseCommand, CommandError
 from service_directory.models import Device
-from service_directory.signals import submit_all_vlans_sync_job
+from service_directory.signals import submit_all_vlans_sync_jobs
 
 
 class Command(BaseCommand):
@@ -10,10 +10,12 @@ class Command(BaseCommand):
         parser.add_argument("device_ids", nargs="+", type=int)
 
     def handle(self, *args, **options):
-        for device_id in options["poll_ids"]:
-            try:
-                Device.objects.get(pk=device_id)
-            except Device.DoesNotExist:
+        device_ids = options["device_ids"]
+        existing_ids = set(
+            Device.objects.filter(pk__in=device_ids).values_list("pk", flat=True)
+        )
+        for device_id in device_ids:
+            if device_id not in existing_ids:
                 raise CommandError(f"Device with id {device_id} doesn't exist")
 
-            submit_all_vlans_sync_job(device_id)
+        submit_all_vlans_sync_jobs(device_ids)
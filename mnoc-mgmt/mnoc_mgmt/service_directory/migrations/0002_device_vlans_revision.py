@@ -0,0 +1,23 @@
+# Generated by Django 3.1.1 on 2026-10-17 17:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('service_directory', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='vlans_modified',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='vlans_revision',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 3.1.1 on 2026-10-17 17:48
+
+from django.db import migrations, models
+from django.db.models import F
+from django.utils import timezone
+
+
+def log_existing_vlans(apps, schema_editor):
+    """
+    Vlans created before the log are logged as created at the next revision
+    of their device, so changes since revision 0 are all the vlans
+    """
+    Device = apps.get_model("service_directory", "Device")
+    Vlan = apps.get_model("service_directory", "Vlan")
+    VlanChange = apps.get_model("service_directory", "VlanChange")
+    device_ids = set(Vlan.objects.values_list("device_id", flat=True))
+    Device.objects.filter(id__in=device_ids).update(
+        vlans_revision=F("vlans_revision") + 1, vlans_modified=timezone.now()
+    )
+    revisions = dict(
+        Device.objects.filter(id__in=device_ids).values_list("id", "vlans_revision")
+    )
+    VlanChange.objects.bulk_create(
+        (
+            VlanChange(
+                device_id=vlan.device_id,
+                revision=revisions[vlan.device_id],
+                action="create",
+                vlan_id=vlan.id,
+                tag=vlan.tag,
+                name=vlan.name,
+                description=vlan.description,
+            )
+            for vlan in Vlan.objects.iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('service_directory', '0002_device_vlans_revision'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VlanChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('device_id', models.PositiveIntegerField()),
+                ('revision', models.PositiveIntegerField()),
+                ('action', models.CharField(choices=[('create', 'Create'), ('update', 'Update'), ('delete', 'Delete')], max_length=8)),
+                ('vlan_id', models.PositiveIntegerField()),
+                ('tag', models.PositiveSmallIntegerField()),
+                ('name', models.CharField(max_length=64)),
+                ('description', models.CharField(blank=True, max_length=128, null=True)),
+                ('changed', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ('id',),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='vlanchange',
+            index=models.Index(fields=['device_id', 'revision'], name='service_dir_device__5ffd33_idx'),
+        ),
+        migrations.RunPython(log_existing_vlans, migrations.RunPython.noop),
+    ]
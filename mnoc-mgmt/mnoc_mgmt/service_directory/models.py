@@ -1,4 +1,6 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from django.utils import timezone
 
 
 class Device(models.Model):
@@ -6,10 +8,31 @@ class Device(models.Model):
     management_ip = models.GenericIPAddressField(
         protocol="ipv4", verbose_name="Management IPv4", db_index=True
     )
+    # Incremented on every change of the device vlans, so clients can tell
+    # whether vlans of the device changed without fetching them
+    vlans_revision = models.PositiveIntegerField(default=0, editable=False)
+    vlans_modified = models.DateTimeField(null=True, blank=True, editable=False)
 
     def __str__(self):
         return f"{self.name} [{self.management_ip}]"
 
+    @classmethod
+    def bump_vlans_revision(cls, device_ids) -> dict:
+        """
+        Marks vlans of the devices as changed. Returns new revisions by device id.
+        Devices stay locked by the update till the end of the transaction,
+        so concurrent changes of the device get the next revisions
+        """
+        with transaction.atomic(savepoint=False):
+            cls.objects.filter(id__in=device_ids).update(
+                vlans_revision=F("vlans_revision") + 1, vlans_modified=timezone.now()
+            )
+            return dict(
+                cls.objects.filter(id__in=device_ids).values_list(
+                    "id", "vlans_revision"
+                )
+            )
+
 
 class Vlan(models.Model):
     tag = models.PositiveSmallIntegerField()
@@ -22,3 +45,115 @@ class Vlan(models.Model):
 
     def __str__(self):
         return f"{self.name} [{self.tag}]"
+
+    def save(self, *args, **kwargs):
+        # The change is logged by post_save, in the same transaction as the vlan
+        with transaction.atomic(savepoint=False):
+            super().save(*args, **kwargs)
+
+    @classmethod
+    def bulk_create_with_ids(cls, vlans: list) -> list:
+        """
+        Same as `bulk_create`, but ids of the created vlans are always set.
+        MySQL doesn't return ids of the created rows,
+        so they are looked up by the unique device and tag
+        """
+        created = cls.objects.bulk_create(vlans)
+        missing_ids = [vlan for vlan in created if vlan.id is None]
+        if missing_ids:
+            ids = {
+                (device_id, tag): vlan_id
+                for vlan_id, device_id, tag in cls.objects.filter(
+                    device_id__in={vlan.device_id for vlan in missing_ids},
+                    tag__in={vlan.tag for vlan in missing_ids},
+                ).values_list("id", "device_id", "tag")
+            }
+            for vlan in missing_ids:
+                vlan.id = ids[(vlan.device_id, vlan.tag)]
+        return created
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        vlan = super().from_db(db, field_names, values)
+        # Device the vlan was loaded with, so moving the vlan
+        # to another device changes vlans of both
+        vlan.loaded_device_id = vlan.__dict__.get("device_id")
+        return vlan
+
+
+class VlanChange(models.Model):
+    """
+    Append-only log of vlan changes, so consumers can fetch only the changes
+    after the vlans revision of the device they have seen.
+    Changes are logged in the same transaction as the vlans,
+    under the revision of the device the transaction has made.
+    """
+
+    class Action(models.TextChoices):
+        CREATE = "create"
+        UPDATE = "update"
+        DELETE = "delete"
+
+    # Not a foreign key: vlans of a device being deleted are logged
+    # while the device is deleted, see signals.delete_vlan_changes
+    device_id = models.PositiveIntegerField()
+    revision = models.PositiveIntegerField()
+    action = models.CharField(max_length=8, choices=Action.choices)
+    # Vlan as it is after the change, or before it for deletes
+    vlan_id = models.PositiveIntegerField()
+    tag = models.PositiveSmallIntegerField()
+    name = models.CharField(max_length=64)
+    description = models.CharField(max_length=128, blank=True, null=True)
+    changed = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ("id",)
+        indexes = [models.Index(fields=("device_id", "revision"))]
+
+    def __str__(self):
+        return f"{self.action} {self.name} [{self.tag}] r{self.revision}"
+
+    @classmethod
+    def log(cls, changes: list):
+        """
+        Bumps vlans revisions of the devices and logs the changes under them.
+
+        Args:
+            changes: (action, vlan, device id) of every change. Device id is
+                given separately, see `changes_of`
+        """
+        if not changes:
+            return
+        with transaction.atomic(savepoint=False):
+            revisions = Device.bump_vlans_revision(
+                {device_id for _, _, device_id in changes}
+            )
+            cls.objects.bulk_create(
+                cls(
+                    device_id=device_id,
+                    revision=revisions[device_id],
+                    action=action,
+                    vlan_id=vlan.id,
+                    tag=vlan.tag,
+                    name=vlan.name,
+                    description=vlan.description,
+                )
+                for action, vlan, device_id in changes
+                if device_id in revisions
+            )
+
+    @classmethod
+    def changes_of(cls, vlan: "Vlan", action: str, old_device_id: int = None):
+        """
+        Returns log entries of the vlan change for `log`.
+        Vlan moved to another device is deleted from the old one
+        and created at the new one
+        """
+        if action == cls.Action.DELETE:
+            return [(action, vlan, old_device_id or vlan.device_id)]
+        if action == cls.Action.UPDATE and old_device_id not in (None, vlan.device_id):
+            return [
+                (cls.Action.DELETE, vlan, old_device_id),
+                (cls.Action.CREATE, vlan, vlan.device_id),
+            ]
+        return [(action, vlan, vlan.device_id)]
@@ -1,6 +1,6 @@
 from rest_framework import serializers
 
-from .models import Device, Vlan
+from .models import Device, Vlan, VlanChange
 
 
 class DeviceSerializer(serializers.ModelSerializer):
@@ -13,3 +13,35 @@ class VlanSerializer(serializers.ModelSerializer):
     class Meta:
         model = Vlan
         fields = "__all__"
+
+
+class VlanChangeSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = VlanChange
+        exclude = ("device_id",)
+
+
+class BulkVlanSerializer(serializers.ModelSerializer):
+    """
+    Vlan of the bulk request. Device and uniqueness are enforced by the database
+    for the whole request, instead of a query per vlan
+    """
+
+    id = serializers.IntegerField(required=False)
+    device = serializers.IntegerField(source="device_id")
+
+    class Meta:
+        model = Vlan
+        fields = ("id", "tag", "name", "description", "device")
+        validators = []
+
+
+class BulkVlanRequestSerializer(serializers.Serializer):
+    create = BulkVlanSerializer(many=True, default=list)
+    update = BulkVlanSerializer(many=True, default=list)
+    delete = serializers.ListField(child=serializers.IntegerField(), default=list)
+
+    def validate_update(self, value):
+        if any("id" not in vlan for vlan in value):
+            raise serializers.ValidationError("Updated vlans must have an id")
+        return value
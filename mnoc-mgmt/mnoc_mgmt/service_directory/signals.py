@@ -1,31 +1,166 @@
+import functools
 import logging
+import threading
+import weakref
+from contextlib import contextmanager
 
+from django.db import DEFAULT_DB_ALIAS, transaction
 from django.db.models.signals import post_save, post_delete
-from django.dispatch import receiver
+from django.dispatch import Signal, receiver
 
-from mnoc_jobtools.tools import SyncJob, SyncJobException
-from .models import Vlan
+from mnoc_jobtools.events import publish_device_changed
+from mnoc_jobtools.tools import JobPriority, SyncJob, SyncJobException
+from .models import Device, Vlan, VlanChange
 
 
 logging.basicConfig(
     level=logging.DEBUG, format="%(asctime)s %(levelname)-8s %(message)s"
 )
 
+# Sent once by the bulk vlan endpoint with `device_ids` of all the changed vlans,
+# as bulk ORM operations don't send post_save/post_delete per vlan
+vlans_bulk_changed = Signal()
+# Set while the bulk vlan endpoint changes vlans, see `bulk_vlan_changes`
+_bulk_changes = threading.local()
+
+
+@contextmanager
+def bulk_vlan_changes():
+    """
+    Vlan receivers ignore the vlans changed within the block:
+    the bulk endpoint logs the changes of the whole request at once
+    and sends `vlans_bulk_changed` for them
+    """
+    _bulk_changes.active = True
+    try:
+        yield
+    finally:
+        _bulk_changes.active = False
+
 
 @receiver(
     [post_save, post_delete],
     sender=Vlan,
-    dispatch_uid="service_directory.signals.submit_vlan_sync_job",
+    dispatch_uid="service_directory.signals.vlan_changed",
+)
+def vlan_changed(sender, instance: Vlan, signal, created=False, **kwargs):
+    if getattr(_bulk_changes, "active", False):
+        return
+    # Vlan.save and deletes run the receivers inside the transaction of the change,
+    # so the change is logged in it, and sync jobs wait for it to commit
+    if signal is post_delete:
+        action = VlanChange.Action.DELETE
+    elif created:
+        action = VlanChange.Action.CREATE
+    else:
+        action = VlanChange.Action.UPDATE
+    old_device_id = getattr(instance, "loaded_device_id", None)
+    changes = VlanChange.changes_of(instance, action, old_device_id)
+    VlanChange.log(changes)
+    instance.loaded_device_id = instance.device_id
+    PendingVlanSyncJobs.add({device_id for _, _, device_id in changes})
+
+
+@receiver(
+    post_delete,
+    sender=Device,
+    dispatch_uid="service_directory.signals.delete_vlan_changes",
+)
+def delete_vlan_changes(sender, instance: Device, **kwargs):
+    VlanChange.objects.filter(device_id=instance.id).delete()
+
+
+@receiver(
+    [post_save, post_delete],
+    sender=Device,
+    dispatch_uid="service_directory.signals.publish_device_change",
 )
-def submit_vlan_sync_job(sender, instance: Vlan, **kwargs):
-    submit_all_vlans_sync_job(device_id=instance.device.id)
+def publish_device_change(sender, instance: Device, **kwargs):
+    # Lets mnoc-sync drop the cached management IP of the device,
+    # once the change is visible to it
+    transaction.on_commit(functools.partial(publish_device_changed, instance.id))
+
+
+@receiver(
+    vlans_bulk_changed,
+    dispatch_uid="service_directory.signals.submit_bulk_vlan_sync_jobs",
+)
+def submit_bulk_vlan_sync_jobs(sender, device_ids: list, **kwargs):
+    PendingVlanSyncJobs.add(device_ids)
+
+
+class PendingVlanSyncJobs:
+    """
+    Devices with vlans changed by the current transaction, to submit
+    a sync job for every device once the transaction is committed.
+
+    Jobs aren't submitted while the transaction is open, so workers don't read
+    vlans before they are committed, and no Redis I/O is done under the locks
+    of the transaction. A transaction changing many vlans of a device submits
+    a single job for it. Pending jobs are dropped if the transaction is rolled
+    back. Outside of a transaction, jobs are submitted right away.
+    """
+
+    # Pending jobs of the open transaction by database, per thread. Only
+    # on_commit holds them, so rollback drops the callback together with
+    # the entry, and the callback removes the entry once it's run
+    _registry = threading.local()
+
+    def __init__(self, using: str):
+        self.using = using
+        self.device_ids = set()
+
+    @classmethod
+    def _pending_jobs(cls) -> weakref.WeakValueDictionary:
+        if not hasattr(cls._registry, "pending_jobs"):
+            cls._registry.pending_jobs = weakref.WeakValueDictionary()
+        return cls._registry.pending_jobs
+
+    def __call__(self):
+        self._pending_jobs().pop(self.using, None)
+        # Devices deleted by the transaction have nothing to sync
+        device_ids = sorted(
+            Device.objects.filter(id__in=self.device_ids).values_list("id", flat=True)
+        )
+        if not device_ids:
+            return
+        logging.warning(f"Vlan data for the device ids {device_ids} has changed")
+        # Vlans are changed by operators, who are waiting for the result
+        submit_all_vlans_sync_jobs(device_ids, priority=JobPriority.HIGH)
+
+    @classmethod
+    def add(cls, device_ids, using: str = None):
+        # Callback registered in a savepoint is dropped when it's rolled back,
+        # together with the changes made in it. So devices changed after the
+        # savepoint was entered can be added to a callback registered before,
+        # at worst submitting a job for a change which was rolled back
+        using = using or DEFAULT_DB_ALIAS
+        pending_jobs = cls._pending_jobs()
+        pending = pending_jobs.get(using)
+        if pending is not None:
+            pending.device_ids.update(device_ids)
+            return
+        pending = pending_jobs[using] = cls(using)
+        pending.device_ids.update(device_ids)
+        # Runs right away outside of a transaction
+        transaction.on_commit(pending, using=using)
 
 
-def submit_all_vlans_sync_job(device_id: int):
+def submit_all_vlans_sync_jobs(
+    device_ids: list, priority: JobPriority = JobPriority.LOW
+):
+    """Bulk submission is a reconcile, so it mustn't delay interactive jobs"""
     try:
-        logging.warning(f"Vlan data for the device id {device_id} has changed")
-        job = SyncJob(device_id=device_id, sync_from="db", sync_to="device")
-        job.put_to_queue()
-        logging.warning(f"Job has been submitted: {job}")
+        jobs = [
+            SyncJob(
+                device_id=device_id,
+                sync_from="db",
+                sync_to="device",
+                priority=priority,
+            )
+            for device_id in device_ids
+        ]
+        SyncJob.put_many(jobs, coalesce=True)
+        logging.warning(f"{len(jobs)} jobs have been submitted")
     except SyncJobException:
-        logging.exception("Failed to submit sync job")
+        logging.exception("Failed to submit sync jobs")
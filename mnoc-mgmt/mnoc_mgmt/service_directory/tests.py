@@ -1,3 +1,291 @@
-from django.test import TestCase
+import json
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.core.management import CommandError, call_command
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+from rest_framework.test import APITestCase
+
+from .api import DeviceViewSet
+from .inventory import export_rows
+from .models import Device, Vlan, VlanChange
+
+
+def streamed_json(response):
+    return json.loads(b"".join(response.streaming_content))
+
+
+class PendingVlanSyncJobsTest(TransactionTestCase):
+    """on_commit callbacks only run when the transaction is committed,
+    so these tests can't run inside of the TestCase transaction"""
+
+    def setUp(self):
+        self.device = Device.objects.create(name="d1", management_ip="10.0.0.1")
+        self.other_device = Device.objects.create(name="d2", management_ip="10.0.0.2")
+        patcher = mock.patch("service_directory.signals.submit_all_vlans_sync_jobs")
+        self.submit = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def submitted(self) -> list:
+        return [call.args[0] for call in self.submit.call_args_list]
+
+    def test_one_job_per_device_after_commit(self):
+        with transaction.atomic():
+            for tag in range(10, 15):
+                Vlan.objects.create(name=f"v{tag}", tag=tag, device=self.device)
+            Vlan.objects.create(name="v10", tag=10, device=self.other_device)
+            self.assertEqual(self.submitted(), [])
+        self.assertEqual(
+            self.submitted(), [sorted([self.device.id, self.other_device.id])]
+        )
+
+    def test_no_job_on_rollback(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                Vlan.objects.create(name="v10", tag=10, device=self.device)
+                raise RuntimeError
+        self.assertEqual(self.submitted(), [])
+        # Next transaction doesn't pick up the devices of the rolled back one
+        Vlan.objects.create(name="v20", tag=20, device=self.other_device)
+        self.assertEqual(self.submitted(), [[self.other_device.id]])
+
+    def test_deleted_device_is_dropped(self):
+        with transaction.atomic():
+            Vlan.objects.create(name="v10", tag=10, device=self.device)
+            Vlan.objects.create(name="v10", tag=10, device=self.other_device)
+            self.other_device.delete()
+        self.assertEqual(self.submitted(), [[self.device.id]])
+
+
+class InventoryTest(TestCase):
+    def test_export_in_chunks_keeps_order(self):
+        for name in ("d3", "d1", "d2"):
+            device = Device.objects.create(name=name, management_ip="10.0.0.1")
+            for tag in (30, 10, 20):
+                Vlan.objects.create(name=f"v{tag}", tag=tag, device=device)
+        vlans = list(export_rows("vlans", batch_size=2))
+        self.assertEqual(
+            [(device, tag) for device, tag, _, _ in vlans],
+            [(f"d{i}", tag) for i in (1, 2, 3) for tag in (10, 20, 30)],
+        )
+        self.assertEqual(vlans[0], ("d1", 10, "v10", ""))
+        devices = list(export_rows("devices", batch_size=2, devices=["d3", "d1"]))
+        self.assertEqual(devices, [("d1", "10.0.0.1"), ("d3", "10.0.0.1")])
+
+    @mock.patch(
+        "service_directory.management.commands.import_inventory"
+        ".submit_all_vlans_sync_jobs"
+    )
+    def test_committed_batches_are_synced_when_import_fails(self, submit):
+        device = Device.objects.create(name="d1", management_ip="10.0.0.1")
+        with tempfile.NamedTemporaryFile("w", suffix=".csv") as stream:
+            stream.write("device,tag,name\nd1,10,v10\nd1,20,v20\nd2,30,v30\n")
+            stream.flush()
+            with self.assertRaises(CommandError):
+                call_command("import_inventory", "vlans", stream.name, batch_size=2)
+        self.assertEqual(Vlan.objects.count(), 2)
+        submit.assert_called_once_with([device.id])
+
+
+class VlanListConditionalGetTest(APITestCase):
+    url = "/service_directory/api/vlans/"
+
+    def setUp(self):
+        self.device = Device.objects.create(name="d1", management_ip="10.0.0.1")
+        self.vlan = Vlan.objects.create(name="v10", tag=10, device=self.device)
+
+    def get(self, **headers):
+        return self.client.get(
+            self.url,
+            {"device__id": self.device.id},
+            HTTP_ACCEPT="application/json",
+            **headers,
+        )
+
+    def test_not_modified(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Last-Modified", response)
+        response = self.get(HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_stale_etag_after_vlan_save(self):
+        etag = self.get()["ETag"]
+        self.vlan.name = "v10-renamed"
+        self.vlan.save()
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        vlans = streamed_json(response)
+        self.assertEqual([vlan["name"] for vlan in vlans], ["v10-renamed"])
+
+    def test_no_etag_without_device(self):
+        response = self.client.get(self.url, HTTP_ACCEPT="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("ETag", response)
+
+
+class VlanChangesFeedTest(APITestCase):
+    def setUp(self):
+        self.device = Device.objects.create(name="d1", management_ip="10.0.0.1")
+        self.url = f"/service_directory/api/devices/{self.device.id}/vlan_changes/"
+
+    def changes(self, since=None) -> dict:
+        params = {} if since is None else {"since": since}
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_changes_since_revision(self):
+        vlan = Vlan.objects.create(name="v10", tag=10, device=self.device)
+        feed = self.changes()
+        self.assertEqual(feed["revision"], 1)
+        self.assertEqual(
+            [(c["action"], c["tag"]) for c in feed["changes"]], [("create", 10)]
+        )
+
+        vlan.description = "uplink"
+        vlan.save()
+        vlan.delete()
+        feed = self.changes(since=feed["revision"])
+        self.assertEqual(feed["revision"], 3)
+        self.assertEqual(
+            [(c["action"], c["revision"]) for c in feed["changes"]],
+            [("update", 2), ("delete", 3)],
+        )
+        self.assertEqual(feed["changes"][0]["description"], "uplink")
+
+        feed = self.changes(since=feed["revision"])
+        self.assertEqual(feed, {"revision": 3, "changes": []})
+
+    def test_other_devices_changes_excluded(self):
+        other_device = Device.objects.create(name="d2", management_ip="10.0.0.2")
+        Vlan.objects.create(name="v10", tag=10, device=other_device)
+        self.assertEqual(self.changes(), {"revision": 0, "changes": []})
+
+    def test_invalid_since(self):
+        response = self.client.get(self.url, {"since": "yesterday"})
+        self.assertEqual(response.status_code, 400)
+
+
+class StreamingListTest(APITestCase):
+    url = "/service_directory/api/devices/"
+
+    def setUp(self):
+        for i in range(5):
+            Device.objects.create(name=f"d{i}", management_ip=f"10.0.0.{i}")
+
+    def test_list_is_streamed_in_chunks(self):
+        with mock.patch.object(DeviceViewSet, "stream_chunk_size", 2):
+            response = self.client.get(self.url, HTTP_ACCEPT="application/json")
+            self.assertTrue(response.streaming)
+            devices = streamed_json(response)
+        self.assertEqual(
+            [device["name"] for device in devices], [f"d{i}" for i in range(5)]
+        )
+
+    def test_empty_list_is_streamed(self):
+        Device.objects.all().delete()
+        response = self.client.get(self.url, HTTP_ACCEPT="application/json")
+        self.assertEqual(streamed_json(response), [])
+
+    def test_filters_apply_to_stream(self):
+        response = self.client.get(
+            self.url, {"name": "d3"}, HTTP_ACCEPT="application/json"
+        )
+        self.assertEqual([device["name"] for device in streamed_json(response)], ["d3"])
+
+    def test_page_size_returns_cursor_pages(self):
+        names = []
+        response = self.client.get(self.url, {"page_size": 2})
+        while True:
+            self.assertFalse(response.streaming)
+            page = response.json()
+            self.assertLessEqual(len(page["results"]), 2)
+            names += [device["name"] for device in page["results"]]
+            if page["next"] is None:
+                break
+            response = self.client.get(page["next"])
+        self.assertEqual(names, [f"d{i}" for i in range(5)])
+
+
+class BulkVlansTest(APITestCase):
+    url = "/service_directory/api/vlans/bulk/"
+
+    def setUp(self):
+        self.device = Device.objects.create(name="d1", management_ip="10.0.0.1")
+        self.v10 = Vlan.objects.create(name="v10", tag=10, device=self.device)
+        self.v20 = Vlan.objects.create(name="v20", tag=20, device=self.device)
+
+    def bulk(self, **changes):
+        return self.client.post(self.url, changes, format="json")
+
+    def vlan(self, tag: int, name: str, **fields) -> dict:
+        return {"tag": tag, "name": name, "device": self.device.id, **fields}
+
+    def tags(self) -> dict:
+        return dict(Vlan.objects.values_list("name", "tag"))
+
+    def test_mixed_changes(self):
+        response = self.bulk(
+            delete=[self.v10.id],
+            # Tag of the deleted vlan is free for the rest of the request
+            update=[self.vlan(10, "v20-moved", id=self.v20.id)],
+            create=[self.vlan(20, "v20"), self.vlan(30, "v30")],
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"created": 2, "updated": 1, "deleted": 1})
+        self.assertEqual(self.tags(), {"v20-moved": 10, "v20": 20, "v30": 30})
+        # All the changes of the request are logged under a single revision
+        self.device.refresh_from_db()
+        changes = VlanChange.objects.filter(
+            device_id=self.device.id, revision=self.device.vlans_revision
+        )
+        self.assertEqual(
+            list(changes.values_list("action", "tag")),
+            [("delete", 10), ("update", 10), ("create", 20), ("create", 30)],
+        )
+
+    def test_conflict_rolls_back(self):
+        response = self.bulk(delete=[self.v20.id], create=[self.vlan(10, "v10-new")])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(
+            response.json(),
+            {
+                "detail": f"Vlan (device {self.device.id}, tag 10)"
+                " has the tag of another vlan of the device",
+                "device": self.device.id,
+                "field": "tag",
+                "value": 10,
+            },
+        )
+        self.assertEqual(self.tags(), {"v10": 10, "v20": 20})
+
+    def test_tag_swap_conflict(self):
+        response = self.bulk(
+            update=[
+                self.vlan(20, "v10", id=self.v10.id),
+                self.vlan(10, "v20", id=self.v20.id),
+            ]
+        )
+        self.assertEqual(response.status_code, 409)
+        conflict = response.json()
+        self.assertEqual(
+            (conflict["device"], conflict["field"], conflict["value"]),
+            (self.device.id, "tag", 20),
+        )
+        self.assertIn(f"takes the tag of vlan {self.v20.id}", conflict["detail"])
+        self.assertEqual(self.tags(), {"v10": 10, "v20": 20})
+
+    def test_unknown_ids(self):
+        response = self.bulk(delete=[self.v10.id, 999])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"delete": "Vlans not found: [999]"})
+        response = self.bulk(
+            delete=[self.v10.id], update=[self.vlan(30, "v30", id=999)]
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"update": "Vlans not found: [999]"})
+        # Nothing of the failed requests is applied
+        self.assertEqual(self.tags(), {"v10": 10, "v20": 20})
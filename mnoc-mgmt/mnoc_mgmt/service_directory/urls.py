@@ -1,8 +1,13 @@
 from django.urls import re_path, include
-from .api import VlanViewSet, DeviceViewSet, RpcListTaskQueueView
+from .api import (
+    VlanViewSet,
+    DeviceViewSet,
+    RpcListTaskQueueView,
+    RpcQueueMetricsView,
+    QueueMetricsPrometheusView,
+)
 from rest_framework.routers import DefaultRouter
 
-
 app_name = "service_directory"
 urlpatterns = []
 router = DefaultRouter()
@@ -14,3 +19,5 @@ urlpatterns.append(re_path(r"api/", include(router.urls)))
 urlpatterns.append(
     re_path(r"api/rpc_list_task_queue/$", RpcListTaskQueueView.as_view())
 )
+urlpatterns.append(re_path(r"api/rpc_queue_metrics/$", RpcQueueMetricsView.as_view()))
+urlpatterns.append(re_path(r"api/metrics/$", QueueMetricsPrometheusView.as_view()))
@@ -1,6 +1,6 @@
 import logging
 
-from mnoc_jobtools.tools import SyncJob, SyncJobException
+from mnoc_jobtools.tools import JobPriority, SyncJob, SyncJobException
 from pysnmp.entity import engine, config
 from pysnmp.carrier.asyncore.dgram import udp
 from pysnmp.entity.rfc3413 import ntfrcv
@@ -69,8 +69,13 @@ class Collector:
 
         device_id = get_device_id_from_db(device_ip)
         try:
-            job = SyncJob(device_id=device_id, sync_from="device", sync_to="db")
-            job.put_to_queue()
+            job = SyncJob(
+                device_id=device_id,
+                sync_from="device",
+                sync_to="db",
+                priority=JobPriority.NORMAL,
+            )
+            job.put_to_queue(coalesce=True)
         except SyncJobException:
             logging.exception("Failed to submit job to the Job Queue")
 
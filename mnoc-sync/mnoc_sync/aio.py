@@ -0,0 +1,470 @@
+"""
+asyncio runner of the sync jobs.
+
+Jobs are coroutines, so a single process keeps hundreds of them in flight:
+the queue is read with async Redis client, and MgmtApi is called
+with aiohttp. PyEZ has no async API, so the device calls are offloaded
+to a bounded thread pool, which is the only part growing with concurrency.
+
+Usage:
+    MNOC_SYNC_RUNNER=asyncio python sync.py
+"""
+
+import asyncio
+import functools
+import json
+import logging
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import aiohttp
+from redis import RedisError
+
+from mnoc_jobtools.aio import AsyncSyncJob
+from mnoc_jobtools.events import subscribe_device_changed
+from mnoc_jobtools.tools import JobStatus
+from mnoc_sync.inventory import DeviceInventory
+from mnoc_sync.mgmt_api import MgmtRestApi
+from mnoc_sync.network import SESSION_POOL
+from mnoc_sync.snapshot import VlanSnapshotStore
+from mnoc_sync.sync import (
+    DEVICE_ERRORS,
+    MGMT_API_HOSTNAME,
+    MGMT_API_PASS,
+    MGMT_API_PORT,
+    MGMT_API_USER,
+    SYNC_BATCH_SIZE,
+    SYNC_BATCH_WINDOW,
+    VlanSyncJobExecutor,
+)
+from mnoc_sync.worker_pool import BatchDrain, SyncWorkerPool
+
+# Number of jobs for different devices running at once
+ASYNC_SYNC_CONCURRENCY = int(os.getenv("MNOC_SYNC_CONCURRENCY", 200))
+# Number of threads running blocking device calls
+DEVICE_THREADS = int(os.getenv("MNOC_SYNC_DEVICE_THREADS", 32))
+
+##################################################################
+
+
+class AsyncMgmtRestApi:
+    """Coroutine counterpart of `MgmtRestApi`, which doesn't block the event loop"""
+
+    def __init__(
+        self,
+        hostname: str,
+        username: str,
+        password: str,
+        port: int = None,
+        pool_size: int = 100,
+    ):
+        """
+        Args:
+            pool_size (optional): max number of connections at once
+        """
+        if port:
+            base_url = f"http://{hostname}:{port}{MgmtRestApi.API_URL_PREFIX}"
+        else:
+            base_url = f"http://{hostname}{MgmtRestApi.API_URL_PREFIX}"
+        self._api_vlan_url = base_url + MgmtRestApi.VLAN_URL + "/"
+        self._api_device_url = base_url + MgmtRestApi.DEVICE_URL + "/"
+        self._auth = aiohttp.BasicAuth(login=username, password=password)
+        self.pool_size = pool_size
+        # Session is bound to the event loop, so it's created on the first request
+        self._session = None
+        # device id -> (ETag, body) of the last vlans response of the device
+        self._vlans_cache = {}
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                auth=self._auth,
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                trust_env=False,
+            )
+        return self._session
+
+    @staticmethod
+    def _check_response(response: aiohttp.ClientResponse, operation: str):
+        try:
+            response.raise_for_status()
+        except aiohttp.ClientResponseError:
+            logging.exception("[Failure]: " + operation)
+            raise
+        logging.info(f"[Success]: " + operation)
+
+    async def _request(self, method: str, url: str, operation: str, **kwargs):
+        async with self._get_session().request(method, url, **kwargs) as response:
+            self._check_response(response, operation)
+            return await response.json()
+
+    async def get_device(self, device_id: int):
+        return await self._request(
+            "GET",
+            self._api_device_url + str(device_id) + "/",
+            f"Get device data for {device_id} from MgmtApi",
+        )
+
+    async def get_vlans_for_device(self, device_id: int):
+        """Same as `MgmtRestApi.get_vlans_for_device`"""
+        cached = self._vlans_cache.get(device_id)
+        async with self._get_session().get(
+            self._api_vlan_url,
+            params={"device__id": device_id},
+            headers={"If-None-Match": cached[0]} if cached else None,
+        ) as response:
+            if cached and response.status == 304:
+                logging.info(f"[Success]: Vlans data for {device_id} is not modified")
+                return json.loads(cached[1])
+            self._check_response(
+                response, f"Get vlans data for {device_id} from MgmtApi"
+            )
+            body = await response.read()
+        etag = response.headers.get("ETag")
+        if etag:
+            self._vlans_cache[device_id] = (etag, body)
+        else:
+            self._vlans_cache.pop(device_id, None)
+        return json.loads(body)
+
+    async def bulk_vlans(
+        self, create: list = (), update: list = (), delete: list = ()
+    ) -> dict:
+        """Same as `MgmtRestApi.bulk_vlans`"""
+        return await self._request(
+            "POST",
+            self._api_vlan_url + "bulk/",
+            f"Create {len(create)}, update {len(update)}"
+            f" and delete {len(delete)} vlans in MgmtApi",
+            json={
+                "create": list(create),
+                "update": list(update),
+                "delete": [vlan["id"] for vlan in delete],
+            },
+        )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncDeviceInventory(DeviceInventory):
+    """`DeviceInventory` fetching devices with `AsyncMgmtRestApi`"""
+
+    async def get_device(self, device_id: int) -> dict:
+        device, generation = self._cached(device_id)
+        if device is not None:
+            return device
+        fetched = time.monotonic()
+        device = await self.mgmt_api.get_device(device_id=device_id)
+        self._store(device_id, device, fetched, generation)
+        return device
+
+
+class AsyncVlanSyncJobExecutor(VlanSyncJobExecutor):
+    """
+    `VlanSyncJobExecutor` with coroutine counterparts of the methods doing I/O.
+    Diff is calculated in the event loop, device calls are run
+    by `device_executor`, and the calls are the same as of the threaded executor
+    """
+
+    def __init__(
+        self,
+        sync_job: AsyncSyncJob,
+        mgmt_api: AsyncMgmtRestApi,
+        management_ip: str,
+        device_executor: ThreadPoolExecutor,
+        snapshots: VlanSnapshotStore = None,
+    ):
+        super().__init__(
+            sync_job, mgmt_api, snapshots=snapshots, management_ip=management_ip
+        )
+        self.device_executor = device_executor
+
+    @classmethod
+    async def create(
+        cls,
+        sync_job: AsyncSyncJob,
+        mgmt_api: AsyncMgmtRestApi,
+        inventory: AsyncDeviceInventory,
+        device_executor: ThreadPoolExecutor,
+        snapshots: VlanSnapshotStore = None,
+    ) -> "AsyncVlanSyncJobExecutor":
+        device = await inventory.get_device(device_id=sync_job.device_id)
+        return cls(
+            sync_job, mgmt_api, device["management_ip"], device_executor, snapshots
+        )
+
+    def _offload(self, func, *args):
+        """Runs blocking call in the device executor.
+        Returns concurrent future, so the call can be cancelled or waited for"""
+        return self.device_executor.submit(functools.partial(func, *args))
+
+    async def fetch_vlan_list_from_device(self):
+        """Same as `VlanSyncJobExecutor.fetch_vlan_list_from_device`"""
+        try:
+            return await asyncio.wrap_future(self._offload(self._read_device_vlans))
+        except DEVICE_ERRORS:
+            logging.exception(
+                f"Failed to fetch Vlans from device."
+                f" Rescheduling the SyncJob {self.sync_job.uid}"
+            )
+            await self.sync_job.reschedule()
+
+    async def fetch_vlan_list_from_db(self) -> List[dict]:
+        return await self.mgmt_api.get_vlans_for_device(device_id=self.device_id)
+
+    async def _timed(self, leg: str, fetch):
+        started = time.perf_counter()
+        try:
+            return await fetch
+        finally:
+            self.timings[leg] = time.perf_counter() - started
+
+    async def fetch_vlan_lists(self):
+        """Same as `VlanSyncJobExecutor.fetch_vlan_lists`"""
+        device_leg = asyncio.ensure_future(
+            self._timed("device", self.fetch_vlan_list_from_device())
+        )
+        try:
+            db_vlans = await self._timed("db", self.fetch_vlan_list_from_db())
+        except BaseException:
+            # Cancelling the task doesn't stop the thread, so the leg is awaited
+            await asyncio.gather(device_leg, return_exceptions=True)
+            raise
+        device_vlans = await device_leg
+        logging.info(
+            f"Fetched vlans from device in {self.timings['device']:.3f}s"
+            f" and from DB in {self.timings['db']:.3f}s"
+        )
+        return device_vlans, db_vlans
+
+    async def sync_from_db_to_device(self, device_vlans, db_vlans):
+        """Same as `VlanSyncJobExecutor.sync_from_db_to_device`"""
+        diff = self._changes(device_vlans, db_vlans, sot="db")
+        if diff is None:
+            logging.warning("No changes detected, so no need to push vlans to device")
+            return
+        pushed = await asyncio.wrap_future(
+            self._offload(self._push_to_device, diff, device_vlans, db_vlans)
+        )
+        if not pushed:
+            await self.sync_job.reschedule()
+
+    async def sync_from_device_to_db(self, device_vlans, db_vlans):
+        """Same as `VlanSyncJobExecutor.sync_from_device_to_db`"""
+        diff = self._changes(db_vlans, device_vlans, sot="device")
+        if diff is None:
+            logging.warning("No changes detected, so no need to update DB vlans")
+            return
+        await self.mgmt_api.bulk_vlans(**self._db_changes(diff, db_vlans))
+        logging.warning("Successfully synced Device to DB Vlans")
+
+    async def execute_job(self):
+        device_vlans, db_vlans = await self.fetch_vlan_lists()
+        if device_vlans is None:
+            return  # Job has been rescheduled
+        if self.sync_from == "db" and self.sync_to == "device":
+            await self.sync_from_db_to_device(
+                device_vlans=device_vlans, db_vlans=db_vlans
+            )
+        elif self.sync_from == "device" and self.sync_to == "db":
+            await self.sync_from_device_to_db(
+                device_vlans=device_vlans, db_vlans=db_vlans
+            )
+
+
+class AsyncSyncWorkerPool(SyncWorkerPool):
+    """
+    `SyncWorkerPool` running the jobs as tasks of the event loop.
+    Same guarantees: jobs of the same device never run concurrently
+    and keep their order, and a job is retrieved only when there is a free slot
+    """
+
+    def __init__(
+        self,
+        size: int,
+        execute_job,
+        get_next_job=AsyncSyncJob.get_next_from_queue,
+        poll_interval: float = 1,
+        max_backlog: int = 10,
+        requeue_delay: float = 5,
+    ):
+        """
+        Args:
+            execute_job: coroutine function, which runs the job. It must not raise
+            get_next_job (optional): coroutine function,
+                see `SyncWorkerPool.get_next_job`
+        """
+        super().__init__(
+            size, execute_job, get_next_job, poll_interval, max_backlog, requeue_delay
+        )
+
+    async def run(self):
+        """Same as `SyncWorkerPool.run`"""
+        logging.info(f"Starting async sync worker pool of {self.size} tasks")
+        # Bound to the running loop, so can't be created in __init__
+        self._slots = asyncio.Semaphore(self.size)
+        tasks = set()
+        while not self._stopped.is_set():
+            try:
+                # Timeout lets the loop see the stop while all the slots are busy
+                await asyncio.wait_for(self._slots.acquire(), self.poll_interval)
+            except asyncio.TimeoutError:
+                continue
+            if self._stopped.is_set():
+                self._slots.release()
+                break
+            sync_job = await self._get_next_job(
+                timeout=self.poll_interval, busy_shards=self.busy_shards()
+            )
+            if sync_job is not None and self._backlog_is_full(sync_job):
+                await self._requeue(sync_job)
+                sync_job = None
+            if sync_job is None or not self._start(sync_job):
+                self._slots.release()
+                continue
+            task = asyncio.ensure_future(self._run_device_jobs(sync_job))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        logging.warning("Sync worker pool is stopping, draining in-flight jobs")
+        await asyncio.gather(*tasks)
+        logging.warning("Sync worker pool has stopped")
+
+    async def _requeue(self, sync_job: AsyncSyncJob):
+        """Same as `SyncWorkerPool._requeue`"""
+        logging.info(f"Backlog of the device is full, job is requeued: {sync_job}")
+        await sync_job.put_to_queue(delay=self.requeue_delay)
+        await sync_job.ack()
+
+    async def _run_device_jobs(self, sync_job: AsyncSyncJob):
+        """Same as `SyncWorkerPool._run_device_jobs`"""
+        try:
+            while sync_job is not None:
+                try:
+                    await self._execute_job(sync_job)
+                except Exception:
+                    logging.exception(f"Failed to execute the sync job {sync_job}")
+                with self._backlogs_lock:
+                    backlog = self._backlogs[sync_job.device_id]
+                    if backlog:
+                        sync_job = backlog.popleft()
+                    else:
+                        del self._backlogs[sync_job.device_id]
+                        sync_job = None
+        finally:
+            self._slots.release()
+
+
+class AsyncBatchDrain(BatchDrain):
+    """`BatchDrain` for AsyncSyncWorkerPool. It's called by the run loop only"""
+
+    def __init__(
+        self,
+        max_jobs: int,
+        window: float = 0,
+        get_many_jobs=AsyncSyncJob.get_many_from_queue,
+    ):
+        """
+        Args:
+            get_many_jobs (optional): coroutine function,
+                see `BatchDrain.get_many_jobs`
+        """
+        super().__init__(max_jobs, window, get_many_jobs)
+
+    async def __call__(self, timeout: float, busy_shards=()):
+        if not self._buffered:
+            jobs = await self._get_many_jobs(
+                max_jobs=self.max_jobs,
+                window=self.window,
+                timeout=timeout,
+                busy_shards=busy_shards,
+            )
+            self._buffer(jobs)
+        return self._buffered.popleft() if self._buffered else None
+
+    async def requeue(self):
+        """Same as `BatchDrain.requeue`"""
+        while self._buffered:
+            sync_job = self._buffered.popleft()
+            await sync_job.put_to_queue(coalesce=True)
+            await sync_job.ack()
+
+
+async def execute_sync_job(
+    sync_job: AsyncSyncJob,
+    mgmt_api: AsyncMgmtRestApi,
+    inventory: AsyncDeviceInventory,
+    device_executor: ThreadPoolExecutor,
+    snapshots: VlanSnapshotStore,
+):
+    """Same as `mnoc_sync.sync.execute_sync_job`"""
+    logging.warning(f"Starting executing sync job: {sync_job}")
+    if sync_job.merged_jobs:
+        logging.info(f"{len(sync_job.merged_jobs)} merged jobs share the outcome")
+    try:
+        executor = await AsyncVlanSyncJobExecutor.create(
+            sync_job, mgmt_api, inventory, device_executor, snapshots
+        )
+        await executor.execute_job()
+    except Exception:
+        logging.exception(f"Failed to execute the sync job {sync_job}")
+        await sync_job.finish(JobStatus.FAILURE)
+        return
+    finally:
+        await sync_job.ack()
+
+    await sync_job.finish(JobStatus.SUCCESS)
+    logging.warning(f"Finished executing sync job: {sync_job}")
+
+
+async def main():
+    mgmt_api = AsyncMgmtRestApi(
+        hostname=MGMT_API_HOSTNAME,
+        username=MGMT_API_USER,
+        password=MGMT_API_PASS,
+        port=MGMT_API_PORT,
+        pool_size=ASYNC_SYNC_CONCURRENCY,
+    )
+    inventory = AsyncDeviceInventory(mgmt_api)
+    device_executor = ThreadPoolExecutor(DEVICE_THREADS, thread_name_prefix="device")
+    get_next_job = AsyncSyncJob.get_next_from_queue
+    batch_drain = None
+    if SYNC_BATCH_SIZE > 1:
+        get_next_job = batch_drain = AsyncBatchDrain(SYNC_BATCH_SIZE, SYNC_BATCH_WINDOW)
+    pool = AsyncSyncWorkerPool(
+        ASYNC_SYNC_CONCURRENCY,
+        functools.partial(
+            execute_sync_job,
+            mgmt_api=mgmt_api,
+            inventory=inventory,
+            device_executor=device_executor,
+            snapshots=VlanSnapshotStore(),
+        ),
+        get_next_job=get_next_job,
+    )
+    # In-flight jobs are drained on shutdown instead of being interrupted
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, pool.stop)
+    loop.add_signal_handler(signal.SIGINT, pool.stop)
+    try:
+        device_events = subscribe_device_changed(inventory.invalidate)
+    except RedisError:
+        logging.exception("Device change events are unavailable, cache will expire")
+        device_events = None
+    try:
+        await pool.run()
+    finally:
+        if device_events is not None:
+            device_events.stop()
+        if batch_drain is not None:
+            await batch_drain.requeue()
+        # Let other workers take over the queue shards of this one
+        await AsyncSyncJob.leave_shards()
+        await mgmt_api.close()
+        device_executor.shutdown()
+        SESSION_POOL.close_all()
@@ -0,0 +1,141 @@
+"""
+Benchmarks of mnoc_sync. Don't need redis, mgmt api or real devices:
+    - vlan diff of the device and DB vlan lists of different sizes
+    - throughput of the sync worker pool against simulated devices.
+      Jobs come from an in-memory queue, and every job sleeps
+      for the typical NETCONF round trips of a device
+
+Usage:
+    python -m mnoc_sync.benchmarks --jobs 200 --devices 50 --sizes 1 4 16
+    python -m mnoc_sync.benchmarks --only diff --vlans 10 1000 4094
+"""
+
+import argparse
+import logging
+import queue
+import random
+import threading
+import time
+
+from mnoc_jobtools.tools import SyncJob
+from mnoc_sync.diff import diff_vlans, diff_vlans_pairwise
+from mnoc_sync.worker_pool import SyncWorkerPool
+
+##################################################################
+
+
+def measure(name: str, operations: int, func):
+    """Runs func and prints operations per second"""
+    started = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - started
+    print(f"{name:<40} {operations / elapsed:>12.1f} ops/s  ({elapsed:.3f}s)")
+
+
+def generate_vlan_lists(count: int) -> tuple:
+    """Device and DB vlans of `count` tags: most are in sync,
+    and some are altered, missing on either side"""
+    device_vlans = []
+    db_vlans = []
+    for tag in range(2, count + 2):
+        name = f"vlan-{tag}"
+        if tag % 10 != 1:
+            device_vlans.append({"name": name, "vlan-id": tag, "description": "d"})
+        if tag % 10 != 2:
+            description = "altered" if tag % 10 == 3 else "d"
+            db_vlans.append({"name": name, "tag": tag, "description": description})
+    random.shuffle(device_vlans)
+    return device_vlans, db_vlans
+
+
+def bench_vlan_diff(counts: list):
+    """Indexed diff against the pairwise one, both directions"""
+    for count in counts:
+        device_vlans, db_vlans = generate_vlan_lists(count)
+        for name, diff in (("indexed", diff_vlans), ("pairwise", diff_vlans_pairwise)):
+            measure(
+                f"{name} diff, {count} vlans",
+                1,
+                lambda: (
+                    diff(device_vlans, db_vlans, sot="db"),
+                    diff(db_vlans, device_vlans, sot="device"),
+                ),
+            )
+
+
+class SimulatedDevice:
+    """Device which takes `latency` seconds per round trip
+    and fails if two jobs talk to it at once"""
+
+    ROUND_TRIPS_PER_JOB = 3  # Connect, get config, commit
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self._lock = threading.Lock()
+
+    def sync(self):
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("Concurrent jobs for the same device")
+        try:
+            time.sleep(self.latency * self.ROUND_TRIPS_PER_JOB)
+        finally:
+            self._lock.release()
+
+
+def bench_worker_pool(size: int, jobs: int, devices: int, latency: float):
+    """Runs `jobs` jobs for random devices through the pool of `size` threads"""
+    simulated_devices = [SimulatedDevice(latency) for _ in range(devices)]
+    job_queue = queue.Queue()
+    for _ in range(jobs):
+        job_queue.put(SyncJob(random.randrange(devices), "db", "device"))
+    done = []
+    failed = []
+
+    def get_next_job(timeout, busy_shards):
+        try:
+            return job_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def execute_job(sync_job):
+        try:
+            simulated_devices[sync_job.device_id].sync()
+        except RuntimeError:
+            failed.append(sync_job)
+        done.append(sync_job)
+        if len(done) == jobs:
+            pool.stop()
+
+    pool = SyncWorkerPool(size, execute_job, get_next_job, poll_interval=0.1)
+    started = time.perf_counter()
+    pool.run()
+    elapsed = time.perf_counter() - started
+    print(
+        f"{'worker pool of ' + str(size):<40} {jobs / elapsed:>12.1f} jobs/s"
+        f"  ({elapsed:.3f}s, {len(failed)} concurrent device access)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--jobs", type=int, default=200)
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="Seconds per device round trip"
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--vlans", type=int, nargs="+", default=[10, 1000, 4094])
+    parser.add_argument("--only", choices=["diff", "pool"])
+    args = parser.parse_args()
+    # Per-job logging would dominate the measurements
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if args.only != "pool":
+        bench_vlan_diff(args.vlans)
+    if args.only != "diff":
+        for size in args.sizes:
+            bench_worker_pool(size, args.jobs, args.devices, args.latency)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+from typing import Any, Dict, List
+
+"""
+Vlan here is just a json converted to dict
+In the context of mnoc-sync, Vlan can be:
+    - serialized representation of Django Vlan model (variable usually called db_vlan)
+    OR
+    - json representation of Vlan configured at the device (variable usually called device_vlan)
+"""
+Vlan = Dict[str, Any]
+
+# Name of the vlan tag attribute by the side it comes from
+TAG_ATTRIBUTES = {"db": "tag", "device": "vlan-id"}
+SUBJECT_BY_SOT = {"db": "device", "device": "db"}
+
+
+def are_equal_vlans(
+    subject_vlan: Vlan, sot_vlan: Vlan, sot: str, tag_only=False
+) -> bool:
+    """Function to compare subject vlan with SOT:
+    - Device and DB vlans have different attributes
+    - We need to compare only significant attributes
+    - Specify `sot` as 'db' or 'device' so we know what are the names of the significant attributes
+    """
+    if sot == "db":
+        db_vlan = sot_vlan
+        device_vlan = subject_vlan
+    elif sot == "device":
+        device_vlan = sot_vlan
+        db_vlan = subject_vlan
+    else:
+        raise NotImplementedError(
+            f"No implementation for {sot}. Supported SOTs: 'db', 'device'"
+        )
+    if tag_only:
+        return db_vlan["tag"] == device_vlan["vlan-id"]
+
+    return all(
+        (
+            db_vlan["description"] == device_vlan["description"],
+            db_vlan["name"] == device_vlan["name"],
+            db_vlan["tag"] == device_vlan["vlan-id"],
+        )
+    )
+
+
+def diff_vlans(
+    subject_vlans: List[Vlan], source_of_truth_vlans: List[Vlan], sot: str
+) -> dict:
+    """
+    Calculates the difference between subject vlans and source of truth,
+    see `VlanSyncJobExecutor.compare_vlans_against_source_of_truth`.
+
+    Subject vlans are indexed by tag, so every vlan is looked at once
+    instead of comparing every pair: O(n + m) for n subject and m SOT vlans.
+    The result is the same as of `diff_vlans_pairwise`:
+    SOT vlan is matched with the first subject vlan of the same tag.
+    """
+    if sot not in SUBJECT_BY_SOT:
+        raise NotImplementedError(
+            f"No implementation for {sot}. Supported SOTs: 'db', 'device'"
+        )
+    sot_tag = TAG_ATTRIBUTES[sot]
+    subject_tag = TAG_ATTRIBUTES[SUBJECT_BY_SOT[sot]]
+
+    subject_by_tag = {}
+    for subject_vlan in subject_vlans:
+        subject_by_tag.setdefault(subject_vlan.get(subject_tag), subject_vlan)
+
+    diff = {
+        "synced_vlans": [],
+        "altered_vlans": [],
+        "non_present_vlans": [],
+        "removed_vlans": [],
+    }
+    # tag -> subject vlan which was matched with SOT vlan of this tag
+    mapped_by_tag = {}
+    for sot_vlan in source_of_truth_vlans:
+        subject_vlan = subject_by_tag.get(sot_vlan[sot_tag])
+        if subject_vlan is None:
+            diff["non_present_vlans"].append(sot_vlan)
+            continue
+        if are_equal_vlans(subject_vlan, sot_vlan, sot=sot):
+            diff["synced_vlans"].append(sot_vlan)
+        else:
+            diff["altered_vlans"].append(sot_vlan)
+        mapped_by_tag[sot_vlan[sot_tag]] = subject_vlan
+
+    for subject_vlan in subject_vlans:
+        # Vlan equal to a mapped one is mapped as well, even if it's a duplicate.
+        # Equal vlans have the same tag, so only one mapped vlan needs checking
+        if subject_vlan != mapped_by_tag.get(subject_vlan.get(subject_tag)):
+            diff["removed_vlans"].append(subject_vlan)
+
+    return diff
+
+
+def diff_vlans_pairwise(
+    subject_vlans: List[Vlan], source_of_truth_vlans: List[Vlan], sot: str
+) -> dict:
+    """
+    Original O(n * m) implementation of `diff_vlans`, which compares
+    every SOT vlan with every subject vlan. Kept as the reference
+    for equivalence tests and benchmarks
+    """
+    mapped_device_vlans = []
+
+    diff = {
+        "synced_vlans": [],
+        "altered_vlans": [],
+        "non_present_vlans": [],
+        "removed_vlans": [],
+    }
+    for sot_vlan in source_of_truth_vlans:
+        mapping_found = False
+        for subject_vlan in subject_vlans:
+            # Case #1: Vlans are identical
+            if are_equal_vlans(subject_vlan, sot_vlan, sot=sot):
+                mapping_found = True
+                diff["synced_vlans"].append(sot_vlan)
+            # Case #2: The same vlan ID but some info is outdated
+            elif are_equal_vlans(subject_vlan, sot_vlan, sot=sot, tag_only=True):
+                mapping_found = True
+                diff["altered_vlans"].append(sot_vlan)
+            else:
+                mapping_found = False
+
+            if mapping_found:
+                mapped_device_vlans.append(subject_vlan)
+                break
+
+        # Case #3: We didn't find SOT vlan at the box
+        if not mapping_found:
+            diff["non_present_vlans"].append(sot_vlan)
+
+    for subject_vlan in subject_vlans:
+        # Case #4: device vlan doesn't exist in DB
+        if subject_vlan not in mapped_device_vlans:
+            diff["removed_vlans"].append(subject_vlan)
+
+    return diff
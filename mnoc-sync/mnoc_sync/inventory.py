@@ -0,0 +1,62 @@
+import logging
+import os
+import threading
+import time
+
+from mnoc_sync.mgmt_api import MgmtRestApi
+
+DEVICE_CACHE_TTL = int(os.getenv("MNOC_DEVICE_CACHE_TTL", 300))  # seconds
+
+
+class DeviceInventory:
+    """
+    Cache of the device data from MgmtApi, shared by all the jobs.
+
+    Management IP of a device almost never changes, so device is fetched
+    once per `ttl` seconds instead of once per job. Cached device is dropped
+    earlier with `invalidate`, which is called for device change events
+    published by mnoc-mgmt, see `mnoc_jobtools.events`.
+    """
+
+    def __init__(self, mgmt_api: MgmtRestApi, ttl: float = DEVICE_CACHE_TTL):
+        self.mgmt_api = mgmt_api
+        self.ttl = ttl
+        # device id -> (device data, time of fetching)
+        self._devices = {}
+        # Incremented on every invalidation, so a device fetched
+        # while it was invalidated isn't cached
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get_device(self, device_id: int) -> dict:
+        device, generation = self._cached(device_id)
+        if device is not None:
+            return device
+        fetched = time.monotonic()
+        device = self.mgmt_api.get_device(device_id=device_id)
+        self._store(device_id, device, fetched, generation)
+        return device
+
+    def _cached(self, device_id: int) -> tuple:
+        """Returns cached device or None, and the current generation"""
+        with self._lock:
+            cached = self._devices.get(device_id)
+            generation = self._generation
+        if cached is not None and time.monotonic() - cached[1] < self.ttl:
+            return cached[0], generation
+        return None, generation
+
+    def _store(self, device_id: int, device: dict, fetched: float, generation: int):
+        with self._lock:
+            if generation == self._generation:
+                self._devices[device_id] = (device, fetched)
+
+    def invalidate(self, device_id: int = None):
+        """Drops cached data of the device, or of all the devices"""
+        with self._lock:
+            self._generation += 1
+            if device_id is None:
+                self._devices.clear()
+            else:
+                self._devices.pop(device_id, None)
+        logging.info(f"Device inventory cache is invalidated for {device_id or 'all'}")
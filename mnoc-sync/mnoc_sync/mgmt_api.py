@@ -1,7 +1,9 @@
+import json
 import logging
 from copy import deepcopy
 
 from requests import Session, Response, HTTPError
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
 
@@ -17,12 +19,26 @@ class MgmtRestApi:
     VLAN_URL = "/vlans"
     DEVICE_URL = "/devices"
 
-    def __init__(self, hostname: str, username: str, password: str, port: int = None):
+    def __init__(
+        self,
+        hostname: str,
+        username: str,
+        password: str,
+        port: int = None,
+        pool_size: int = None,
+    ):
+        """
+        Args:
+            pool_size (optional): max number of kept alive connections.
+                Set it to the number of threads sharing the instance
+        """
         self._hostname = hostname
         self._username = username
         self._password = password
         self._port = port
         self._session = self.__get_requests_session()
+        if pool_size:
+            self._session.mount("http://", HTTPAdapter(pool_maxsize=pool_size))
         if port:
             self.__api_base_url = (
                 f"http://{self._hostname}:{self._port}{self.API_URL_PREFIX}"
@@ -32,6 +48,8 @@ class MgmtRestApi:
 
         self.__api_vlan_url = self.__api_base_url + self.VLAN_URL + "/"
         self.__api_device_url = self.__api_base_url + self.DEVICE_URL + "/"
+        # device id -> (ETag, body) of the last vlans response of the device
+        self._vlans_cache = {}
 
     def __get_requests_session(self, trust_env: bool = False) -> Session:
         session = Session()
@@ -54,32 +72,70 @@ class MgmtRestApi:
         return response.json()
 
     def get_vlans_for_device(self, device_id: int):
+        """
+        Vlans are requested with the ETag of the last response for the device,
+        so the unchanged vlans are answered with 304 Not Modified
+        and parsed from the last body instead of being sent again
+        """
+        cached = self._vlans_cache.get(device_id)
         response = self._session.get(
-            self.__api_vlan_url, params={"device__id": device_id},
+            self.__api_vlan_url,
+            params={"device__id": device_id},
+            headers={"If-None-Match": cached[0]} if cached else None,
         )
+        if cached and response.status_code == 304:
+            logging.info(f"[Success]: Vlans data for {device_id} is not modified")
+            return json.loads(cached[1])
         self.__check_response(response, f"Get vlans data for {device_id} from MgmtApi")
+        etag = response.headers.get("ETag")
+        if etag:
+            self._vlans_cache[device_id] = (etag, response.content)
+        else:
+            self._vlans_cache.pop(device_id, None)
+        return response.json()
+
+    def bulk_vlans(
+        self, create: list = (), update: list = (), delete: list = ()
+    ) -> dict:
+        """
+        Creates, updates and deletes vlans in one request and one transaction.
+
+        Args:
+            create: vlans to create, with `device` id
+            update: vlans with `id` to update
+            delete: vlans with `id` to delete
+        Returns:
+            Number of created, updated and deleted vlans
+        """
+        response = self._session.post(
+            self.__api_vlan_url + "bulk/",
+            json={
+                "create": list(create),
+                "update": list(update),
+                "delete": [vlan["id"] for vlan in delete],
+            },
+        )
+        self.__check_response(
+            response,
+            f"Create {len(create)}, update {len(update)}"
+            f" and delete {len(delete)} vlans in MgmtApi",
+        )
         return response.json()
 
+    @staticmethod
+    def to_db_vlan(vlan: dict, device_id) -> dict:
+        """Vlan of the device converted to the one to submit to MgmtApi"""
+        vlan_to_submit = deepcopy(vlan)
+        vlan_to_submit["device"] = device_id
+        if "vlan-id" in vlan_to_submit:
+            vlan_to_submit["tag"] = vlan_to_submit.pop("vlan-id")
+        return vlan_to_submit
+
     def add_vlans_for_device(self, new_vlans: list, device_id):
-        for vlan in new_vlans:
-            vlan_to_submit = deepcopy(vlan)
-            vlan_to_submit["device"] = device_id
-            if "vlan-id" in vlan_to_submit:
-                vlan_to_submit["tag"] = vlan_to_submit.pop("vlan-id")
-            response = self._session.post(self.__api_vlan_url, json=vlan_to_submit)
-            self.__check_response(
-                response, f"Create new vlan {vlan['name']} for {device_id} in MgmtApi"
-            )
+        self.bulk_vlans(create=[self.to_db_vlan(vlan, device_id) for vlan in new_vlans])
 
     def update_vlans(self, updated_vlans_list: list):
-        for vlan in updated_vlans_list:
-            response = self._session.put(
-                self.__api_vlan_url + str(vlan["id"]), json=vlan
-            )
-            self.__check_response(response, f"Update vlan {vlan['tag']} in MgmtApi")
-            logging.info(f"Updated {vlan['name']} in MgmtApi")
+        self.bulk_vlans(update=updated_vlans_list)
 
     def delete_vlans(self, removed_vlans_list: list):
-        for vlan in removed_vlans_list:
-            response = self._session.delete(self.__api_vlan_url + str(vlan["id"]))
-            self.__check_response(response, f"Delete vlan {vlan['tag']} in MgmtApi")
+        self.bulk_vlans(delete=removed_vlans_list)
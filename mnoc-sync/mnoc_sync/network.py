@@ -1,10 +1,20 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import List
+
 from jnpr.junos import Device
+from jnpr.junos.exception import ConnectError, RpcError
 from jnpr.junos.utils.config import Config
 
 from pathlib import Path
 
-
 VLAN_CONFIG_TEMPLATE = str(Path(__file__).resolve().parent / "vlan_template.conf")
+SESSION_IDLE_TIMEOUT = 300  # Seconds before idle session is closed
+SESSION_CHECK_INTERVAL = 30  # Session idle for longer is checked before reuse
+SESSION_ACQUIRE_TIMEOUT = 120  # Max seconds to wait for a session of busy device
+MAX_SESSIONS_PER_DEVICE = 1
 
 
 class NetworkDeviceException(Exception):
@@ -13,48 +23,308 @@ class NetworkDeviceException(Exception):
     pass
 
 
+def vlan_config_commands(diff: dict, device_vlans: List[dict]) -> List[str]:
+    """
+    Junos `set`/`delete` statements, which bring the device vlans to the DB ones,
+    from the diff of `device_vlans` against the DB (sot="db").
+
+    Vlans are configured by name, so altered vlan whose name differs
+    from the one of the device vlan of the same tag is recreated.
+    All the deletes go first, so a name freed by a removed
+    or renamed vlan can be reused by another one.
+    """
+    device_by_tag = {}
+    for device_vlan in device_vlans:
+        device_by_tag.setdefault(device_vlan["vlan-id"], device_vlan)
+
+    deletes = [f"delete vlans {vlan['name']}" for vlan in diff["removed_vlans"]]
+    sets = []
+    for db_vlan in diff["altered_vlans"]:
+        device_vlan = device_by_tag[db_vlan["tag"]]
+        if device_vlan["name"] == db_vlan["name"]:
+            sets.extend(_vlan_description_commands(db_vlan))
+        else:
+            deletes.append(f"delete vlans {device_vlan['name']}")
+            sets.extend(_vlan_set_commands(db_vlan))
+    for db_vlan in diff["non_present_vlans"]:
+        sets.extend(_vlan_set_commands(db_vlan))
+    return deletes + sets
+
+
+def _vlan_set_commands(db_vlan: dict) -> List[str]:
+    commands = [f"set vlans {db_vlan['name']} vlan-id {db_vlan['tag']}"]
+    if db_vlan.get("description") is not None:
+        commands.extend(_vlan_description_commands(db_vlan))
+    return commands
+
+
+def _vlan_description_commands(db_vlan: dict) -> List[str]:
+    description = db_vlan.get("description")
+    if description is None:
+        return [f"delete vlans {db_vlan['name']} description"]
+    description = description.replace("\\", "\\\\").replace('"', '\\"')
+    return [f'set vlans {db_vlan["name"]} description "{description}"']
+
+
+class NetworkDeviceSessionPool:
+    """
+    Keeps NETCONF sessions open between jobs, so SSH and NETCONF handshakes
+    are done once per device and not every time the device is accessed.
+
+    Sessions are keyed by host, port and user. Session which was idle
+    for more than `check_interval` is probed with a cheap RPC before reuse,
+    as the device may have closed it meanwhile, and session idle for more than
+    `idle_timeout` is closed. At most `max_sessions_per_device` sessions
+    are open to the same device, the others wait for a session to be released.
+    """
+
+    def __init__(
+        self,
+        idle_timeout: float = SESSION_IDLE_TIMEOUT,
+        check_interval: float = SESSION_CHECK_INTERVAL,
+        max_sessions_per_device: int = MAX_SESSIONS_PER_DEVICE,
+        acquire_timeout: float = SESSION_ACQUIRE_TIMEOUT,
+        device_factory=Device,
+    ):
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.max_sessions_per_device = max_sessions_per_device
+        self.acquire_timeout = acquire_timeout
+        self._device_factory = device_factory
+        # key -> list of (device, time of release), most recently released last
+        self._idle = {}
+        # key -> number of open sessions, idle or in use
+        self._open = {}
+        self._changed = threading.Condition()
+
+    @contextmanager
+    def session(self, host, port, user, password):
+        """
+        Borrows an open session to the device for the duration of the block:
+
+            with pool.session(host, port, user, password) as device:
+                device.rpc.get_config()
+
+        Session is closed instead of being returned to the pool
+        if the block fails with connection error.
+        """
+        key = (host, port, user)
+        device = self._acquire(key, password)
+        try:
+            yield device
+        except ConnectError:
+            self._release(key, device, discard=True)
+            raise
+        except BaseException:
+            self._release(key, device, discard=not device.connected)
+            raise
+        self._release(key, device, discard=not device.connected)
+
+    def _acquire(self, key, password):
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            with self._changed:
+                self._evict_idle()
+                while not self._idle.get(key) and (
+                    self._open.get(key, 0) >= self.max_sessions_per_device
+                ):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._changed.wait(remaining):
+                        raise NetworkDeviceException(
+                            f"Timed out waiting for a session to {key[0]}"
+                        )
+                    self._evict_idle()
+                if self._idle.get(key):
+                    device, released = self._idle[key].pop()
+                else:
+                    device, released = None, None
+                    # Reserved before opening, so the cap holds while connecting
+                    self._open[key] = self._open.get(key, 0) + 1
+
+            if device is None:
+                return self._open_session(key, password)
+            if time.monotonic() - released < self.check_interval or self._alive(device):
+                return device
+            logging.info(f"Session to {key[0]} is dead, opening a new one")
+            self._close(key, device)
+
+    def _open_session(self, key, password):
+        host, port, user = key
+        try:
+            device = self._device_factory(
+                host=host, port=port, user=user, password=password
+            )
+            device.open()
+        except BaseException:
+            with self._changed:
+                self._open[key] -= 1
+                self._changed.notify_all()
+            raise
+        logging.info(f"Opened new session to {host}")
+        return device
+
+    @staticmethod
+    def _alive(device) -> bool:
+        if not device.connected:
+            return False
+        try:
+            device.rpc.get_system_uptime_information()
+        except Exception:
+            return False
+        return True
+
+    def _release(self, key, device, discard: bool = False):
+        if discard:
+            self._close(key, device)
+            return
+        with self._changed:
+            self._idle.setdefault(key, []).append((device, time.monotonic()))
+            self._changed.notify_all()
+
+    def _close(self, key, device):
+        try:
+            device.close()
+        except Exception:
+            logging.exception(f"Failed to close session to {key[0]}")
+        with self._changed:
+            self._open[key] -= 1
+            self._changed.notify_all()
+
+    def _evict_idle(self):
+        """Closes sessions idle for longer than idle_timeout.
+        Must be called with the lock held"""
+        expired = time.monotonic() - self.idle_timeout
+        for key, sessions in self._idle.items():
+            while sessions and sessions[0][1] < expired:
+                device, _ = sessions.pop(0)
+                logging.info(f"Closing idle session to {key[0]}")
+                try:
+                    device.close()
+                except Exception:
+                    logging.exception(f"Failed to close session to {key[0]}")
+                self._open[key] -= 1
+        self._changed.notify_all()
+
+    def close_all(self):
+        """Closes all the idle sessions. Must be called on shutdown"""
+        with self._changed:
+            for key, sessions in self._idle.items():
+                for device, _ in sessions:
+                    try:
+                        device.close()
+                    except Exception:
+                        logging.exception(f"Failed to close session to {key[0]}")
+                    self._open[key] -= 1
+                sessions.clear()
+            self._changed.notify_all()
+
+
+# Process-wide pool shared by all the NetworkDevice instances
+SESSION_POOL = NetworkDeviceSessionPool()
+
+
 class NetworkDevice:
-    def __init__(self, host, port, user, password, vendor):
+    def __init__(self, host, port, user, password, vendor, session_pool=None):
         if vendor.lower() != "juniper":
             raise NotImplementedError("Supported vendors: juniper")
         self.host = host
         self.user = user
         self.port = port
         self.password = password
-        self.device = Device(
-            host=self.host, port=self.port, user=self.user, password=self.password
-        )
+        self.session_pool = session_pool or SESSION_POOL
+        # Session borrowed from the pool, set only within `with` block
+        self.device = None
+        self._session = None
 
     def connect(self):
-        self.device.open()
+        """Borrows a session from the pool until `disconnect`"""
+        if self.device is None:
+            self._session = self.session_pool.session(
+                self.host, self.port, self.user, self.password
+            )
+            self.device = self._session.__enter__()
+
+    def disconnect(self, *exc_info):
+        """Returns the session to the pool"""
+        if self.device is not None:
+            session, self._session, self.device = self._session, None, None
+            session.__exit__(*(exc_info or (None, None, None)))
 
     @property
     def connected(self):
-        return self.device.connected
+        return self.device is not None and self.device.connected
 
     def __enter__(self):
         self.connect()
         return self
 
     def __exit__(self, *args):
-        self.device.close()
+        self.disconnect(*args)
+
+    @contextmanager
+    def _borrowed_device(self):
+        """Session of the `with` block, or the one borrowed just for the call"""
+        if self.device is not None:
+            yield self.device
+        else:
+            with self:
+                yield self.device
 
     def get_vlan_list(self):
-        if not self.connected:
-            self.connect()
+        with self._borrowed_device() as device:
+            config = device.rpc.get_config(
+                filter_xml="vlans", options={"format": "json"}
+            )
+        return [vlan for vlan in config["configuration"]["vlans"]["vlan"]]
+
+    def get_config_revision(self):
+        """
+        Identifies the last commit of the device config, so config changes
+        can be detected without fetching the config.
+        Returns None if the device has no commit history
 
-        config = self.device.rpc.get_config(
-            filter_xml="vlans", options={"format": "json"}
+        Commit time has one second resolution, so the revision includes
+        the number of the commits made in the same second as the last one:
+        a commit in the second the vlans were fetched in changes the revision
+        """
+        with self._borrowed_device() as device:
+            reply = device.rpc.get_commit_information()
+        commits = reply.findall("commit-history")
+        if not commits:
+            return None
+        fields = [
+            commits[0].findtext(tag, "")
+            for tag in ("date-time", "user", "client", "log")
+        ]
+        same_second = sum(
+            1 for commit in commits if commit.findtext("date-time", "") == fields[0]
         )
-        return [vlan for vlan in config["configuration"]["vlans"]["vlan"]]
+        return "/".join(fields + [str(same_second)])
 
-    def sync_config_to_target_vlans(self, vlan_list):
-        if not self.connected:
-            self.connect()
+    def sync_config_to_target_vlans(self, vlan_list, commands=None):
+        """
+        Replaces the vlans of the device with `vlan_list`.
 
-        with Config(self.device, mode="exclusive") as cu:
-            cu.load(
-                template_path=VLAN_CONFIG_TEMPLATE,
-                template_vars={"vlan_list": vlan_list},
-            )
-            cu.commit()
+        If `commands` (see `vlan_config_commands`) are given, only they are
+        loaded, so candidate config and commit time depend on the size
+        of the change and not of the vlan table. Full replace is done
+        if they fail to load or commit.
+        """
+        with self._borrowed_device() as device:
+            with Config(device, mode="exclusive") as cu:
+                if commands:
+                    try:
+                        cu.load("\n".join(commands), format="set")
+                        cu.commit()
+                        return
+                    except RpcError:
+                        logging.exception(
+                            f"Failed to push vlan changes to {self.host},"
+                            f" falling back to full replace"
+                        )
+                        cu.rollback()
+                cu.load(
+                    template_path=VLAN_CONFIG_TEMPLATE,
+                    template_vars={"vlan_list": vlan_list},
+                )
+                cu.commit()
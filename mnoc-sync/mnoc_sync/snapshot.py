@@ -0,0 +1,69 @@
+import json
+import logging
+import os
+from typing import List, Optional
+
+import redis
+from mnoc_jobtools.tools import (
+    DEFAULT_REDIS_HOST,
+    DEFAULT_REDIS_PORT,
+    get_connection_pool,
+)
+
+SNAPSHOT_KEY_PREFIX = "vlan_snapshot:"  # Used as prefix for Redis key of the snapshot
+SNAPSHOT_TTL = int(os.getenv("MNOC_VLAN_SNAPSHOT_TTL", 86400))  # seconds
+
+
+class VlanSnapshotStore:
+    """
+    Vlans last fetched from the device, together with the config revision
+    of the device they were fetched at.
+
+    While the revision of the device is the same, vlans of the snapshot
+    are the ones of the device, so fetching the vlan config can be skipped.
+    Snapshots are kept in Redis, so they survive restarts and are shared
+    by all the workers. Redis failures are logged, and the vlans are fetched
+    from the device as if there was no snapshot.
+    """
+
+    def __init__(
+        self,
+        host: str = DEFAULT_REDIS_HOST,
+        port: int = DEFAULT_REDIS_PORT,
+        ttl: int = SNAPSHOT_TTL,
+    ):
+        self._redis = redis.Redis(connection_pool=get_connection_pool(host, port))
+        self.ttl = ttl
+
+    @staticmethod
+    def key(device_id: int) -> str:
+        return f"{SNAPSHOT_KEY_PREFIX}{device_id}"
+
+    def get(self, device_id: int, revision: str) -> Optional[List[dict]]:
+        """Returns vlans of the snapshot if it was taken at the `revision`"""
+        try:
+            payload = self._redis.get(self.key(device_id))
+        except redis.RedisError:
+            logging.exception(f"Failed to get vlan snapshot of the device {device_id}")
+            return None
+        if payload is None:
+            return None
+        snapshot = json.loads(payload)
+        if snapshot["revision"] != revision:
+            return None
+        return snapshot["vlans"]
+
+    def put(self, device_id: int, revision: str, vlans: List[dict]):
+        payload = json.dumps({"revision": revision, "vlans": vlans})
+        try:
+            self._redis.set(self.key(device_id), payload, ex=self.ttl)
+        except redis.RedisError:
+            logging.exception(f"Failed to put vlan snapshot of the device {device_id}")
+
+    def invalidate(self, device_id: int):
+        """Drops the snapshot. Must be called when vlans of the device are changed,
+        as the revision is read separately from the vlans"""
+        try:
+            self._redis.delete(self.key(device_id))
+        except redis.RedisError:
+            logging.exception(f"Failed to drop vlan snapshot of the device {device_id}")
@@ -1,11 +1,27 @@
+import asyncio
+import functools
 import logging
 import os
-from typing import List, Dict, Any
-
-from mnoc_jobtools.tools import SyncJob
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from mnoc_jobtools.events import subscribe_device_changed
+from mnoc_jobtools.tools import JobStatus, SyncJob
+from mnoc_sync.diff import Vlan, are_equal_vlans, diff_vlans
+from mnoc_sync.inventory import DeviceInventory
 from mnoc_sync.mgmt_api import MgmtRestApi
-from mnoc_sync.network import NetworkDevice
+from mnoc_sync.network import (
+    SESSION_POOL,
+    NetworkDevice,
+    NetworkDeviceException,
+    vlan_config_commands,
+)
+from mnoc_sync.snapshot import VlanSnapshotStore
+from mnoc_sync.worker_pool import BatchDrain, SyncWorkerPool
 from jnpr.junos.exception import RpcError, ConnectError
+from redis import RedisError
 
 logging.basicConfig(
     level=logging.DEBUG, format="%(asctime)s %(levelname)-8s %(message)s"
@@ -25,15 +41,49 @@ DEVICE_USER = "automation"
 DEVICE_PASS = "p@ssword"
 DEVICE_VENDOR = "juniper"
 
+# "threads" runs the jobs in a thread pool, "asyncio" as tasks, see mnoc_sync.aio
+SYNC_RUNNER = os.getenv("MNOC_SYNC_RUNNER", "threads")
+# Number of jobs for different devices running at once
+SYNC_WORKERS = int(os.getenv("MNOC_SYNC_WORKERS", 1))
+# Jobs retrieved at once and merged by device and direction. 1 disables merging
+SYNC_BATCH_SIZE = int(os.getenv("MNOC_SYNC_BATCH_SIZE", 1))
+# Seconds to wait for more jobs of the batch after the first one
+SYNC_BATCH_WINDOW = float(os.getenv("MNOC_SYNC_BATCH_WINDOW", 0))
+# "incremental" pushes only the changed vlans, "replace" the whole vlan table
+VLAN_PUSH_MODE = os.getenv("MNOC_VLAN_PUSH_MODE", "incremental")
+# Failures of talking to the device, after which the job is rescheduled.
+# NetworkDeviceException is raised when no session to the device is free in time
+DEVICE_ERRORS = (RpcError, ConnectError, NetworkDeviceException)
+
+
+class SyncResources:
+    """
+    Clients and caches shared by all the jobs of the runner, so HTTP connections
+    and device data are reused. Built by the runner when it starts,
+    so importing the module opens nothing
+    """
 
-"""
-Vlan here is just a json converted to dict
-In the context of mnoc-sync, Vlan can be:
-    - serialized representation of Django Vlan model (variable usually called db_vlan)
-    OR
-    - json representation of Vlan configured at the device (variable usually called device_vlan)
-"""
-Vlan = Dict[str, Any]
+    def __init__(self, pool_size: int = SYNC_WORKERS):
+        self.mgmt_api = MgmtRestApi(
+            hostname=MGMT_API_HOSTNAME,
+            username=MGMT_API_USER,
+            password=MGMT_API_PASS,
+            port=MGMT_API_PORT,
+            pool_size=pool_size,
+        )
+        self.inventory = DeviceInventory(self.mgmt_api)
+        self.snapshots = VlanSnapshotStore()
+        # Runs the device leg of the jobs while their threads fetch from the DB
+        self.fetch_executor = ThreadPoolExecutor(pool_size, thread_name_prefix="fetch")
+
+    def close(self):
+        self.fetch_executor.shutdown()
+
+
+@functools.lru_cache(maxsize=None)
+def default_resources() -> SyncResources:
+    """Resources of the executors created without them, built on first use"""
+    return SyncResources()
 
 
 class VlanSyncJobExecutor:
@@ -45,22 +95,38 @@ class VlanSyncJobExecutor:
     - applies diff to the job target (sync_to)
     """
 
-    def __init__(self, sync_job: SyncJob):
+    def __init__(
+        self,
+        sync_job: SyncJob,
+        mgmt_api: MgmtRestApi = None,
+        inventory: DeviceInventory = None,
+        snapshots: VlanSnapshotStore = None,
+        management_ip: str = None,
+        fetch_executor: ThreadPoolExecutor = None,
+    ):
+        """
+        Args:
+            mgmt_api, inventory, snapshots, fetch_executor (optional): shared by
+                the jobs, see `SyncResources`. Ones of `default_resources` if not given
+            management_ip (optional): IP of the device,
+                if it's known already and mustn't be looked up in the inventory
+        """
         self.sync_job = sync_job
         self.device_id = sync_job.device_id
         self.sync_from = sync_job.sync_from
         self.sync_to = sync_job.sync_to
-        self.mgmt_api = MgmtRestApi(
-            hostname=MGMT_API_HOSTNAME,
-            username=MGMT_API_USER,
-            password=MGMT_API_PASS,
-            port=MGMT_API_PORT,
-        )
-        device_management_ip = self.mgmt_api.get_device(device_id=self.device_id)[
-            "management_ip"
-        ]
+        self.mgmt_api = mgmt_api or default_resources().mgmt_api
+        self.snapshots = snapshots or default_resources().snapshots
+        self.fetch_executor = fetch_executor
+        # Seconds spent fetching vlans, by the side they were fetched from
+        self.timings = {}
+        if management_ip is None:
+            inventory = inventory or default_resources().inventory
+            management_ip = inventory.get_device(device_id=self.device_id)[
+                "management_ip"
+            ]
         self.device = NetworkDevice(
-            host=device_management_ip,
+            host=management_ip,
             port=DEVICE_PORT,
             user=DEVICE_USER,
             password=DEVICE_PASS,
@@ -73,23 +139,38 @@ class VlanSyncJobExecutor:
 
     def fetch_vlan_list_from_device(self):
         """Gets list of currently configured vlans from device
-        excluding default vlan"""
+        excluding default vlan.
+        Vlans of the snapshot are used if the device config wasn't committed
+        since the snapshot was taken"""
+        try:
+            return self._read_device_vlans()
+        except DEVICE_ERRORS:
+            logging.exception(
+                f"Failed to fetch Vlans from device."
+                f" Rescheduling the SyncJob {self.sync_job.uid}"
+            )
+            self.sync_job.reschedule()
+
+    def _read_device_vlans(self) -> List[dict]:
         with self.device as device:
-            try:
-                vlan_list = device.get_vlan_list()
-                non_default_vlans = []
-                for vlan in vlan_list:
-                    if vlan["name"] == "default" and vlan["vlan-id"] == 1:
-                        continue
-                    non_default_vlans.append(vlan)
-                logging.info("Successfully fetched vlan list from device")
-                return non_default_vlans
-            except (RpcError, ConnectError):
-                logging.exception(
-                    f"Failed to fetch Vlans from device."
-                    f" Rescheduling the SyncJob {self.sync_job.uid}"
-                )
-                self.sync_job.reschedule()
+            # Read before the vlans, so a commit in between
+            # makes the snapshot outdated rather than wrong
+            revision = device.get_config_revision()
+            if revision is not None:
+                vlan_list = self.snapshots.get(self.device_id, revision)
+                if vlan_list is not None:
+                    logging.info("Config revision is unchanged, using snapshot")
+                    return vlan_list
+            vlan_list = device.get_vlan_list()
+            non_default_vlans = []
+            for vlan in vlan_list:
+                if vlan["name"] == "default" and vlan["vlan-id"] == 1:
+                    continue
+                non_default_vlans.append(vlan)
+            logging.info("Successfully fetched vlan list from device")
+            if revision is not None:
+                self.snapshots.put(self.device_id, revision, non_default_vlans)
+            return non_default_vlans
 
     def compare_vlans_against_source_of_truth(
         self, subject_vlans: List[Vlan], source_of_truth_vlans: List[Vlan], sot: str
@@ -118,47 +199,15 @@ class VlanSyncJobExecutor:
         Returns:
 
         """
-        mapped_device_vlans = []
-
-        diff = {
-            "synced_vlans": [],
-            "altered_vlans": [],
-            "non_present_vlans": [],
-            "removed_vlans": [],
-        }
-        for sot_vlan in source_of_truth_vlans:
-            mapping_found = False
-            for subject_vlan in subject_vlans:
-                # Case #1: Vlans are identical
-                if are_equal_vlans(subject_vlan, sot_vlan, sot=sot):
-                    mapping_found = True
-                    diff["synced_vlans"].append(sot_vlan)
-                # Case #2: The same vlan ID but some info is outdated
-                elif are_equal_vlans(subject_vlan, sot_vlan, sot=sot, tag_only=True):
-                    mapping_found = True
-                    diff["altered_vlans"].append(sot_vlan)
-                else:
-                    mapping_found = False
-
-                if mapping_found:
-                    mapped_device_vlans.append(subject_vlan)
-                    break
-
-            # Case #3: We didn't find SOT vlan at the box
-            if not mapping_found:
-                diff["non_present_vlans"].append(sot_vlan)
-
-        for subject_vlan in subject_vlans:
-            # Case #4: device vlan doesn't exist in DB
-            if subject_vlan not in mapped_device_vlans:
-                diff["removed_vlans"].append(subject_vlan)
+        return diff_vlans(subject_vlans, source_of_truth_vlans, sot)
 
-        return diff
-
-    def sync_from_db_to_device(self, device_vlans, db_vlans):
-        """Push updates to device"""
+    def _changes(self, subject_vlans, source_of_truth_vlans, sot: str):
+        """Diff of subject vlans against source of truth,
+        or None if they are in sync"""
         diff = self.compare_vlans_against_source_of_truth(
-            subject_vlans=device_vlans, source_of_truth_vlans=db_vlans, sot="db"
+            subject_vlans=subject_vlans,
+            source_of_truth_vlans=source_of_truth_vlans,
+            sot=sot,
         )
         logging.info(f"Discovered Altered Vlans: {len(diff['altered_vlans'])}")
         logging.info(f"Discovered Non-present Vlans: {len(diff['non_present_vlans'])}")
@@ -167,88 +216,174 @@ class VlanSyncJobExecutor:
         if not any(
             (diff["altered_vlans"], diff["non_present_vlans"], diff["removed_vlans"])
         ):
+            return None
+        return diff
+
+    def sync_from_db_to_device(self, device_vlans, db_vlans):
+        """Push updates to device"""
+        diff = self._changes(device_vlans, db_vlans, sot="db")
+        if diff is None:
             logging.warning("No changes detected, so no need to push vlans to device")
             return
-
-        with self.device as device:
-            try:
-                device.sync_config_to_target_vlans(db_vlans)
-                logging.warning("Successfully pushed Vlans config to Deviec")
-            except (RpcError, ConnectError):
-                logging.exception("Failed to push Vlans config to Device")
+        if not self._push_to_device(diff, device_vlans, db_vlans):
+            self.sync_job.reschedule()
+
+    def _push_to_device(self, diff, device_vlans, db_vlans) -> bool:
+        """Returns False if both the incremental push and full replace failed,
+        so the job is rescheduled instead of being finished as a success"""
+        commands = None
+        if VLAN_PUSH_MODE == "incremental":
+            commands = vlan_config_commands(diff, device_vlans)
+        # Snapshot is outdated by the commit, so it's dropped instead of kept until expiry
+        self.snapshots.invalidate(self.device_id)
+        try:
+            # Session is opened within the try, so failing to open it is
+            # a failed push as well
+            with self.device as device:
+                device.sync_config_to_target_vlans(db_vlans, commands=commands)
+        except DEVICE_ERRORS:
+            logging.exception(
+                f"Failed to push Vlans config to Device."
+                f" Rescheduling the SyncJob {self.sync_job.uid}"
+            )
+            return False
+        logging.warning("Successfully pushed Vlans config to Deviec")
+        return True
 
     def sync_from_device_to_db(self, device_vlans, db_vlans):
-        diff = self.compare_vlans_against_source_of_truth(
-            subject_vlans=db_vlans, source_of_truth_vlans=device_vlans, sot="device"
-        )
-        logging.info(f"Discovered Altered Vlans: {len(diff['altered_vlans'])}")
-        logging.info(f"Discovered Non-present Vlans: {len(diff['non_present_vlans'])}")
-        logging.info(f"Discovered Removed vlans Vlans: {len(diff['removed_vlans'])}")
+        diff = self._changes(db_vlans, device_vlans, sot="device")
+        if diff is None:
+            logging.warning("No changes detected, so no need to update DB vlans")
+            return
+        self.mgmt_api.bulk_vlans(**self._db_changes(diff, db_vlans))
+        logging.warning("Successfully synced Device to DB Vlans")
 
-        if diff["altered_vlans"]:
-            self.mgmt_api.update_vlans(diff["altered_vlans"])
+    def _db_changes(self, diff, db_vlans) -> dict:
+        """Arguments of `MgmtRestApi.bulk_vlans`, which apply the diff to DB"""
+        # Altered vlans come from the device, DB ids are of the vlans of the same tag
+        db_vlan_ids = {}
+        for db_vlan in db_vlans:
+            db_vlan_ids.setdefault(db_vlan["tag"], db_vlan["id"])
+        return {
+            "create": [
+                MgmtRestApi.to_db_vlan(vlan, self.device_id)
+                for vlan in diff["non_present_vlans"]
+            ],
+            "update": [
+                dict(
+                    MgmtRestApi.to_db_vlan(vlan, self.device_id),
+                    id=db_vlan_ids[vlan["vlan-id"]],
+                )
+                for vlan in diff["altered_vlans"]
+            ],
+            "delete": diff["removed_vlans"],
+        }
 
-        if diff["non_present_vlans"]:
-            self.mgmt_api.add_vlans_for_device(
-                diff["non_present_vlans"], device_id=self.device_id
-            )
+    def _timed(self, leg: str, fetch):
+        started = time.perf_counter()
+        try:
+            return fetch()
+        finally:
+            self.timings[leg] = time.perf_counter() - started
 
-        if diff["removed_vlans"]:
-            self.mgmt_api.delete_vlans(diff["removed_vlans"])
+    def fetch_vlan_lists(self):
+        """
+        Fetches vlans from the device and from the DB at the same time,
+        so the job waits for the slower of them and not for both.
 
-        logging.warning("Successfully synced Device to DB Vlans")
+        Raises the error of the DB fetch, but only once the device fetch
+        is cancelled or done: the device mustn't be accessed after
+        the job is over. Device vlans are None if the fetch failed
+        and the job was rescheduled.
+        """
+        fetch_executor = self.fetch_executor or default_resources().fetch_executor
+        device_leg = fetch_executor.submit(
+            self._timed, "device", self.fetch_vlan_list_from_device
+        )
+        try:
+            db_vlans = self._timed("db", self.fetch_vlan_list_from_db)
+        except BaseException:
+            if not device_leg.cancel():
+                device_leg.exception()  # Waits for it, the error is of no interest
+            raise
+        device_vlans = device_leg.result()
+        logging.info(
+            f"Fetched vlans from device in {self.timings['device']:.3f}s"
+            f" and from DB in {self.timings['db']:.3f}s"
+        )
+        return device_vlans, db_vlans
 
     def execute_job(self):
-        device_vlans = self.fetch_vlan_list_from_device()
-        db_vlans = self.fetch_vlan_list_from_db()
+        device_vlans, db_vlans = self.fetch_vlan_lists()
+        if device_vlans is None:
+            return  # Job has been rescheduled
         if self.sync_from == "db" and self.sync_to == "device":
             self.sync_from_db_to_device(device_vlans=device_vlans, db_vlans=db_vlans)
         elif self.sync_from == "device" and self.sync_to == "db":
             self.sync_from_device_to_db(device_vlans=device_vlans, db_vlans=db_vlans)
 
 
-def are_equal_vlans(
-    subject_vlan: Vlan, sot_vlan: Vlan, sot: str, tag_only=False
-) -> bool:
-    """Function to compare subject vlan with SOT:
-        - Device and DB vlans have different attributes
-        - We need to compare only significant attributes
-        - Specify `sot` as 'db' or 'device' so we know what are the names of the significant attributes
-        """
-    if sot == "db":
-        db_vlan = sot_vlan
-        device_vlan = subject_vlan
-    elif sot == "device":
-        device_vlan = sot_vlan
-        db_vlan = subject_vlan
-    else:
-        raise NotImplementedError(
-            f"No implementation for {sot}. Supported SOTs: 'db', 'device'"
-        )
-    if tag_only:
-        return db_vlan["tag"] == device_vlan["vlan-id"]
-
-    return all(
-        (
-            db_vlan["description"] == device_vlan["description"],
-            db_vlan["name"] == device_vlan["name"],
-            db_vlan["tag"] == device_vlan["vlan-id"],
-        )
-    )
+def execute_sync_job(sync_job: SyncJob, resources: SyncResources = None):
+    """Executes the job and records its outcome. Failures are logged, not raised"""
+    logging.warning(f"Starting executing sync job: {sync_job}")
+    if sync_job.merged_jobs:
+        logging.info(f"{len(sync_job.merged_jobs)} merged jobs share the outcome")
+    resources = resources or default_resources()
+    try:
+        VlanSyncJobExecutor(
+            sync_job=sync_job,
+            mgmt_api=resources.mgmt_api,
+            inventory=resources.inventory,
+            snapshots=resources.snapshots,
+            fetch_executor=resources.fetch_executor,
+        ).execute_job()
+    except Exception:
+        logging.exception(f"Failed to execute the sync job {sync_job}")
+        sync_job.finish(JobStatus.FAILURE)
+        return
+    finally:
+        sync_job.ack()
+
+    sync_job.finish(JobStatus.SUCCESS)
+    logging.warning(f"Finished executing sync job: {sync_job}")
 
 
 def main():
-    while True:
-        sync_job = SyncJob.get_next_from_queue()
-        executor = VlanSyncJobExecutor(sync_job=sync_job)
-        logging.warning(f"Starting executing sync job: {sync_job}")
-        try:
-            executor.execute_job()
-        except Exception:
-            logging.exception(f"Failed to execute the sync job {sync_job}")
-            continue
-
-        logging.warning(f"Finished executing sync job: {sync_job}")
+    if SYNC_RUNNER == "asyncio":
+        from mnoc_sync import aio
+
+        asyncio.run(aio.main())
+        return
+
+    resources = SyncResources()
+    get_next_job = SyncJob.get_next_from_queue
+    batch_drain = None
+    if SYNC_BATCH_SIZE > 1:
+        get_next_job = batch_drain = BatchDrain(SYNC_BATCH_SIZE, SYNC_BATCH_WINDOW)
+    pool = SyncWorkerPool(
+        size=SYNC_WORKERS,
+        execute_job=functools.partial(execute_sync_job, resources=resources),
+        get_next_job=get_next_job,
+    )
+    # In-flight jobs are drained on shutdown instead of being interrupted
+    signal.signal(signal.SIGTERM, lambda *_: pool.stop())
+    signal.signal(signal.SIGINT, lambda *_: pool.stop())
+    try:
+        device_events = subscribe_device_changed(resources.inventory.invalidate)
+    except RedisError:
+        logging.exception("Device change events are unavailable, cache will expire")
+        device_events = None
+    try:
+        pool.run()
+    finally:
+        if device_events is not None:
+            device_events.stop()
+        if batch_drain is not None:
+            batch_drain.requeue()
+        # Let other workers take over the queue shards of this one
+        SyncJob.leave_shards()
+        resources.close()
+        SESSION_POOL.close_all()
 
 
 if __name__ == "__main__":
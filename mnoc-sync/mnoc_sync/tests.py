@@ -10,10 +10,34 @@ from mnoc_sync.sync import (
     VlanSyncJobExecutor,
     are_equal_vlans,
 )
+from mnoc_jobtools.aio import AsyncSyncJob
 from mnoc_jobtools.tools import SyncJob
+from mnoc_sync.aio import (
+    AsyncBatchDrain,
+    AsyncSyncWorkerPool,
+    AsyncVlanSyncJobExecutor,
+)
+from mnoc_sync.diff import diff_vlans, diff_vlans_pairwise
+from mnoc_sync.inventory import DeviceInventory
 from mnoc_sync.mgmt_api import MgmtRestApi
-from mnoc_sync.network import NetworkDevice
+from mnoc_sync.snapshot import VlanSnapshotStore
+from mnoc_sync.network import (
+    NetworkDevice,
+    NetworkDeviceException,
+    NetworkDeviceSessionPool,
+    vlan_config_commands,
+)
+from mnoc_sync.worker_pool import BatchDrain, SyncWorkerPool
+from jnpr.junos.exception import ConnectError, RpcError
+from concurrent.futures import ThreadPoolExecutor
 from pytest import fixture
+from xml.etree import ElementTree
+import asyncio
+import pytest
+import queue
+import random
+import threading
+import time
 
 # STATICS #########################################################################
 
@@ -69,14 +93,22 @@ def job_executor(sync_job):
 @fixture
 def device_vlan_list():
     return [
-        {"name": "pytest-device-vlan-100", "vlan-id": 100, "description": "pytest",}
+        {
+            "name": "pytest-device-vlan-100",
+            "vlan-id": 100,
+            "description": "pytest",
+        }
     ]
 
 
 @fixture
 def device_vlan_list_new():
     return [
-        {"name": "pytest-device-vlan-333", "vlan-id": 333, "description": "pytest",}
+        {
+            "name": "pytest-device-vlan-333",
+            "vlan-id": 333,
+            "description": "pytest",
+        }
     ]
 
 
@@ -113,8 +145,16 @@ def db_vlan_list_altered():
 @fixture
 def device_vlan_list_altered():
     return [
-        {"name": "pytest-device-vlan-100", "tag": 100, "description": "pytest",},
-        {"name": "pytest-device-vlan-300", "tag": 300, "description": "pytest",},
+        {
+            "name": "pytest-device-vlan-100",
+            "tag": 100,
+            "description": "pytest",
+        },
+        {
+            "name": "pytest-device-vlan-300",
+            "tag": 300,
+            "description": "pytest",
+        },
     ]
 
 
@@ -126,6 +166,19 @@ class TestMgmtRestApi:
         response = mgmt_api.get_vlans_for_device(DEVICE_DB_ID)
         assert isinstance(response, list)
 
+    def test_api_get_vlans_not_modified(self, mgmt_api, monkeypatch):
+        vlans = mgmt_api.get_vlans_for_device(DEVICE_DB_ID)
+        responses = []
+        get = mgmt_api._session.get
+
+        def spy_get(*args, **kwargs):
+            responses.append(get(*args, **kwargs))
+            return responses[-1]
+
+        monkeypatch.setattr(mgmt_api._session, "get", spy_get)
+        assert mgmt_api.get_vlans_for_device(DEVICE_DB_ID) == vlans
+        assert responses[0].status_code == 304
+
     def test_api_add_delete_vlan(self, mgmt_api, device_vlan_list_new):
         vlan = device_vlan_list_new[0]
         mgmt_api.add_vlans_for_device(device_vlan_list_new, device_id=DEVICE_DB_ID)
@@ -137,6 +190,21 @@ class TestMgmtRestApi:
 
         assert vlan_found
 
+    def test_api_bulk_vlans(self, mgmt_api, device_vlan_list_new):
+        new_vlans = [
+            mgmt_api.to_db_vlan(vlan, DEVICE_DB_ID) for vlan in device_vlan_list_new
+        ]
+        assert mgmt_api.bulk_vlans(create=new_vlans)["created"] == len(new_vlans)
+        db_vlans = [
+            db_vlan
+            for db_vlan in mgmt_api.get_vlans_for_device(DEVICE_DB_ID)
+            if db_vlan["name"] in {vlan["name"] for vlan in new_vlans}
+        ]
+        for db_vlan in db_vlans:
+            db_vlan["description"] = "pytest-bulk"
+        assert mgmt_api.bulk_vlans(update=db_vlans)["updated"] == len(db_vlans)
+        assert mgmt_api.bulk_vlans(delete=db_vlans)["deleted"] == len(db_vlans)
+
 
 class TestSyncJobExecutor:
     def test_executor_resolve_device_ip(self, job_executor):
@@ -176,3 +244,637 @@ class TestSyncJobExecutor:
 
     def test_job_executor(self, job_executor):
         job_executor.execute_job()
+
+
+class TestSyncWorkerPool:
+    @staticmethod
+    def queued_jobs(device_ids):
+        job_queue = queue.Queue()
+        for device_id in device_ids:
+            job_queue.put(SyncJob(device_id, "db", "device"))
+
+        def get_next_job(timeout, busy_shards):
+            try:
+                return job_queue.get(timeout=timeout)
+            except queue.Empty:
+                return None
+
+        return get_next_job
+
+    def test_devices_run_concurrently_jobs_of_device_in_order(self):
+        device_ids = [1, 2, 1, 3, 1, 2]
+        executed = []
+        running = set()
+        lock = threading.Lock()
+        max_running = 0
+
+        def execute_job(sync_job):
+            nonlocal max_running
+            with lock:
+                assert sync_job.device_id not in running
+                running.add(sync_job.device_id)
+                max_running = max(max_running, len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(sync_job.device_id)
+                executed.append(sync_job)
+                if len(executed) == len(device_ids):
+                    pool.stop()
+
+        get_next_job = self.queued_jobs(device_ids)
+        pool = SyncWorkerPool(4, execute_job, get_next_job, poll_interval=0.05)
+        pool.run()
+        assert sorted(job.device_id for job in executed) == sorted(device_ids)
+        assert max_running > 1
+        assert pool.busy_shards() == set()
+
+    def test_stop_drains_in_flight_jobs(self):
+        retrieved = []
+        executed = []
+        get_queued_job = self.queued_jobs([1, 1, 2, 3])
+
+        def get_next_job(timeout, busy_shards):
+            sync_job = get_queued_job(timeout, busy_shards)
+            if sync_job:
+                retrieved.append(sync_job)
+            return sync_job
+
+        def execute_job(sync_job):
+            pool.stop()
+            time.sleep(0.1)
+            executed.append(sync_job)
+
+        pool = SyncWorkerPool(2, execute_job, get_next_job, poll_interval=0.05)
+        pool.run()
+        # Jobs retrieved before stop are done, the rest stay in the queue
+        assert executed
+        assert sorted(job.uid for job in executed) == sorted(
+            job.uid for job in retrieved
+        )
+
+    def test_backlog_overflow_is_requeued(self):
+        device_ids = [1, 1, 1, 1, 2]
+        get_queued_job = self.queued_jobs(device_ids)
+        requeued = []
+        executed = []
+
+        def get_next_job(timeout, busy_shards):
+            sync_job = get_queued_job(timeout, busy_shards)
+            if sync_job is not None:
+                sync_job.put_to_queue = lambda delay: requeued.append((sync_job, delay))
+            return sync_job
+
+        def execute_job(sync_job):
+            if sync_job.device_id == 2:
+                pool.stop()
+            else:
+                time.sleep(0.1)  # Until all the jobs are retrieved
+            executed.append(sync_job.device_id)
+
+        pool = SyncWorkerPool(
+            2, execute_job, get_next_job, 0.05, max_backlog=1, requeue_delay=3
+        )
+        pool.run()
+        assert sorted(executed) == [1, 1, 2]
+        assert [delay for _, delay in requeued] == [3, 3]
+
+    def test_batch_drain_merges_jobs_of_device(self):
+        device_ids = [1, 2, 1, 1, 2, 3]
+        get_queued_job = self.queued_jobs(device_ids)
+        executed = []
+
+        def get_many_jobs(max_jobs, window, timeout, busy_shards):
+            jobs = []
+            while len(jobs) < max_jobs:
+                sync_job = get_queued_job(timeout if not jobs else 0.01, busy_shards)
+                if sync_job is None:
+                    break
+                jobs.append(sync_job)
+            return jobs
+
+        def execute_job(sync_job):
+            executed.append(sync_job)
+            if len(executed) == 3:
+                pool.stop()
+
+        batch_drain = BatchDrain(10, get_many_jobs=get_many_jobs)
+        pool = SyncWorkerPool(2, execute_job, batch_drain, poll_interval=0.05)
+        pool.run()
+        merged = {job.device_id: len(job.merged_jobs) for job in executed}
+        assert merged == {1: 2, 2: 1, 3: 0}
+
+    def test_busy_shards_include_buffered_jobs(self, monkeypatch):
+        monkeypatch.setattr(SyncJob, "SHARD_COUNT", 16)
+        device_ids = [1, 2, 3]
+        batch_drain = BatchDrain(
+            10,
+            get_many_jobs=lambda **_: [SyncJob(i, "db", "device") for i in device_ids],
+        )
+        pool = SyncWorkerPool(2, lambda sync_job: None, batch_drain)
+        # Job of device 1 is in flight, jobs of devices 2 and 3 are buffered
+        assert pool._start(batch_drain(timeout=0))
+        assert pool.busy_shards() == {SyncJob.shard_for(i) for i in device_ids}
+        for _ in device_ids[1:]:
+            batch_drain(timeout=0)
+        assert pool.busy_shards() == {SyncJob.shard_for(1)}
+
+
+class FakeMgmtApi:
+    def __init__(self):
+        self.fetched = 0
+
+    def get_device(self, device_id):
+        self.fetched += 1
+        return {"id": device_id, "management_ip": f"10.0.0.{self.fetched}"}
+
+
+class TestDeviceInventory:
+    def test_device_cached(self):
+        inventory = DeviceInventory(FakeMgmtApi())
+        assert inventory.get_device(1) is inventory.get_device(1)
+        assert inventory.mgmt_api.fetched == 1
+
+    def test_cache_expired(self):
+        inventory = DeviceInventory(FakeMgmtApi(), ttl=0)
+        inventory.get_device(1)
+        assert inventory.get_device(1)["management_ip"] == "10.0.0.2"
+
+    def test_invalidate(self):
+        inventory = DeviceInventory(FakeMgmtApi())
+        inventory.get_device(1)
+        inventory.get_device(2)
+        inventory.invalidate(1)
+        assert inventory.get_device(1)["management_ip"] == "10.0.0.3"
+        assert inventory.get_device(2)["management_ip"] == "10.0.0.2"
+        inventory.invalidate()
+        assert inventory.get_device(2)["management_ip"] == "10.0.0.4"
+
+
+class FakeRevisionDevice:
+    def __init__(self, vlans):
+        self.vlans = vlans
+        self.revision = "rev-1"
+        self.fetched = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def get_config_revision(self):
+        return self.revision
+
+    def get_vlan_list(self):
+        self.fetched += 1
+        return self.vlans
+
+
+class TestVlanSnapshot:
+    @fixture
+    def snapshots(self):
+        snapshots = VlanSnapshotStore()
+        snapshots.invalidate(DEVICE_DB_ID)
+        return snapshots
+
+    @fixture
+    def executor(self, sync_job_db_to_device, snapshots, device_vlan_list):
+        executor = VlanSyncJobExecutor(
+            sync_job_db_to_device,
+            inventory=DeviceInventory(FakeMgmtApi()),
+            snapshots=snapshots,
+        )
+        executor.device = FakeRevisionDevice(device_vlan_list)
+        snapshots.invalidate(executor.device_id)
+        return executor
+
+    def test_snapshot_of_revision(self, snapshots, device_vlan_list):
+        snapshots.put(DEVICE_DB_ID, "rev-1", device_vlan_list)
+        assert snapshots.get(DEVICE_DB_ID, "rev-1") == device_vlan_list
+        assert snapshots.get(DEVICE_DB_ID, "rev-2") is None
+        snapshots.invalidate(DEVICE_DB_ID)
+        assert snapshots.get(DEVICE_DB_ID, "rev-1") is None
+
+    def test_fetch_skipped_while_revision_unchanged(self, executor, device_vlan_list):
+        assert executor.fetch_vlan_list_from_device() == device_vlan_list
+        assert executor.fetch_vlan_list_from_device() == device_vlan_list
+        assert executor.device.fetched == 1
+        executor.device.revision = "rev-2"
+        executor.fetch_vlan_list_from_device()
+        assert executor.device.fetched == 2
+
+
+class TestParallelFetch:
+    @fixture
+    def executor(self, sync_job_db_to_device):
+        return VlanSyncJobExecutor(
+            sync_job_db_to_device, inventory=DeviceInventory(FakeMgmtApi())
+        )
+
+    def test_legs_overlap(self, executor, device_vlan_list, db_vlan_list):
+        def fetch(vlans):
+            time.sleep(0.2)
+            return vlans
+
+        executor.fetch_vlan_list_from_device = lambda: fetch(device_vlan_list)
+        executor.fetch_vlan_list_from_db = lambda: fetch(db_vlan_list)
+        started = time.perf_counter()
+        assert executor.fetch_vlan_lists() == (device_vlan_list, db_vlan_list)
+        assert time.perf_counter() - started < 0.35
+        assert executor.timings["device"] >= 0.2
+        assert executor.timings["db"] >= 0.2
+
+    def test_db_error_raised_after_device_leg(self, executor):
+        device_leg_started = threading.Event()
+        device_leg_done = threading.Event()
+
+        def fetch_from_device():
+            device_leg_started.set()
+            time.sleep(0.1)
+            device_leg_done.set()
+
+        def fetch_from_db():
+            device_leg_started.wait(1)
+            raise ConnectionError("MgmtApi is down")
+
+        executor.fetch_vlan_list_from_device = fetch_from_device
+        executor.fetch_vlan_list_from_db = fetch_from_db
+        with pytest.raises(ConnectionError):
+            executor.fetch_vlan_lists()
+        assert device_leg_done.is_set()
+
+    def test_no_sync_after_device_error(self, executor, db_vlan_list):
+        synced = []
+        executor.fetch_vlan_list_from_device = lambda: None  # Rescheduled
+        executor.fetch_vlan_list_from_db = lambda: db_vlan_list
+        executor.sync_from_db_to_device = lambda **kwargs: synced.append(kwargs)
+        executor.execute_job()
+        assert synced == []
+
+
+class TestAsyncRunner:
+    def test_pool_devices_run_concurrently_jobs_of_device_in_order(self):
+        jobs = [AsyncSyncJob(device_id, "db", "device") for device_id in [1, 2, 1, 3]]
+        executed = []
+        running = set()
+        max_running = 0
+
+        async def get_next_job(timeout, busy_shards):
+            if jobs:
+                return jobs.pop(0)
+            await asyncio.sleep(timeout)
+
+        async def execute_job(sync_job):
+            nonlocal max_running
+            assert sync_job.device_id not in running
+            running.add(sync_job.device_id)
+            max_running = max(max_running, len(running))
+            await asyncio.sleep(0.05)
+            running.remove(sync_job.device_id)
+            executed.append(sync_job.device_id)
+            if len(executed) == 4:
+                pool.stop()
+
+        pool = AsyncSyncWorkerPool(4, execute_job, get_next_job, poll_interval=0.05)
+        asyncio.run(pool.run())
+        assert sorted(executed) == [1, 1, 2, 3]
+        assert max_running > 1
+        assert pool.busy_shards() == set()
+
+    def test_batch_drain_merges_jobs_of_device(self):
+        jobs = [AsyncSyncJob(device_id, "db", "device") for device_id in [1, 2, 1, 1]]
+        executed = []
+
+        async def get_many_jobs(max_jobs, window, timeout, busy_shards):
+            batch = jobs[:max_jobs]
+            del jobs[:max_jobs]
+            if not batch:
+                await asyncio.sleep(timeout)
+            return batch
+
+        async def execute_job(sync_job):
+            executed.append(sync_job)
+            if len(executed) == 2:
+                pool.stop()
+
+        batch_drain = AsyncBatchDrain(10, get_many_jobs=get_many_jobs)
+        pool = AsyncSyncWorkerPool(2, execute_job, batch_drain, poll_interval=0.05)
+        asyncio.run(pool.run())
+        merged = {job.device_id: len(job.merged_jobs) for job in executed}
+        assert merged == {1: 2, 2: 0}
+
+    @fixture
+    def executor(self):
+        device_executor = ThreadPoolExecutor(2)
+        yield AsyncVlanSyncJobExecutor(
+            AsyncSyncJob(1, "db", "device"), FakeMgmtApi(), "10.0.0.1", device_executor
+        )
+        device_executor.shutdown()
+
+    def test_device_calls_offloaded(self, executor, device_vlan_list, db_vlan_list):
+        def read_device_vlans():
+            time.sleep(0.2)  # Blocking, as PyEZ calls are
+            return device_vlan_list
+
+        async def fetch_vlan_list_from_db():
+            await asyncio.sleep(0.2)
+            return db_vlan_list
+
+        executor._read_device_vlans = read_device_vlans
+        executor.fetch_vlan_list_from_db = fetch_vlan_list_from_db
+        started = time.perf_counter()
+        assert asyncio.run(executor.fetch_vlan_lists()) == (
+            device_vlan_list,
+            db_vlan_list,
+        )
+        assert time.perf_counter() - started < 0.35
+        assert executor.timings["device"] >= 0.2
+
+    def test_device_error_reschedules(self, executor, db_vlan_list, monkeypatch):
+        rescheduled = []
+
+        def read_device_vlans():
+            raise ConnectError(None)
+
+        async def reschedule():
+            rescheduled.append(True)
+
+        async def fetch_vlan_list_from_db():
+            return db_vlan_list
+
+        executor._read_device_vlans = read_device_vlans
+        executor.fetch_vlan_list_from_db = fetch_vlan_list_from_db
+        monkeypatch.setattr(executor.sync_job, "reschedule", reschedule)
+        asyncio.run(executor.execute_job())
+        assert rescheduled == [True]
+
+
+class FakeDevice:
+    opened = 0
+
+    def __init__(self, host, port, user, password):
+        self.host = host
+        self.connected = False
+        self.rpc = self
+
+    def open(self):
+        FakeDevice.opened += 1
+        self.connected = True
+
+    def close(self):
+        self.connected = False
+
+    def get_system_uptime_information(self):
+        if not self.connected:
+            raise ConnectError(self)
+
+
+class FailingDevice(FakeDevice):
+    def open(self):
+        raise ConnectError(self)
+
+
+class TestPushErrors:
+    @fixture
+    def executor(self, sync_job_db_to_device):
+        executor = VlanSyncJobExecutor(
+            sync_job_db_to_device,
+            mgmt_api=FakeMgmtApi(),
+            snapshots=VlanSnapshotStore(),
+            management_ip="10.0.0.1",
+        )
+        executor.rescheduled = []
+        executor.sync_job.reschedule = lambda: executor.rescheduled.append(True)
+        return executor
+
+    @staticmethod
+    def push(executor, db_vlans, session_pool) -> list:
+        executor.device.session_pool = session_pool
+        executor.sync_from_db_to_device(device_vlans=[], db_vlans=db_vlans)
+        return executor.rescheduled
+
+    def test_commit_error_reschedules_job(self, executor, db_vlan_list):
+        def push(vlan_list, commands=None):
+            raise ConnectError("device-1")
+
+        executor.device.sync_config_to_target_vlans = push
+        session_pool = NetworkDeviceSessionPool(device_factory=FakeDevice)
+        assert self.push(executor, db_vlan_list, session_pool) == [True]
+
+    def test_open_error_reschedules_job(self, executor, db_vlan_list):
+        session_pool = NetworkDeviceSessionPool(device_factory=FailingDevice)
+        assert self.push(executor, db_vlan_list, session_pool) == [True]
+
+    def test_session_timeout_reschedules_job(self, executor, db_vlan_list):
+        session_pool = NetworkDeviceSessionPool(
+            device_factory=FakeDevice, max_sessions_per_device=1, acquire_timeout=0
+        )
+        # The only session to the device is busy
+        with session_pool.session("10.0.0.1", DEVICE_PORT, DEVICE_USER, DEVICE_PASS):
+            assert self.push(executor, db_vlan_list, session_pool) == [True]
+
+
+class TestConfigRevision:
+    @staticmethod
+    def network_device(*commits):
+        reply = ElementTree.fromstring(
+            "<commit-information>"
+            + "".join(
+                f"<commit-history><date-time>{date_time}</date-time>"
+                f"<user>{user}</user><client>cli</client></commit-history>"
+                for date_time, user in commits
+            )
+            + "</commit-information>"
+        )
+        device = FakeDevice("device-1", DEVICE_PORT, DEVICE_USER, DEVICE_PASS)
+        device.get_commit_information = lambda: reply
+        network_device = NetworkDevice(
+            "device-1", DEVICE_PORT, DEVICE_USER, DEVICE_PASS, DEVICE_VENDOR
+        )
+        network_device.device = device
+        return network_device
+
+    def test_no_history(self):
+        assert self.network_device().get_config_revision() is None
+
+    def test_commit_in_same_second_changes_revision(self):
+        first = ("2026-01-01 10:00:00 UTC", "automation")
+        second = ("2026-01-01 10:00:00 UTC", "automation")
+        before = self.network_device(first, ("2025-12-31 09:00:00 UTC", "admin"))
+        after = self.network_device(second, first)
+        assert before.get_config_revision() != after.get_config_revision()
+        assert before.get_config_revision() == before.get_config_revision()
+
+
+class TestNetworkDeviceSessionPool:
+    @fixture
+    def session_pool(self):
+        FakeDevice.opened = 0
+        return NetworkDeviceSessionPool(
+            check_interval=0, acquire_timeout=0.1, device_factory=FakeDevice
+        )
+
+    def network_device(self, session_pool, host="device-1"):
+        return NetworkDevice(
+            host, DEVICE_PORT, DEVICE_USER, DEVICE_PASS, DEVICE_VENDOR, session_pool
+        )
+
+    def test_session_reused(self, session_pool):
+        network_device = self.network_device(session_pool)
+        with network_device:
+            first = network_device.device
+        with network_device:
+            assert network_device.device is first
+        assert FakeDevice.opened == 1
+
+    def test_dead_session_replaced(self, session_pool):
+        network_device = self.network_device(session_pool)
+        with network_device:
+            first = network_device.device
+        first.close()  # By the device, while the session is idle
+        with network_device:
+            assert network_device.device is not first
+            assert network_device.connected
+        assert FakeDevice.opened == 2
+
+    def test_idle_session_evicted(self, session_pool):
+        session_pool.idle_timeout = 0
+        network_device = self.network_device(session_pool)
+        with network_device:
+            first = network_device.device
+        with network_device:
+            assert network_device.device is not first
+        assert not first.connected
+
+    def test_sessions_per_device_capped(self, session_pool):
+        with self.network_device(session_pool):
+            with pytest.raises(NetworkDeviceException):
+                with self.network_device(session_pool):
+                    pass
+            with self.network_device(session_pool, host="device-2"):
+                pass
+
+
+def random_vlan_lists(seed):
+    """Device and DB vlans with random overlap, alterations and duplicate tags"""
+    rng = random.Random(seed)
+    device_vlans = []
+    db_vlans = []
+    for tag in rng.sample(range(1, 60), 40):
+        vlan = {"name": f"vlan-{tag}", "description": rng.choice(["a", "b"])}
+        for _ in range(rng.choice([0, 1, 1, 1, 2])):
+            device_vlans.append(dict(vlan, **{"vlan-id": tag}))
+        for _ in range(rng.choice([0, 1, 1, 1, 2])):
+            db_vlans.append(
+                dict(vlan, tag=tag, description=rng.choice(["a", "b"]), device=1)
+            )
+    rng.shuffle(device_vlans)
+    rng.shuffle(db_vlans)
+    return device_vlans, db_vlans
+
+
+class TestVlanDiff:
+    @pytest.mark.parametrize("seed", range(50))
+    def test_equivalent_to_pairwise_diff(self, seed):
+        device_vlans, db_vlans = random_vlan_lists(seed)
+        assert diff_vlans(device_vlans, db_vlans, sot="db") == diff_vlans_pairwise(
+            device_vlans, db_vlans, sot="db"
+        )
+        assert diff_vlans(db_vlans, device_vlans, sot="device") == diff_vlans_pairwise(
+            db_vlans, device_vlans, sot="device"
+        )
+
+    def test_diff_buckets(self, device_vlan_list, db_vlan_list_altered):
+        diff = diff_vlans(device_vlan_list, db_vlan_list_altered, sot="db")
+        assert diff["synced_vlans"] == []
+        assert diff["altered_vlans"] == [db_vlan_list_altered[1]]
+        assert diff["non_present_vlans"] == [db_vlan_list_altered[0]]
+        assert diff["removed_vlans"] == []
+
+    def test_empty_lists(self, device_vlan_list):
+        diff = diff_vlans(device_vlan_list, [], sot="db")
+        assert diff["removed_vlans"] == device_vlan_list
+        diff = diff_vlans([], device_vlan_list, sot="device")
+        assert diff["non_present_vlans"] == device_vlan_list
+
+    def test_unknown_sot(self):
+        with pytest.raises(NotImplementedError):
+            diff_vlans([], [], sot="unknown")
+
+
+class FakeConfig:
+    loaded = []
+    fail_set_load = False
+
+    def __init__(self, device, mode=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def load(self, *args, **kwargs):
+        if kwargs.get("format") == "set" and FakeConfig.fail_set_load:
+            raise RpcError()
+        FakeConfig.loaded.append(kwargs.get("format", "template"))
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        FakeConfig.loaded.clear()
+
+
+class TestIncrementalVlanPush:
+    def test_commands(self):
+        device_vlans = [
+            {"name": "synced", "vlan-id": 10, "description": "a"},
+            {"name": "described", "vlan-id": 20, "description": "a"},
+            {"name": "renamed", "vlan-id": 30, "description": "a"},
+            {"name": "removed", "vlan-id": 40, "description": "a"},
+        ]
+        db_vlans = [
+            {"name": "synced", "tag": 10, "description": "a"},
+            {"name": "described", "tag": 20, "description": 'say "b"'},
+            {"name": "removed", "tag": 30, "description": "a"},
+            {"name": "new", "tag": 50, "description": None},
+        ]
+        diff = diff_vlans(device_vlans, db_vlans, sot="db")
+        assert vlan_config_commands(diff, device_vlans) == [
+            "delete vlans removed",
+            "delete vlans renamed",
+            'set vlans described description "say \\"b\\""',
+            "set vlans removed vlan-id 30",
+            'set vlans removed description "a"',
+            "set vlans new vlan-id 50",
+        ]
+
+    def test_no_commands_for_synced_vlans(self, device_vlan_list):
+        db_vlans = [dict(vlan, tag=vlan["vlan-id"]) for vlan in device_vlan_list]
+        diff = diff_vlans(device_vlan_list, db_vlans, sot="db")
+        assert vlan_config_commands(diff, device_vlan_list) == []
+
+    @pytest.mark.parametrize(
+        "commands, fail_set_load, loaded",
+        [
+            (["set vlans new vlan-id 50"], False, ["set"]),
+            (["set vlans new vlan-id 50"], True, ["template"]),
+            (None, False, ["template"]),
+        ],
+    )
+    def test_push(self, monkeypatch, commands, fail_set_load, loaded):
+        monkeypatch.setattr("mnoc_sync.network.Config", FakeConfig)
+        monkeypatch.setattr(FakeConfig, "loaded", [])
+        monkeypatch.setattr(FakeConfig, "fail_set_load", fail_set_load)
+        network_device = NetworkDevice(
+            "device-1",
+            DEVICE_PORT,
+            DEVICE_USER,
+            DEVICE_PASS,
+            DEVICE_VENDOR,
+            NetworkDeviceSessionPool(device_factory=FakeDevice),
+        )
+        network_device.sync_config_to_target_vlans([], commands=commands)
+        assert FakeConfig.loaded == loaded
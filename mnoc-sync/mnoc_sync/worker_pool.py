@@ -0,0 +1,205 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from mnoc_jobtools.tools import SyncJob
+
+
+class SyncWorkerPool:
+    """
+    Runs sync jobs of different devices concurrently.
+
+    Jobs spend most of the time waiting for NETCONF and REST round trips,
+    so threads are used: they don't need the jobs and PyEZ devices
+    to be pickled, and the waiting doesn't hold the GIL.
+
+    Jobs of the same device never run concurrently and keep the order
+    they were retrieved in: a job of a device which is busy waits in
+    the backlog of the device and is run by the same thread
+    when the in-flight job is done. Backlog holds up to `max_backlog` jobs,
+    the next ones are put back to the queue with a delay: jobs in memory
+    are lost if the worker crashes, unless the queue tracks deliveries.
+
+    A job is retrieved from the queue only when there is a free thread,
+    so the rest of the jobs stay in the queue for other workers.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        execute_job,
+        get_next_job=SyncJob.get_next_from_queue,
+        poll_interval: float = 1,
+        max_backlog: int = 10,
+        requeue_delay: float = 5,
+    ):
+        """
+        Args:
+            size: max number of jobs running at once
+            execute_job: callable, which runs the SyncJob. It must not raise
+            get_next_job (optional): callable, which takes `timeout`
+                and `busy_shards` and returns next SyncJob or None on timeout.
+                If it holds retrieved jobs itself, like BatchDrain,
+                its `busy_shards` method returns the shards of those jobs
+            poll_interval (optional): seconds between checks
+                whether the pool was stopped, while waiting for a job
+            max_backlog (optional): max number of jobs waiting for a busy device
+            requeue_delay (optional): seconds before the job, which didn't fit
+                into the backlog, gets back into the queue
+        """
+        self.size = size
+        self._execute_job = execute_job
+        self._get_next_job = get_next_job
+        self.poll_interval = poll_interval
+        self.max_backlog = max_backlog
+        self.requeue_delay = requeue_delay
+        self._slots = threading.Semaphore(size)
+        self._stopped = threading.Event()
+        # device id -> jobs of the busy device waiting for the in-flight one.
+        # Device is busy as long as it has an entry here
+        self._backlogs = {}
+        self._backlogs_lock = threading.Lock()
+
+    def run(self):
+        """
+        Retrieves and runs jobs until `stop` is called.
+        Returns when all the retrieved jobs are done
+        """
+        logging.info(f"Starting sync worker pool of {self.size} threads")
+        with ThreadPoolExecutor(self.size, thread_name_prefix="sync") as executor:
+            while not self._stopped.is_set():
+                if not self._slots.acquire(timeout=self.poll_interval):
+                    continue
+                sync_job = self._get_next_job(
+                    timeout=self.poll_interval, busy_shards=self.busy_shards()
+                )
+                if sync_job is not None and self._backlog_is_full(sync_job):
+                    self._requeue(sync_job)
+                    sync_job = None
+                if sync_job is None or not self._start(sync_job):
+                    self._slots.release()
+                    continue
+                executor.submit(self._run_device_jobs, sync_job)
+            logging.warning("Sync worker pool is stopping, draining in-flight jobs")
+        logging.warning("Sync worker pool has stopped")
+
+    def stop(self):
+        """Stops retrieving new jobs. Safe to call from a signal handler"""
+        self._stopped.set()
+
+    def busy_shards(self) -> set:
+        """Queue shards of the devices with jobs in flight,
+        and of the jobs held by `get_next_job`, e.g. buffered by BatchDrain"""
+        with self._backlogs_lock:
+            shards = {SyncJob.shard_for(device_id) for device_id in self._backlogs}
+        held_shards = getattr(self._get_next_job, "busy_shards", None)
+        if held_shards is not None:
+            shards |= held_shards()
+        return shards
+
+    def _backlog_is_full(self, sync_job: SyncJob) -> bool:
+        """Backlogs are only appended to by `run`, so the backlog
+        which is not full now stays so until the job is started"""
+        with self._backlogs_lock:
+            backlog = self._backlogs.get(sync_job.device_id, ())
+            return len(backlog) >= self.max_backlog
+
+    def _requeue(self, sync_job: SyncJob):
+        """Puts the job, which didn't fit into the backlog, back to the queue"""
+        logging.info(f"Backlog of the device is full, job is requeued: {sync_job}")
+        sync_job.put_to_queue(delay=self.requeue_delay)
+        sync_job.ack()
+
+    def _start(self, sync_job: SyncJob) -> bool:
+        """Marks the device of the job busy.
+        Returns False if it already was, and the job went to its backlog"""
+        with self._backlogs_lock:
+            backlog = self._backlogs.get(sync_job.device_id)
+            if backlog is not None:
+                logging.info(f"Device is busy, job is put to its backlog: {sync_job}")
+                backlog.append(sync_job)
+                return False
+            self._backlogs[sync_job.device_id] = deque()
+            return True
+
+    def _run_device_jobs(self, sync_job: SyncJob):
+        """Runs the job, then the backlog of its device, then frees the slot"""
+        try:
+            while sync_job is not None:
+                try:
+                    self._execute_job(sync_job)
+                except Exception:
+                    logging.exception(f"Failed to execute the sync job {sync_job}")
+                with self._backlogs_lock:
+                    backlog = self._backlogs[sync_job.device_id]
+                    if backlog:
+                        sync_job = backlog.popleft()
+                    else:
+                        del self._backlogs[sync_job.device_id]
+                        sync_job = None
+        finally:
+            self._slots.release()
+
+
+class BatchDrain:
+    """
+    `get_next_job` for SyncWorkerPool, which retrieves up to `max_jobs` jobs
+    at once and merges consecutive jobs of the same device and direction,
+    so a burst of jobs for a device costs one execution and one commit.
+
+    Jobs of the other groups of the batch are buffered and handed out
+    by the next calls, before anything else is retrieved.
+    Call `requeue` on shutdown, to return the buffered jobs to the queue.
+    """
+
+    def __init__(
+        self,
+        max_jobs: int,
+        window: float = 0,
+        get_many_jobs=SyncJob.get_many_from_queue,
+    ):
+        """
+        Args:
+            max_jobs: max number of jobs retrieved at once
+            window (optional): seconds to wait for more jobs after the first one
+            get_many_jobs (optional): callable, which takes `max_jobs`, `window`,
+                `timeout` and `busy_shards` and returns list of SyncJobs
+        """
+        self.max_jobs = max_jobs
+        self.window = window
+        self._get_many_jobs = get_many_jobs
+        self._buffered = deque()
+        self._lock = threading.Lock()
+
+    def __call__(self, timeout: float, busy_shards=()):
+        with self._lock:
+            if not self._buffered:
+                jobs = self._get_many_jobs(
+                    max_jobs=self.max_jobs,
+                    window=self.window,
+                    timeout=timeout,
+                    busy_shards=busy_shards,
+                )
+                self._buffer(jobs)
+            return self._buffered.popleft() if self._buffered else None
+
+    def _buffer(self, jobs: list):
+        merged = SyncJob.merge_jobs(jobs)
+        if len(merged) < len(jobs):
+            logging.info(f"{len(jobs)} jobs are merged into {len(merged)}")
+        self._buffered.extend(merged)
+
+    def busy_shards(self) -> set:
+        """Queue shards of the buffered jobs: they must stay owned by the worker
+        until the jobs are done, see `SyncWorkerPool.busy_shards`"""
+        with self._lock:
+            return {sync_job.shard for sync_job in self._buffered}
+
+    def requeue(self):
+        """Returns buffered jobs to the queue. Merged jobs are submitted once"""
+        with self._lock:
+            while self._buffered:
+                sync_job = self._buffered.popleft()
+                sync_job.put_to_queue(coalesce=True)
+                sync_job.ack()